@@ -2,12 +2,36 @@ from flask import Flask, request, jsonify
 from flask_cors import CORS
 import pandas as pd
 import numpy as np
-import joblib
 import calendar
+import gzip
 import os
+import io
+import re
+import sys
+import hashlib
+import json
+import multiprocessing
+import shutil
+import copy
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, FIRST_COMPLETED, wait
+from concurrent.futures.process import BrokenProcessPool
+from scipy import sparse, stats
 from prophet import Prophet
+try:
+    import resource  # POSIX only; used for peak RSS reporting
+except ImportError:
+    resource = None
+try:
+    import holidays  # public holiday calendars for the calendar feature store
+except ImportError:
+    holidays = None
 from prophet.diagnostics import cross_validation, performance_metrics
-from sklearn.metrics import mean_absolute_error, mean_squared_error, r2_score
+from prophet.serialize import model_to_json, model_from_json
 
 app = Flask(__name__)
 # Allow requests from your Firebase hosting domain
@@ -21,15 +45,133 @@ CORS(app, origins=[
     "http://127.0.0.1:3000"
 ], supports_credentials=True)
 
-MODEL_PATH = os.path.join(os.path.dirname(__file__), "model", "prophet_sales_forecast.pkl")
-SAVED_MODEL = None
-if os.path.exists(MODEL_PATH):
-    try:
-        SAVED_MODEL = joblib.load(MODEL_PATH)
-        print("✓ Pre-trained model loaded successfully")
-    except Exception as e:
-        print(f"Error loading model: {e}")
-        SAVED_MODEL = None
+class ModelRegistry:
+    """
+    Versioned Prophet models on disk, one directory per version:
+    <root>/<name>/<version>/model.json (Prophet JSON) and meta.json
+    (training range, params, metrics, dataset fingerprint). Metadata is
+    read on request; models are deserialized on first use and kept in memory,
+    so importing the app loads nothing.
+    """
+
+    NAME_PATTERN = re.compile(r"^[A-Za-z0-9_.-]+$")
+
+    def __init__(self, root):
+        self.root = root
+        self._models = {}
+        self._lock = threading.Lock()
+
+    def _path(self, name, version=None):
+        if not self.NAME_PATTERN.match(name or ""):
+            raise ValueError(f"Invalid model name '{name}'")
+        return os.path.join(self.root, name) if version is None else os.path.join(self.root, name, str(version))
+
+    def names(self):
+        if not os.path.isdir(self.root):
+            return []
+        return sorted(n for n in os.listdir(self.root)
+                      if self.NAME_PATTERN.match(n) and os.path.isdir(os.path.join(self.root, n)))
+
+    def versions(self, name):
+        path = self._path(name)
+        if not os.path.isdir(path):
+            return []
+        return sorted(int(v) for v in os.listdir(path)
+                      if v.isdigit() and os.path.exists(os.path.join(path, v, "model.json")))
+
+    def resolve(self, name, version=None):
+        """Concrete version number (latest when None)"""
+        versions = self.versions(name)
+        if not versions:
+            raise LookupError(f"No registered model '{name}'")
+        if version is None:
+            return versions[-1]
+        if int(version) not in versions:
+            raise LookupError(f"Model '{name}' has no version {version}")
+        return int(version)
+
+    def meta(self, name, version=None):
+        version = self.resolve(name, version)
+        with open(os.path.join(self._path(name, version), "meta.json")) as f:
+            return json.load(f)
+
+    def load(self, name, version=None):
+        """(Prophet model, meta) for a registered version, deserialized once"""
+        version = self.resolve(name, version)
+        with self._lock:
+            model = self._models.get((name, version))
+        if model is None:
+            start = time.perf_counter()
+            with open(os.path.join(self._path(name, version), "model.json")) as f:
+                model = model_from_json(f.read())
+            with self._lock:
+                self._models[(name, version)] = model
+            print(f"✓ Loaded registered model {name}@{version} in {(time.perf_counter() - start) * 1000:.1f} ms")
+        return model, self.meta(name, version)
+
+    def register(self, name, model_json, meta):
+        """Store a new version; returns its metadata"""
+        with self._lock:
+            version = (self.versions(name) or [0])[-1] + 1
+            path = self._path(name, version)
+            tmp_path = f"{path}.tmp-{os.getpid()}"
+            os.makedirs(tmp_path, exist_ok=True)
+            meta = {**meta, "name": name, "version": version, "registered_at": pd.Timestamp.now().isoformat()}
+            with open(os.path.join(tmp_path, "model.json"), "w") as f:
+                f.write(model_json)
+            with open(os.path.join(tmp_path, "meta.json"), "w") as f:
+                json.dump(meta, f, indent=2, default=str)
+            os.replace(tmp_path, path)
+        print(f"✓ Registered model {name}@{version}")
+        return meta
+
+    def catalog(self):
+        return {name: [self.meta(name, v) for v in self.versions(name)] for name in self.names()}
+
+
+MODEL_REGISTRY_DIR = os.environ.get("MODEL_REGISTRY_DIR", os.path.join(os.path.dirname(__file__), "model", "registry"))
+MODEL_REGISTRY = ModelRegistry(MODEL_REGISTRY_DIR)
+DEFAULT_MODEL_NAME = "sales_forecast"
+
+
+def parse_model_ref(ref):
+    """Model reference "name" or "name@version" -> (name, version or None)"""
+    name, _, version = str(ref).partition("@")
+    return name or DEFAULT_MODEL_NAME, int(version) if version else None
+
+
+def model_training_meta(model):
+    """Registry metadata describing a fitted Prophet model"""
+    history = model.history
+    return {
+        "training_start": history['ds'].min().strftime("%Y-%m-%d"),
+        "training_end": history['ds'].max().strftime("%Y-%m-%d"),
+        "training_rows": int(len(history)),
+        "params": {
+            "seasonality_mode": model.seasonality_mode,
+            "changepoint_prior_scale": model.changepoint_prior_scale,
+            "seasonality_prior_scale": model.seasonality_prior_scale,
+            "changepoint_range": model.changepoint_range,
+            "interval_width": model.interval_width
+        },
+        "seasonalities": {name: {"period": s["period"], "fourier_order": s["fourier_order"]}
+                          for name, s in model.seasonalities.items()},
+        "calendar": [name for name in model.extra_regressors if name in CALENDAR_REGRESSORS],
+        "series_fingerprint": series_fingerprint(history[['ds', 'y']])
+    }
+
+
+def register_pickled_model(path, name=DEFAULT_MODEL_NAME):
+    """One-off migration of a joblib-pickled Prophet model into the registry"""
+    import joblib
+    model = joblib.load(path)
+    if not isinstance(model, Prophet):
+        raise ValueError(f"{path} does not hold a Prophet model ({type(model).__name__})")
+    return MODEL_REGISTRY.register(name, model_to_json(model), {
+        **model_training_meta(model),
+        "source": os.path.basename(path),
+        "metrics": None
+    })
 
 # SKU Metadata with sizes
 SKU_METADATA = {
@@ -83,6 +225,218 @@ SKU_METADATA = {
     'PW1L': {'brand': 'Premier Water', 'size': '1L', 'category': 'Water'}
 }
 
+# Metadata for SKUs that are not in SKU_METADATA
+UNKNOWN_SKU = {'brand': 'Unknown', 'size': 'N/A', 'category': 'Other'}
+
+# SKU to case quantity mapping (units per case)
+CASE_QUANTITIES = {
+    # Mountain Dew
+    'MD8': 24, 'MD12': 24, 'MD290': 24, 'MD750': 12, 'MD1L': 12, 
+    'MD1.25': 12, 'MD1.5': 12, 'MD1.5/6': 6,
+    # Pepsi
+    'P8': 24, 'P290': 24, 'P750': 12, 'P1L': 12, 
+    'P1.25': 12, 'P1.5': 12, 'P1.5/6': 6,
+    # 7Up
+    'S7': 24, 'SS8': 24, 'SS290': 24, 'SEV290': 24, 
+    'S1.25': 12, 'S1.5': 12,
+    # Gatorade
+    'GBB350': 24, 'GBB500': 24, 'GTF350': 24, 'GR500': 24, 
+    'GO500': 24, 'GB900': 12, 'GBB8': 24, 'GBB237': 24,
+    # Milkis
+    'MILKIS': 30, 'MILKIS500': 20,
+    # Tropicana
+    'TRO8': 24,
+    # Premier Water
+    'PW350': 24, 'PW500': 24, 'PW1L': 12
+}
+
+# Case pricing data (in Philippine Pesos)
+CASE_PRICES = {
+    # Mountain Dew
+    'MD8': 380, 'MD12': 480, 'MD290': 380, 'MD750': 540, 'MD1L': 650,
+    'MD1.25': 720, 'MD1.5': 840, 'MD1.5/6': 420,
+    # Pepsi
+    'P8': 380, 'P290': 380, 'P750': 540, 'P1L': 650,
+    'P1.25': 720, 'P1.5': 840, 'P1.5/6': 420,
+    # 7Up
+    'S7': 350, 'SS8': 380, 'SS290': 380, 'SEV290': 380,
+    'S1.25': 720, 'S1.5': 840,
+    # Gatorade
+    'GBB350': 780, 'GBB500': 980, 'GTF350': 780, 'GR500': 980,
+    'GO500': 980, 'GB900': 780, 'GBB8': 480, 'GBB237': 550,
+    # Milkis
+    'MILKIS': 900, 'MILKIS500': 1200,
+    # Tropicana
+    'TRO8': 420,
+    # Premier Water
+    'PW350': 130, 'PW500': 150, 'PW1L': 170
+}
+
+
+class PriceBook:
+    """
+    SKU catalog (units per case) with versioned, effective-dated case prices.
+    Price versions are kept as flat arrays sorted by (SKU, effective day,
+    version), so pricing a whole date x SKU grid as of each date is a single
+    searchsorted. Changes after the seed catalog persist to a JSON file.
+    """
+
+    BASE_DAY = -10 ** 6   # effective day of the seed prices (before any data)
+    DAY_SPAN = 10 ** 7    # search-key stride per SKU position
+
+    def __init__(self, case_quantities, case_prices, path=None):
+        self.skus = list(case_quantities)
+        self.sku_pos = {sku: i for i, sku in enumerate(self.skus)}
+        self.case_qty = np.array([case_quantities[sku] for sku in self.skus], dtype=float)
+        self.path = path
+        self._lock = threading.Lock()
+        self._versions = [
+            {"version": 0, "sku": sku, "case_price": float(case_prices.get(sku, 0)),
+             "effective_from": None, "note": "catalog"}
+            for sku in self.skus
+        ]
+        if path and os.path.exists(path):
+            with open(path) as f:
+                self._versions += json.load(f)
+        self._rebuild()
+
+    def _rebuild(self):
+        """Re-sort the price arrays; readers swap to the new table atomically"""
+        pos = np.array([self.sku_pos[v["sku"]] for v in self._versions], dtype=np.int64)
+        days = np.array([
+            self.BASE_DAY if v["effective_from"] is None else day_ordinals([v["effective_from"]])[0]
+            for v in self._versions
+        ], dtype=np.int64)
+        versions = np.array([v["version"] for v in self._versions], dtype=np.int64)
+        prices = np.array([v["case_price"] for v in self._versions], dtype=float)
+        order = np.lexsort((versions, days, pos))
+        keys = pos[order] * self.DAY_SPAN + (days[order] - self.BASE_DAY)
+        self._table = (keys, prices[order])
+        self.version = int(versions.max())
+        self.fingerprint = hashlib.sha1(
+            json.dumps(self._versions, sort_keys=True).encode("utf-8")
+        ).hexdigest()[:16]
+
+    def positions(self, skus):
+        """Catalog position of each SKU (-1 = not in the catalog)"""
+        return np.array([self.sku_pos.get(str(sku).strip(), -1) for sku in skus], dtype=np.int64)
+
+    def case_quantities(self, skus):
+        """Units per case aligned to `skus` (1 for SKUs not in the catalog)"""
+        pos = self.positions(skus)
+        return np.where(pos >= 0, self.case_qty[np.maximum(pos, 0)], 1.0)
+
+    def prices_asof(self, skus, dates):
+        """(dates x skus) case prices in effect on each date (0 for unknown SKUs)"""
+        keys, prices = self._table
+        pos = self.positions(skus)
+        query = np.maximum(pos, 0)[None, :] * self.DAY_SPAN + (day_ordinals(dates)[:, None] - self.BASE_DAY)
+        grid = prices[np.searchsorted(keys, query.ravel(), side='right') - 1].reshape(query.shape)
+        grid[:, pos < 0] = 0.0
+        return grid
+
+    def current_prices(self, skus, as_of=None):
+        """Case prices aligned to `skus` as of a date (default: today)"""
+        as_of = pd.Timestamp.now().normalize() if as_of is None else as_of
+        return self.prices_asof(skus, [as_of])[0]
+
+    def set_price(self, sku, case_price, effective_from, note=""):
+        """Add a price version; it applies from `effective_from` until the next change"""
+        return self.set_prices([{"sku": sku, "case_price": case_price,
+                                 "effective_from": effective_from, "note": note}])[0]
+
+    def set_prices(self, changes):
+        """
+        Add several price versions atomically: every change is validated
+        before any is applied, then all are saved in one write.
+        """
+        parsed = []
+        for i, change in enumerate(changes):
+            label = f"Price change {i + 1}: " if len(changes) > 1 else ""
+            if not isinstance(change, dict):
+                raise ValueError(f"{label}must be an object")
+            missing = [field for field in ("sku", "case_price", "effective_from") if change.get(field) is None]
+            if missing:
+                raise ValueError(f"{label}missing field(s) {', '.join(missing)}")
+            sku = str(change["sku"]).strip()
+            if sku not in self.sku_pos:
+                raise ValueError(f"{label}unknown SKU '{sku}'")
+            try:
+                case_price = float(change["case_price"])
+                effective_from = pd.Timestamp(change["effective_from"]).normalize()
+            except (TypeError, ValueError):
+                raise ValueError(f"{label}invalid case_price or effective_from")
+            if not np.isfinite(case_price) or case_price < 0:
+                raise ValueError(f"{label}case_price must be non-negative")
+            if pd.isna(effective_from):
+                raise ValueError(f"{label}invalid effective_from")
+            parsed.append((sku, case_price, effective_from.strftime("%Y-%m-%d"), change.get("note", "")))
+        if not parsed:
+            raise ValueError("No price changes given")
+
+        with self._lock:
+            created_at = pd.Timestamp.now().isoformat()
+            entries = [{
+                "version": self.version + 1 + i,
+                "sku": sku,
+                "case_price": case_price,
+                "effective_from": effective_from,
+                "note": note,
+                "created_at": created_at
+            } for i, (sku, case_price, effective_from, note) in enumerate(parsed)]
+            self._versions.extend(entries)
+            self._rebuild()
+            if self.path:
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                tmp_path = f"{self.path}.tmp-{os.getpid()}"
+                with open(tmp_path, "w") as f:
+                    json.dump([v for v in self._versions if v["version"] > 0], f, indent=2)
+                os.replace(tmp_path, self.path)
+        for entry in entries:
+            print(f"✓ Price book v{entry['version']}: {entry['sku']} → ₱{entry['case_price']:,.2f} "
+                  f"from {entry['effective_from']}")
+        return entries
+
+    def history(self, sku=None):
+        """Price versions, optionally for one SKU"""
+        return [dict(v) for v in self._versions if sku is None or v["sku"] == sku]
+
+    def catalog(self, as_of=None):
+        """One record per SKU with the case price in effect on `as_of`"""
+        as_of = pd.Timestamp.now().normalize() if as_of is None else pd.Timestamp(as_of).normalize()
+        prices = self.current_prices(self.skus, as_of)
+        as_of_day = day_ordinals([as_of])[0]
+        effective = {}
+        for v in self._versions:
+            day = self.BASE_DAY if v["effective_from"] is None else day_ordinals([v["effective_from"]])[0]
+            if day <= as_of_day:
+                effective[v["sku"]] = max(effective.get(v["sku"], (day, -1)), (day, v["version"]))
+        records = []
+        for sku, qty, price in zip(self.skus, self.case_qty, prices):
+            day = effective[sku][0]
+            records.append({
+                "sku": sku,
+                "case_qty": int(qty),
+                "case_price": float(price),
+                "price_per_unit": float(price) / qty if qty > 0 else 0,
+                "effective_from": None if day == self.BASE_DAY else str(pd.Timestamp(day, unit='D').date()),
+                **SKU_METADATA.get(sku, UNKNOWN_SKU)
+            })
+        return records
+
+
+def day_ordinals(dates):
+    """Dates as int64 days since the Unix epoch"""
+    return pd.DatetimeIndex(pd.to_datetime(dates)).normalize().to_numpy().astype('datetime64[D]').astype(np.int64)
+
+
+# Seeded from CASE_QUANTITIES / CASE_PRICES; later price changes persist here
+PRICE_BOOK_PATH = os.environ.get(
+    "PRICE_BOOK_PATH", os.path.join(os.path.dirname(__file__), "datasets", "price_book.json")
+)
+PRICE_BOOK = PriceBook(CASE_QUANTITIES, CASE_PRICES, PRICE_BOOK_PATH)
+
+
 def parse_num_series(s, index=None):
     """Parse numeric series from various formats"""
     if s is None:
@@ -101,91 +455,60 @@ def parse_num_series(s, index=None):
     )
 
 
+def parse_num_matrix(df):
+    """
+    Parse a block of columns into a 2-D float matrix in one pass.
+    Plain numbers go through pd.to_numeric directly; only the cells that
+    fail (currency symbols, thousands separators) get the regex cleanup.
+    """
+    flat = pd.Series(df.to_numpy(dtype=object).ravel())
+    parsed = pd.to_numeric(flat, errors='coerce')
+    retry = parsed.isna() & flat.notna()
+    if retry.any():
+        parsed[retry] = parse_num_series(flat[retry])
+    return parsed.to_numpy(dtype=float).reshape(df.shape)
+
+
 def detect_date_column(df):
     """Auto-detect date column from DataFrame"""
-    best_col, best_score = None, -1
+    best_col, best_score = None, 0
     for col in df.columns:
         sample = df[col].dropna().astype(str).head(200)
         if sample.empty:
             continue
-        score = pd.to_datetime(sample, errors='coerce').notna().sum()
+        formats, _ = sniff_date_formats(sample)
+        score = parse_dates(sample, formats).notna().sum() if formats else 0
         if score > best_score:
             best_score = score
             best_col = col
     return best_col
 
 
-def detect_format_and_process(df):
+def detect_format_and_process(df, schema=None):
     """
     Detect CSV format and process accordingly
     Handles: Standard format and Wide format (Date-Outlet-SKUs)
     """
     # Clean column names
     df.columns = [str(c).strip() for c in df.columns]
-    col_lower = [c.lower() for c in df.columns]
-    
-    # Check for wide format
-    has_outlet = any('outlet' in c for c in col_lower)
-    has_multiple_cols = len(df.columns) > 5
+
+    # Layout, date column and date format come from the cached schema
+    if schema is None:
+        schema, _ = infer_schema(df)
     
-    if has_outlet and has_multiple_cols:
+    if schema['layout'] == 'wide':
         # Wide format processing
-        return process_wide_format(df)
+        return process_wide_format(df, schema)
     else:
         # Standard format processing
-        return process_standard_format(df)
+        return process_standard_format(df, schema)
 
 
-def process_wide_format(df):
+def find_wide_columns(df):
     """
-    Convert wide format (Date, Outlet, SKU1, SKU2, ...) to (ds, y)
-    Handles PER-CASE sales data
+    Locate the date, outlet and SKU columns of a wide-format frame
+    Returns (date_col, outlet_col, sku_cols); outlet_col may be None
     """
-    print("Processing WIDE format (Date-Outlet-SKUs) - PER CASE")
-    
-    # SKU to case quantity mapping
-    CASE_QUANTITIES = {
-        # Mountain Dew
-        'MD8': 24, 'MD12': 24, 'MD290': 24, 'MD750': 12, 'MD1L': 12, 
-        'MD1.25': 12, 'MD1.5': 12, 'MD1.5/6': 6,
-        # Pepsi
-        'P8': 24, 'P290': 24, 'P750': 12, 'P1L': 12, 
-        'P1.25': 12, 'P1.5': 12, 'P1.5/6': 6,
-        # 7Up
-        'S7': 24, 'SS8': 24, 'SS290': 24, 'SEV290': 24, 
-        'S1.25': 12, 'S1.5': 12,
-        # Gatorade
-        'GBB350': 24, 'GBB500': 24, 'GTF350': 24, 'GR500': 24, 
-        'GO500': 24, 'GB900': 12, 'GBB8': 24, 'GBB237': 24,
-        # Milkis
-        'MILKIS': 30, 'MILKIS500': 20,
-        # Tropicana
-        'TRO8': 24,
-        # Premier Water
-        'PW350': 24, 'PW500': 24, 'PW1L': 12
-    }
-    
-    # Case pricing data (in Philippine Pesos)
-    CASE_PRICES = {
-        # Mountain Dew
-        'MD8': 380, 'MD12': 480, 'MD290': 380, 'MD750': 540, 'MD1L': 650,
-        'MD1.25': 720, 'MD1.5': 840, 'MD1.5/6': 420,
-        # Pepsi
-        'P8': 380, 'P290': 380, 'P750': 540, 'P1L': 650,
-        'P1.25': 720, 'P1.5': 840, 'P1.5/6': 420,
-        # 7Up
-        'S7': 350, 'SS8': 380, 'SS290': 380, 'SEV290': 380,
-        'S1.25': 720, 'S1.5': 840,
-        # Gatorade
-        'GBB350': 780, 'GBB500': 980, 'GTF350': 780, 'GR500': 980,
-        'GO500': 980, 'GB900': 780, 'GBB8': 480, 'GBB237': 550,
-        # Milkis
-        'MILKIS': 900, 'MILKIS500': 1200,
-        # Tropicana
-        'TRO8': 420,
-        # Premier Water
-        'PW350': 130, 'PW500': 150, 'PW1L': 170
-    }
     # Find date column
     date_col = None
     for col in df.columns:
@@ -212,100 +535,446 @@ def process_wide_format(df):
         non_sku_cols.append(outlet_col)
     
     sku_cols = [col for col in df.columns if col not in non_sku_cols]
+    return date_col, outlet_col, sku_cols
+
+
+def case_vectors(sku_cols):
+    """Case quantity and current case price arrays aligned to the given SKU columns"""
+    return PRICE_BOOK.case_quantities(sku_cols), PRICE_BOOK.current_prices(sku_cols)
+
+
+def process_wide_format(df, schema=None):
+    """
+    Convert wide format (Date, Outlet, SKU1, SKU2, ...) to (ds, y)
+    Handles PER-CASE sales data
+    """
+    print("Processing WIDE format (Date-Outlet-SKUs) - PER CASE")
     
-    # Parse date
-    df[date_col] = pd.to_datetime(df[date_col], errors='coerce')
-    df = df.dropna(subset=[date_col])
-    
+    if schema is None:
+        schema, _ = infer_schema(df)
+    compact = build_compact_dataset(df, schema)
+    result = compact_daily(compact)
+
+    print(f"✓ Converted wide format: {len(result)} daily observations")
+    print(f"✓ Total units (all SKUs combined): {result['y'].sum():,.0f}")
+    print(f"✓ Total revenue: ₱{result['revenue'].sum():,.2f}")
+    return result
+
+
+def smallest_int_dtype(values):
+    """Smallest signed integer dtype that holds every value"""
+    if values.size == 0:
+        return np.int8
+    lo, hi = values.min(), values.max()
+    for dtype in (np.int8, np.int16, np.int32):
+        info = np.iinfo(dtype)
+        if info.min <= lo and hi <= info.max:
+            return dtype
+    return np.int64
+
+
+def build_compact_dataset(df, schema):
+    """
+    Compact wide-format representation used by the aggregation paths:
+    - cases: outlet-day x SKU case counts as a CSR matrix (small int dtype)
+    - outlet_codes: categorical codes into `outlets` (-1 = missing outlet)
+    - days: int32 day offsets from `date0`
+    Rows without a valid date are dropped.
+    """
+    date_col = schema['date_column']
+    outlet_col = schema['outlet_column']
+    sku_cols = [sku['name'] for sku in schema['sku_columns']]
+
+    # Parse date with the sniffed explicit format(s)
+    dates = schema_dates(df[date_col], schema)
+    valid = dates.notna().to_numpy()
+    dates = dates[valid].dt.normalize()
+
     # Convert cases to units and calculate revenue
     print(f"Converting {len(sku_cols)} SKU columns from cases to units and revenue...")
 
-    # Initialize columns with proper numeric types
-    df['total_units'] = 0.0
-    df['total_revenue'] = 0.0
+    # One numeric parse of the whole SKU block -> (rows x SKUs) case matrix
+    dense = np.nan_to_num(parse_num_matrix(df.loc[valid, sku_cols]), nan=0.0)
+    if np.array_equal(dense, np.round(dense)):
+        dense = dense.astype(smallest_int_dtype(dense))
+    else:
+        dense = dense.astype(np.float32)
+    cases = sparse.csr_matrix(dense)
+    del dense
+
+    if outlet_col is not None:
+        codes, outlets = pd.factorize(df.loc[valid, outlet_col])
+        outlets = [str(o) for o in outlets]
+    else:
+        codes, outlets = np.full(int(valid.sum()), -1), []
+    codes = codes.astype(np.int16 if len(outlets) < np.iinfo(np.int16).max else np.int32)
 
-    for col in sku_cols:
-        cases = parse_num_series(df[col])
-        
-        # Get case quantity and price for this SKU
-        case_qty = CASE_QUANTITIES.get(col.strip(), 1)
-        case_price = CASE_PRICES.get(col.strip(), 0)
-        
-        # Convert cases to units - ensure numeric
-        units = cases.fillna(0) * case_qty
-        df[f'{col}_units'] = units.astype(float)
-        
-        # Calculate revenue (cases × case price) - ensure numeric
-        revenue = cases.fillna(0) * case_price
-        df[f'{col}_revenue'] = revenue.astype(float)
-        
-        # Add to totals - use .add() to avoid type errors
-        df['total_units'] = df['total_units'].add(units, fill_value=0)
-        df['total_revenue'] = df['total_revenue'].add(revenue, fill_value=0)
-        
-        if cases.sum() > 0:
-            print(f"  ✓ {col}: {cases.sum():.0f} cases × {case_qty} units = {units.sum():.0f} units | Revenue: ₱{revenue.sum():,.2f}")
+    date0 = dates.min() if len(dates) else pd.Timestamp(0)
+    days = ((dates - date0).dt.days).to_numpy(dtype=np.int32)
+
+    # Units per case aligned to the column order (prices come from the price book)
+    case_qty = PRICE_BOOK.case_quantities(sku_cols)
+
+    return {
+        "cases": cases,
+        "outlet_codes": codes,
+        "outlets": outlets,
+        "days": days,
+        "date0": date0,
+        "skus": sku_cols,
+        "case_qty": case_qty,
+        "date_format": schema['date_format'] or '%Y-%m-%d',
+        "rows_dropped": int((~valid).sum())
+    }
+
+
+def compact_nbytes(compact, cube=None):
+    """Memory footprint of a compact dataset (and its aggregate cube), per component"""
+    cases = compact["cases"]
+    footprint = {
+        "cases_data": int(cases.data.nbytes),
+        "cases_indices": int(cases.indices.nbytes + cases.indptr.nbytes),
+        "outlet_codes": int(compact["outlet_codes"].nbytes),
+        "days": int(compact["days"].nbytes),
+        "outlet_names": int(sum(len(o) for o in compact["outlets"]))
+    }
+    footprint["total"] = sum(footprint.values())
+    footprint["dense_float64_equivalent"] = int(cases.shape[0] * cases.shape[1] * 8)
+    footprint["nnz"] = int(cases.nnz)
+    footprint["density"] = round(cases.nnz / max(1, cases.shape[0] * cases.shape[1]), 4)
+    if cube is not None:
+        footprint["cube"] = cube_nbytes(cube)
+    return footprint
+
+
+def compact_dates(compact, days):
+    """Timestamps for day offsets of a compact dataset"""
+    return compact["date0"] + pd.to_timedelta(np.asarray(days, dtype=np.int64), unit='D')
 
-    # Ensure totals are numeric
-    df['total_units'] = pd.to_numeric(df['total_units'], errors='coerce').fillna(0)
-    df['total_revenue'] = pd.to_numeric(df['total_revenue'], errors='coerce').fillna(0)
+
+def priced_cells(cases, row_days, compact):
+    """
+    As-of revenue of every nonzero cell of a case matrix: each cell is priced
+    at its SKU's case price in effect on its row's day (one price book join
+    over the distinct days). Returns (revenue per nonzero, row per nonzero).
+    """
+    day_index, day_pos = np.unique(row_days, return_inverse=True)
+    prices = PRICE_BOOK.prices_asof(compact["skus"], compact_dates(compact, day_index))
+    nz_rows = np.repeat(np.arange(cases.shape[0]), np.diff(cases.indptr))
+    return cases.data * prices[day_pos[nz_rows], cases.indices], nz_rows
+
+
+def compact_daily(compact):
+    """Daily (ds, y, revenue) series straight from the sparse case matrix"""
+    cases = compact["cases"]
+    cell_revenue, nz_rows = priced_cells(cases, compact["days"], compact)
+    sku_cases = np.asarray(cases.sum(axis=0), dtype=float).ravel()
+    sku_revenue = np.bincount(cases.indices, weights=cell_revenue, minlength=cases.shape[1])
+    for col, n_cases, qty, rev in zip(compact["skus"], sku_cases, compact["case_qty"], sku_revenue):
+        if n_cases > 0:
+            print(f"  ✓ {col}: {n_cases:.0f} cases × {qty:.0f} units = {n_cases * qty:.0f} units | Revenue: ₱{rev:,.2f}")
+
+    # Units per row as a sparse matrix-vector product, revenue priced as of each day
+    units = cases @ compact["case_qty"]
+    revenue = np.bincount(nz_rows, weights=cell_revenue, minlength=cases.shape[0])
 
     print(f"\n{'='*60}")
     print(f"CONVERSION SUMMARY")
     print(f"{'='*60}")
+    print(f"Total Cases Processed: {sku_cases.sum():,.0f}")
+    print(f"Total Units: {units.sum():,.0f}")
+    print(f"Total Revenue: ₱{revenue.sum():,.2f}")
+    print(f"{'='*60}\n")
 
-    # Calculate total cases processed safely
-    total_cases = 0
-    for col in sku_cols:
-        col_cases = parse_num_series(df[col]).sum()
-        total_cases += col_cases
+    # Group by day offset - only days that appear in the data
+    day_index, inverse = np.unique(compact["days"], return_inverse=True)
+    return pd.DataFrame({
+        'ds': compact_dates(compact, day_index),
+        'y': np.bincount(inverse, weights=units, minlength=len(day_index)),
+        'revenue': np.bincount(inverse, weights=revenue, minlength=len(day_index))
+    })
 
-    print(f"Total Cases Processed: {total_cases:,.0f}")
-    print(f"Total Units: {df['total_units'].sum():,.0f}")
-    print(f"Total Revenue: ₱{df['total_revenue'].sum():,.2f}")
-    print(f"{'='*60}\n")
-    
-    # Group by date - now with both units and revenue
-    result = df.groupby(date_col).agg({
-        'total_units': 'sum',
-        'total_revenue': 'sum'
-    }).reset_index()
-    result.columns = ['ds', 'y', 'revenue']
 
-    print(f"✓ Converted wide format: {len(result)} daily observations")
-    print(f"✓ Total units (all SKUs combined): {result['y'].sum():,.0f}")
-    print(f"✓ Total revenue: ₱{result['revenue'].sum():,.2f}")
-    return result
+def compact_row_cases(compact):
+    """Total cases per outlet-day row"""
+    return np.asarray(compact["cases"].sum(axis=1), dtype=float).ravel()
+
+
+def compact_outlet_totals(compact, values):
+    """Sum a per-row array by outlet -> Series indexed by outlet name"""
+    codes = compact["outlet_codes"]
+    keep = codes >= 0
+    totals = np.bincount(codes[keep], weights=values[keep], minlength=len(compact["outlets"]))
+    return pd.Series(totals, index=compact["outlets"])
+
+
+def daily_rollups(daily):
+    """Monthly, weekly and yearly sums of a daily series, keyed by period label"""
+    values = daily[[c for c in ('y', 'revenue') if c in daily.columns]]
+    return {
+        "monthly": values.groupby(daily['ds'].dt.to_period('M').astype(str)).sum(),
+        "weekly": values.groupby(daily['ds'].dt.to_period('W').astype(str)).sum(),
+        "yearly": values.groupby(daily['ds'].dt.year).sum()
+    }
+
+
+def daily_calendar(daily):
+    """Daily series with the calendar attributes /sales-query filters on"""
+    dates = pd.to_datetime(daily['ds'])
+    return pd.DataFrame({
+        'date': dates,
+        'y': daily['y'].to_numpy(),
+        'year': dates.dt.year.to_numpy(),
+        'month': dates.dt.month.to_numpy(),
+        'week': dates.dt.isocalendar().week.to_numpy(dtype=np.int64),
+        'day_of_week': dates.dt.day_name().to_numpy()
+    })
+
+
+# SKU_METADATA fields the cube rolls SKUs up to
+SKU_DIMENSIONS = {"brand": "brand", "size": "size", "category": "category"}
+
+
+def sku_dimension_rollups(skus, sku_cases, case_qty, sku_revenue):
+    """
+    Brand, bottle size and category totals (cases, units, revenue) over the
+    SKUs that sold, in order of first appearance
+    """
+    sold = sku_cases > 0
+    totals = pd.DataFrame({
+        'cases': sku_cases[sold],
+        'units': (sku_cases * case_qty)[sold],
+        'revenue': sku_revenue[sold]
+    })
+    meta = [SKU_METADATA.get(sku.strip(), UNKNOWN_SKU) for sku, s in zip(skus, sold) if s]
+    return {
+        dim: totals.groupby(np.array([m[field] for m in meta], dtype=object), sort=False).sum()
+        for dim, field in SKU_DIMENSIONS.items()
+    }
+
+
+def indicator_matrix(groups, n_groups):
+    """Sparse (groups x items) 0/1 matrix that sums items into their group"""
+    return sparse.csr_matrix(
+        (np.ones(len(groups)), (groups, np.arange(len(groups)))), shape=(n_groups, len(groups))
+    )
 
 
-def process_standard_format(df):
+def build_cube(compact):
+    """
+    Date x outlet x SKU case cube of a compact dataset, with rollups:
+    - day_outlet_sku: CSR, one row per (day, outlet) pair sorted by day then
+      outlet (pair_days / pair_outlets; -1 = missing outlet)
+    - day_sku: dense day x SKU cases, rows follow day_index
+    - period_sku: weekly / monthly / yearly x SKU cases
+    - outlet_sku: dense outlet x SKU cases
+    """
+    cases = compact["cases"]
+    n_outlets = len(compact["outlets"])
+    codes = compact["outlet_codes"].astype(np.int64)
+    slots = np.where(codes >= 0, codes, n_outlets)
+
+    # Collapse repeated outlet-day rows into one cube cell row
+    pair_keys, inverse = np.unique(compact["days"].astype(np.int64) * (n_outlets + 1) + slots, return_inverse=True)
+    day_outlet_sku = (indicator_matrix(inverse, len(pair_keys)) @ cases).tocsr()
+    pair_days = (pair_keys // (n_outlets + 1)).astype(np.int32)
+    pair_outlets = (pair_keys % (n_outlets + 1)).astype(np.int32)
+    pair_outlets[pair_outlets == n_outlets] = -1
+
+    day_index, day_inverse = np.unique(pair_days, return_inverse=True)
+    day_sku = (indicator_matrix(day_inverse, len(day_index)) @ day_outlet_sku).toarray()
+    keep = pair_outlets >= 0
+    outlet_sku = (indicator_matrix(pair_outlets[keep], n_outlets) @ day_outlet_sku[keep]).toarray()
+
+    cube = {
+        "day_outlet_sku": day_outlet_sku,
+        "pair_days": pair_days,
+        "pair_outlets": pair_outlets,
+        "day_index": day_index.astype(np.int32),
+        "day_sku": day_sku,
+        "outlet_sku": outlet_sku
+    }
+    cube["period_sku"] = cube_period_rollups(compact, cube["day_index"], day_sku)
+    return cube
+
+
+def cube_period_rollups(compact, day_index, day_sku):
+    """Week, month and year x SKU case totals from the day x SKU slice"""
+    dates = compact_dates(compact, day_index)
+    frame = pd.DataFrame(day_sku, columns=compact["skus"])
+    return {
+        "weekly": frame.groupby(dates.to_period('W').astype(str)).sum(),
+        "monthly": frame.groupby(dates.to_period('M').astype(str)).sum(),
+        "yearly": frame.groupby(dates.year).sum()
+    }
+
+
+def merge_cubes(base, delta):
+    """Append a delta cube whose days all come after the base cube's days"""
+    outlet_sku = np.zeros_like(delta["outlet_sku"])
+    outlet_sku[:base["outlet_sku"].shape[0]] = base["outlet_sku"]
+    return {
+        "day_outlet_sku": sparse.vstack([base["day_outlet_sku"], delta["day_outlet_sku"]], format="csr"),
+        "pair_days": np.concatenate([base["pair_days"], delta["pair_days"]]),
+        "pair_outlets": np.concatenate([base["pair_outlets"], delta["pair_outlets"]]),
+        "day_index": np.concatenate([base["day_index"], delta["day_index"]]),
+        "day_sku": np.vstack([base["day_sku"], delta["day_sku"]]),
+        "outlet_sku": outlet_sku + delta["outlet_sku"],
+        "period_sku": {
+            key: base["period_sku"][key].add(delta["period_sku"][key], fill_value=0)
+            for key in ("weekly", "monthly", "yearly")
+        }
+    }
+
+
+def cube_nbytes(cube):
+    """Memory held by a cube's arrays"""
+    cells = cube["day_outlet_sku"]
+    total = cells.data.nbytes + cells.indices.nbytes + cells.indptr.nbytes
+    total += sum(cube[key].nbytes for key in ("pair_days", "pair_outlets", "day_index", "day_sku", "outlet_sku"))
+    total += sum(int(frame.memory_usage(deep=True).sum()) for frame in cube["period_sku"].values())
+    return int(total)
+
+
+def cube_revenue(compact, cube):
+    """As-of priced revenue of the cube per day, SKU and outlet"""
+    cells = cube["day_outlet_sku"]
+    cell_revenue, nz_rows = priced_cells(cells, cube["pair_days"], compact)
+    pair_revenue = np.bincount(nz_rows, weights=cell_revenue, minlength=cells.shape[0])
+    day_pos = np.searchsorted(cube["day_index"], cube["pair_days"])
+    keep = cube["pair_outlets"] >= 0
+    return {
+        "day_revenue": np.bincount(day_pos, weights=pair_revenue, minlength=len(cube["day_index"])),
+        "sku_revenue": np.bincount(cells.indices, weights=cell_revenue, minlength=cells.shape[1]),
+        "outlet_revenue": np.bincount(cube["pair_outlets"][keep], weights=pair_revenue[keep],
+                                      minlength=len(compact["outlets"]))
+    }
+
+
+def build_aggregates(compact, daily):
+    """
+    Aggregates built once at ingest so endpoints slice instead of regrouping
+    rows: monthly/weekly/yearly rollups and a calendar of the daily series,
+    plus for compact datasets the date x outlet x SKU cube, per-outlet and
+    per-SKU totals and the brand/size/category rollups
+    """
+    aggregates = daily_rollups(daily)
+    aggregates["calendar"] = daily_calendar(daily)
+    aggregates["last_ds"] = daily['ds'].max() if not daily.empty else None
+    if compact is not None:
+        codes = compact["outlet_codes"]
+        keep = codes >= 0
+        n_outlets = len(compact["outlets"])
+        cube = build_cube(compact)
+        revenue = cube_revenue(compact, cube)
+        sku_cases = cube["day_sku"].sum(axis=0)
+        aggregates.update({
+            "cube": cube,
+            "outlet_cases": cube["outlet_sku"].sum(axis=1),
+            "outlet_units": cube["outlet_sku"] @ compact["case_qty"],
+            "outlet_revenue": revenue["outlet_revenue"],
+            "outlet_orders": np.bincount(codes[keep], minlength=n_outlets),
+            "sku_cases": sku_cases,
+            "sku_revenue": revenue["sku_revenue"],
+            "dimensions": sku_dimension_rollups(compact["skus"], sku_cases, compact["case_qty"], revenue["sku_revenue"])
+        })
+    aggregates["price_fingerprint"] = PRICE_BOOK.fingerprint
+    return aggregates
+
+
+def merge_aggregates(base, delta, compact):
+    """Fold the aggregates of appended rows into a dataset's aggregates"""
+    merged = {key: base[key].add(delta[key], fill_value=0) for key in ("monthly", "weekly", "yearly")}
+    merged["calendar"] = pd.concat([base["calendar"], delta["calendar"]], ignore_index=True)
+    merged["last_ds"] = max(d for d in (base["last_ds"], delta["last_ds"]) if d is not None)
+    merged["cube"] = merge_cubes(base["cube"], delta["cube"])
+    for key in ("outlet_cases", "outlet_units", "outlet_revenue", "outlet_orders"):
+        # New outlets were given codes after the existing ones
+        total = np.zeros(len(delta[key]), dtype=np.result_type(base[key], delta[key]))
+        total[:len(base[key])] = base[key]
+        merged[key] = total + delta[key]
+    merged["sku_cases"] = base["sku_cases"] + delta["sku_cases"]
+    merged["sku_revenue"] = base["sku_revenue"] + delta["sku_revenue"]
+    merged["dimensions"] = sku_dimension_rollups(
+        compact["skus"], merged["sku_cases"], compact["case_qty"], merged["sku_revenue"]
+    )
+    merged["price_fingerprint"] = delta["price_fingerprint"]
+    return merged
+
+
+def forecast_unit_prices(dataset, dates, window_days=90):
+    """
+    Expected revenue per unit on future dates: the SKU unit mix of the last
+    `window_days` priced with the case prices in effect on each date, so
+    scheduled price changes carry into revenue forecasts. None when the
+    dataset has no SKU breakdown.
+    """
+    compact = dataset.get("compact")
+    if compact is None or not len(dates):
+        return None
+    cube = dataset["aggregates"]["cube"]
+    recent = cube["day_index"] > cube["day_index"][-1] - window_days
+    units = cube["day_sku"][recent].sum(axis=0) * compact["case_qty"]
+    if units.sum() <= 0:
+        return None
+    prices = PRICE_BOOK.prices_asof(compact["skus"], dates)
+    return (prices / compact["case_qty"]) @ (units / units.sum())
+
+
+def reprice_dataset(dataset):
+    """
+    Re-apply the price book to a compact dataset after a price change: daily
+    revenue, its rollups and the SKU/outlet/dimension revenue are rebuilt
+    from the cube with one as-of join, without touching the upload
+    """
+    aggregates = dataset.get("aggregates")
+    compact = dataset.get("compact")
+    if compact is None or aggregates is None or aggregates.get("price_fingerprint") == PRICE_BOOK.fingerprint:
+        return dataset
+
+    start = time.perf_counter()
+    revenue = cube_revenue(compact, aggregates["cube"])
+    daily = dataset["daily"].assign(revenue=revenue["day_revenue"])
+    dataset["aggregates"] = {
+        **aggregates,
+        **daily_rollups(daily),
+        "outlet_revenue": revenue["outlet_revenue"],
+        "sku_revenue": revenue["sku_revenue"],
+        "dimensions": sku_dimension_rollups(
+            compact["skus"], aggregates["sku_cases"], compact["case_qty"], revenue["sku_revenue"]
+        ),
+        "price_fingerprint": PRICE_BOOK.fingerprint
+    }
+    dataset["daily"] = daily
+    print(f"✓ Repriced dataset {dataset['dataset_id']} with price book v{PRICE_BOOK.version} "
+          f"in {(time.perf_counter() - start) * 1000:.1f} ms")
+    return dataset
+
+
+def outlet_totals_series(dataset, key="outlet_cases"):
+    """Per-outlet aggregate as a Series indexed by outlet name"""
+    return pd.Series(dataset["aggregates"][key], index=dataset_compact(dataset)["outlets"])
+
+
+def process_standard_format(df, schema=None):
     """
     Process standard format (Date, SKU/Value columns)
     """
     print("Processing STANDARD format (assuming per-unit data)")
     
+    if schema is None:
+        schema, _ = infer_schema(df)
+    
     # Normalize column names
     df.columns = [c.lower().strip() for c in df.columns]
-    
-    # Find date column
-    date_col = None
-    for cand in ["date", "ds", "datetime", "day", "timestamp"]:
-        if cand in df.columns:
-            date_col = cand
-            break
-    
-    if date_col is None:
-        date_col = detect_date_column(df)
-    
-    if date_col is None:
-        raise ValueError("No date column found")
+    date_col = schema['date_column'].lower().strip()
     
     # Rename to 'ds'
     if date_col != 'ds':
         df.rename(columns={date_col: 'ds'}, inplace=True)
     
     # Parse dates
-    df['ds'] = pd.to_datetime(df['ds'], errors='coerce')
+    df['ds'] = schema_dates(df['ds'], schema)
     df = df.dropna(subset=['ds'])
     
     # Find value columns
@@ -338,35 +1007,151 @@ def process_standard_format(df):
     return result
 
 
+# Forecast accuracy metrics. Everything reduces to additive sufficient
+# statistics (counts and sums) of per-pair terms, so a long backtest table
+# gets metrics per horizon step, per series and per cutoff with one bincount
+# per statistic, and statistics from separate batches can simply be added
+# together.
+METRIC_NAMES = ['mae', 'rmse', 'mape', 'r2', 'accuracy', 'bias']
+METRIC_DECIMALS = {'mae': 2, 'rmse': 2, 'mape': 2, 'r2': 4, 'accuracy': 2, 'bias': 2}
+
+
+def metric_terms(y_true, y_pred):
+    """Per-pair terms of the sufficient statistics; zero where either side is NaN"""
+    y_true = np.asarray(y_true, dtype=float)
+    y_pred = np.asarray(y_pred, dtype=float)
+    mask = ~(np.isnan(y_true) | np.isnan(y_pred))
+    actual = np.where(mask, y_true, 0.0)
+    error = np.where(mask, y_pred - y_true, 0.0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ape = np.abs(error / actual)
+    ape_ok = mask & np.isfinite(ape)
+    return {
+        "n": mask,
+        "sum_y": actual,
+        "sum_y2": actual * actual,
+        "sum_err": error,
+        "sum_abs": np.abs(error),
+        "sum_sq": error * error,
+        "sum_ape": np.where(ape_ok, ape, 0.0),
+        "n_ape": ape_ok
+    }
+
+
+def metric_stats(y_true, y_pred, axis=None):
+    """Sufficient statistics over `axis`; pairs with a NaN on either side are skipped"""
+    return {name: term.sum(axis=axis) for name, term in metric_terms(y_true, y_pred).items()}
+
+
+def metric_stats_by(y_true, y_pred, groups, size):
+    """Sufficient statistics per group code in [0, size) of 1-D pairs, one bincount each"""
+    return {name: np.bincount(groups, weights=term, minlength=size)
+            for name, term in metric_terms(y_true, y_pred).items()}
+
+
+def metrics_from_stats(stats):
+    """MAE, RMSE, MAPE, R², accuracy and bias (arrays) from metric_stats()"""
+    n = np.asarray(stats["n"], dtype=float)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mae = stats["sum_abs"] / n
+        rmse = np.sqrt(stats["sum_sq"] / n)
+        mape = stats["sum_ape"] / stats["n_ape"] * 100
+        ss_tot = stats["sum_y2"] - stats["sum_y"] ** 2 / n
+        r2 = np.where(ss_tot > 0, 1 - stats["sum_sq"] / ss_tot, np.where(stats["sum_sq"] == 0, 1.0, 0.0))
+        bias = stats["sum_err"] / stats["sum_y"] * 100
+    accuracy = np.where(np.isnan(mape), 0.0, np.maximum(0.0, 100 - mape))
+    empty = n == 0
+    metrics = {'mae': mae, 'rmse': rmse, 'mape': mape, 'r2': r2, 'accuracy': accuracy, 'bias': bias}
+    return {name: np.where(empty, 0.0, values) for name, values in metrics.items()}
+
+
+def metric_columns(metrics):
+    """Metric arrays as rounded JSON lists (NaN/inf -> None)"""
+    return {
+        name: [round(float(v), METRIC_DECIMALS[name]) if np.isfinite(v) else None
+               for v in np.atleast_1d(metrics[name])]
+        for name in METRIC_NAMES
+    }
+
+
 def calculate_metrics(y_true, y_pred):
     """
     Calculate comprehensive evaluation metrics
     """
-    mask = ~(np.isnan(y_true) | np.isnan(y_pred))
-    y_true_clean = np.array(y_true)[mask]
-    y_pred_clean = np.array(y_pred)[mask]
-    
-    if len(y_true_clean) == 0:
-        return {'mae': 0, 'rmse': 0, 'mape': 0, 'r2': 0, 'accuracy': 0, 'bias': 0}
-    
-    mae = mean_absolute_error(y_true_clean, y_pred_clean)
-    rmse = np.sqrt(mean_squared_error(y_true_clean, y_pred_clean))
-    
-    mape_values = np.abs((y_true_clean - y_pred_clean) / y_true_clean)
-    mape = np.mean(mape_values[np.isfinite(mape_values)]) * 100
-    
-    r2 = r2_score(y_true_clean, y_pred_clean)
-    accuracy = max(0, 100 - mape)
-    bias = np.mean(y_pred_clean - y_true_clean) / np.mean(y_true_clean) * 100
-    
+    metrics = metrics_from_stats(metric_stats(y_true, y_pred))
+    return {name: round(float(metrics[name]), METRIC_DECIMALS[name]) for name in METRIC_NAMES}
+
+
+def backtest_table(df_cv, series_col=None):
+    """
+    Long backtest table (cutoff, ds, y, yhat[, series]) as coded columns:
+    cutoff, 0-based horizon step and series codes with y / yhat, plus the
+    cutoff and series labels and the horizon. Rows are kept long (no dense
+    cutoff x step x series cube), so ragged backtests cost O(rows).
+    Duplicate (cutoff, ds, series) rows are rejected.
+    """
+    steps = ((pd.to_datetime(df_cv['ds']) - pd.to_datetime(df_cv['cutoff'])).dt.days - 1).to_numpy()
+    if len(steps) and steps.min() < 0:
+        raise ValueError("Backtest rows must fall after their cutoff")
+    cutoff_codes, cutoffs = pd.factorize(pd.to_datetime(df_cv['cutoff']), sort=True)
+    if series_col:
+        series_codes, series = pd.factorize(df_cv[series_col], sort=True)
+    else:
+        series_codes, series = np.zeros(len(df_cv), dtype=np.int64), pd.Index(["total"])
+    horizon = int(steps.max()) + 1 if len(steps) else 0
+
+    keys = (cutoff_codes.astype(np.int64) * horizon + steps) * len(series) + series_codes
+    duplicated = pd.Series(keys).duplicated().to_numpy()
+    if duplicated.any():
+        row = int(np.argmax(duplicated))
+        raise ValueError(
+            f"{int(duplicated.sum())} duplicate backtest rows for the same cutoff, ds and series "
+            f"(first: cutoff {cutoffs[cutoff_codes[row]]:%Y-%m-%d}, step {int(steps[row]) + 1}"
+            + (f", series {series[series_codes[row]]}" if series_col else "") + "). Send one row per combination."
+        )
     return {
-        'mae': round(float(mae), 2),
-        'rmse': round(float(rmse), 2),
-        'mape': round(float(mape), 2),
-        'r2': round(float(r2), 4),
-        'accuracy': round(float(accuracy), 2),
-        'bias': round(float(bias), 2)
+        "cutoff": cutoff_codes,
+        "step": steps,
+        "series": series_codes,
+        "y": df_cv['y'].to_numpy(dtype=float),
+        "yhat": df_cv['yhat'].to_numpy(dtype=float),
+        "cutoffs": cutoffs,
+        "series_names": series,
+        "horizon": horizon
+    }
+
+
+def backtest_report(table, bucket_days=7):
+    """
+    Metrics of a backtest_table(): overall, per horizon step (day 1..H), per
+    `bucket_days` block of steps, per series and per cutoff
+    """
+    y, yhat = table["y"], table["yhat"]
+    horizon, cutoffs, series = table["horizon"], table["cutoffs"], table["series_names"]
+    by_step = metric_stats_by(y, yhat, table["step"], horizon)
+    starts = np.arange(0, horizon, bucket_days)
+    by_bucket = {k: np.add.reduceat(v, starts) for k, v in by_step.items()} if horizon else by_step
+    overall = {k: v.sum() for k, v in by_step.items()}
+
+    report = {
+        "pairs": int(overall["n"]),
+        "overall": {name: values[0] for name, values in metric_columns(metrics_from_stats(overall)).items()},
+        "by_horizon": {"step": list(range(1, horizon + 1)), **metric_columns(metrics_from_stats(by_step))},
+        "by_horizon_bucket": {
+            "steps": [f"{start + 1}-{min(start + bucket_days, horizon)}" for start in starts],
+            **metric_columns(metrics_from_stats(by_bucket))
+        }
+    }
+    if len(series) > 1:
+        report["by_series"] = {
+            "series": [str(name) for name in series],
+            **metric_columns(metrics_from_stats(metric_stats_by(y, yhat, table["series"], len(series))))
+        }
+    report["by_cutoff"] = {
+        "cutoff": [pd.Timestamp(c).strftime("%Y-%m-%d") for c in cutoffs],
+        **metric_columns(metrics_from_stats(metric_stats_by(y, yhat, table["cutoff"], len(cutoffs))))
     }
+    return report
 
 
 def get_optimized_prophet_params(df, target_col='y'):
@@ -425,9 +1210,13 @@ def get_optimized_prophet_params(df, target_col='y'):
     return params
 
 
-def evaluate_model_performance(prophet_df, model, forecast_result):
+def evaluate_model_performance(prophet_df, model, forecast_result, params=None, seasonalities=None,
+                               baseline_cv=None, cancel=None):
     """
-    Comprehensive model evaluation with multiple metrics
+    Comprehensive model evaluation with multiple metrics.
+    With `params` the cross-validation uses the cached, parallel folds;
+    `baseline_cv` supplies ready backtest folds for a baseline model.
+    `cancel` stops a forecast job between CV folds.
     """
     print(f"\n{'='*60}")
     print("MODEL PERFORMANCE EVALUATION")
@@ -476,13 +1265,21 @@ def evaluate_model_performance(prophet_df, model, forecast_result):
         if len(prophet_df) >= 90:
             try:
                 print("\nPerforming cross-validation...")
-                df_cv = cross_validation(
-                    model,
-                    initial='60 days',
-                    period='15 days',
-                    horizon='30 days',
-                    parallel=None
-                )
+                cv_run = None
+                if baseline_cv is not None:
+                    df_cv = baseline_cv
+                elif params is not None:
+                    df_cv, cv_run = cross_validate_cached(
+                        prophet_df, params, seasonalities or FORECAST_SEASONALITIES, cancel=cancel
+                    )
+                else:
+                    df_cv = cross_validation(
+                        model,
+                        initial=f'{CV_INITIAL_DAYS} days',
+                        period=f'{CV_PERIOD_DAYS} days',
+                        horizon=f'{CV_HORIZON_DAYS} days',
+                        parallel=None
+                    )
                 
                 cv_metrics = calculate_metrics(df_cv['y'].values, df_cv['yhat'].values)
                 
@@ -506,10 +1303,25 @@ def evaluate_model_performance(prophet_df, model, forecast_result):
                 print(f"{'='*60}\n")
                 
                 evaluation_results['cross_validation'] = cv_metrics
+
+                # How accuracy degrades over the horizon
+                horizon_report = backtest_report(backtest_table(df_cv))
+                evaluation_results['cross_validation_by_horizon'] = {
+                    "by_horizon": horizon_report["by_horizon"],
+                    "by_horizon_bucket": horizon_report["by_horizon_bucket"]
+                }
+                buckets = horizon_report["by_horizon_bucket"]
+                print("\nACCURACY BY HORIZON:")
+                for steps, accuracy in zip(buckets["steps"], buckets["accuracy"]):
+                    print(f"  Days {steps:<6} {accuracy:>10.2f}%")
                 evaluation_results['overfitting_check'] = {
                     'accuracy_drop': round(float(accuracy_drop), 2),
                     'status': 'good' if accuracy_drop < 5 else 'warning' if accuracy_drop < 10 else 'poor'
                 }
+                if cv_run is not None:
+                    evaluation_results['cross_validation_run'] = cv_run
+            except ForecastJobCancelled:
+                raise
             except Exception as e:
                 print(f"  Cross-validation skipped: {e}")
         else:
@@ -528,192 +1340,3564 @@ def format_mdy(ts):
         return None
 
 
-@app.route("/forecast", methods=["POST"])
-def forecast():
+class LRUCache:
     """
-    Enhanced forecast endpoint with automatic model evaluation and optimization
+    Thread-safe LRU cache bounded by an approximate memory budget (bytes).
+    Tracks hits, misses and evictions so the cache can be monitored.
     """
-    try:
-        if "file" not in request.files:
-            return jsonify({"error": "No file uploaded"}), 400
 
-        file = request.files["file"]
-        forecast_days = int(request.form.get("days", 30))
-        forecast_days = max(30, min(forecast_days, 730))
-        
-        # Load and clean data
-        df = pd.read_csv(file, dtype=str, keep_default_na=False, na_values=[''])
-        
-        # Remove duplicate header rows
-        if df.shape[1] >= 2:
-            second_col = df.columns[1]
-            mask_header = (df[second_col].astype(str).str.strip().str.upper() == "OUTLET") | \
-                         (df.iloc[:, 0].astype(str).str.strip().str.upper() == "DATE")
-            df = df.loc[~mask_header].reset_index(drop=True)
-
-        # Detect format and process
-        prophet_df = detect_format_and_process(df)
-        
-        if prophet_df.empty:
-            return jsonify({"error": "No valid data after cleaning"}), 400
+    def __init__(self, name, max_bytes):
+        self.name = name
+        self.max_bytes = max_bytes
+        self._items = OrderedDict()
+        self._sizes = {}
+        self._lock = threading.Lock()
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        with self._lock:
+            if key in self._items:
+                self._items.move_to_end(key)
+                self.hits += 1
+                return self._items[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, value, nbytes=0):
+        with self._lock:
+            if key in self._items:
+                self.current_bytes -= self._sizes.pop(key)
+                del self._items[key]
+            self._items[key] = value
+            self._sizes[key] = int(nbytes)
+            self.current_bytes += int(nbytes)
+
+            # Always keep the newest entry, even if it alone exceeds the budget
+            while self.current_bytes > self.max_bytes and len(self._items) > 1:
+                old_key, _ = self._items.popitem(last=False)
+                self.current_bytes -= self._sizes.pop(old_key)
+                self.evictions += 1
+                print(f"  ↺ {self.name}: evicted {old_key}")
+
+    def pop(self, key):
+        with self._lock:
+            if key not in self._items:
+                return None
+            self.current_bytes -= self._sizes.pop(key)
+            return self._items.pop(key)
+
+    def items(self):
+        with self._lock:
+            return list(self._items.items())
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._items
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._items),
+                "memory_bytes": self.current_bytes,
+                "memory_budget_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0
+            }
 
-        # Remove duplicates and sort
-        prophet_df = prophet_df.drop_duplicates(subset=['ds'], keep='first')
-        prophet_df = prophet_df.sort_values('ds').reset_index(drop=True)
-        
-        # Data quality checks
-        print(f"\n{'='*60}")
-        print("DATA QUALITY REPORT")
-        print(f"{'='*60}")
-        print(f"Total records: {len(prophet_df)}")
-        print(f"Date range: {prophet_df['ds'].min().date()} to {prophet_df['ds'].max().date()}")
-        print(f"Time span: {(prophet_df['ds'].max() - prophet_df['ds'].min()).days} days")
-        print(f"\nTarget Variable Statistics:")
-        print(f"  Mean:     {prophet_df['y'].mean():>10.2f}")
-        print(f"  Median:   {prophet_df['y'].median():>10.2f}")
-        print(f"  Std Dev:  {prophet_df['y'].std():>10.2f}")
-        print(f"  Min:      {prophet_df['y'].min():>10.2f}")
-        print(f"  Max:      {prophet_df['y'].max():>10.2f}")
-        print(f"  Zeros:    {(prophet_df['y'] == 0).sum()} ({(prophet_df['y'] == 0).sum()/len(prophet_df)*100:.1f}%)")
-        print(f"{'='*60}\n")
-        
-        # Check for minimum data requirements
-        if len(prophet_df) < 30:
-            return jsonify({
-                "error": f"Insufficient data for forecasting. Need at least 30 days, got {len(prophet_df)}"
-            }), 400
 
-        # Get optimized parameters
-        model_params = get_optimized_prophet_params(prophet_df)
+# Parsed uploads, keyed by the content hash of the raw CSV bytes
+DATASET_CACHE_MAX_MB = float(os.environ.get("DATASET_CACHE_MAX_MB", 512))
+DATASET_CACHE = LRUCache("dataset cache", int(DATASET_CACHE_MAX_MB * 1024 * 1024))
 
-        # Train Prophet model
-        print("Training Prophet model with optimized parameters...")
-        prophet_model = Prophet(**model_params)
-        prophet_model.add_seasonality(name='monthly', period=30.5, fourier_order=5)
-        prophet_model.fit(prophet_df)
-        print("✓ Model training complete\n")
 
-        # Generate forecast
-        future = prophet_model.make_future_dataframe(periods=forecast_days, freq='D')
-        forecast_result = prophet_model.predict(future)
-        
-        # Apply bounds
-        forecast_result['yhat'] = forecast_result['yhat'].clip(lower=0)
-        forecast_result['yhat_lower'] = forecast_result['yhat_lower'].clip(lower=0)
-        forecast_result['yhat_upper'] = forecast_result['yhat_upper'].clip(lower=0)
+# Candidate strptime formats for date sniffing. Order breaks ties, so
+# ambiguous values like 03/01/2023 resolve month-first as pandas does.
+DATE_FORMAT_CANDIDATES = [
+    '%m/%d/%Y', '%m/%d/%y', '%Y-%m-%d', '%d/%m/%Y', '%d/%m/%y', '%Y/%m/%d',
+    '%m-%d-%Y', '%d-%m-%Y', '%d.%m.%Y', '%Y-%m-%d %H:%M:%S', '%m/%d/%Y %H:%M',
+    '%d-%b-%Y', '%d %b %Y', '%b %d, %Y', '%B %d, %Y'
+]
 
-        # Evaluate model performance
-        evaluation_results = evaluate_model_performance(prophet_df, prophet_model, forecast_result)
+# Inferred layouts keyed by header signature (bounded to ~1 MB of schemas)
+SCHEMA_CACHE = LRUCache("schema cache", 1024 * 1024)
 
-        # Extract future forecast
-        future_forecast = forecast_result[forecast_result['ds'] > prophet_df['ds'].max()].copy()
 
-        # Prepare response data
-        historical_dates = prophet_df['ds'].dt.strftime("%Y-%m-%d").tolist()
-        historical_values = prophet_df['y'].tolist()
-        forecast_dates = future_forecast['ds'].dt.strftime("%Y-%m-%d").tolist()
-        
-        forecast_values = [float(v) if pd.notna(v) else 0 for v in future_forecast['yhat'].tolist()]
-        forecast_lower = [float(v) if pd.notna(v) else 0 for v in future_forecast['yhat_lower'].tolist()]
-        forecast_upper = [float(v) if pd.notna(v) else 0 for v in future_forecast['yhat_upper'].tolist()]
-        
-        combined_dates = historical_dates + forecast_dates
-        combined_actual = historical_values + [None] * len(forecast_dates)
-        combined_predicted = [None] * len(historical_dates) + forecast_values
-        combined_lower = [None] * len(historical_dates) + forecast_lower
-        combined_upper = [None] * len(historical_dates) + forecast_upper
-
-        graph_series = {
-            "actual": combined_actual,
-            "baseline": combined_predicted,
-            "base": combined_predicted,
-            "predicted": combined_predicted,
-            "lower_bound": combined_lower,
-            "upper_bound": combined_upper
-        }
+def sniff_date_formats(values, max_unique=5000):
+    """
+    Find the explicit strptime format(s) that parse a date column.
+    Works on the distinct values and greedily adds formats until every
+    value is covered. Returns (formats, coverage).
+    """
+    sample = pd.Series(values).dropna().astype(str).str.strip()
+    uniques = pd.Series(pd.unique(sample[sample != ""]))
+    if uniques.empty:
+        return [], 0.0
+    if len(uniques) > max_unique:
+        uniques = uniques.iloc[np.linspace(0, len(uniques) - 1, max_unique).astype(int)]
+
+    formats = []
+    remaining = uniques
+    while not remaining.empty:
+        best_fmt, best_mask = None, None
+        for fmt in DATE_FORMAT_CANDIDATES:
+            if fmt in formats:
+                continue
+            mask = pd.to_datetime(remaining, format=fmt, errors='coerce').notna()
+            if best_mask is None or mask.sum() > best_mask.sum():
+                best_fmt, best_mask = fmt, mask
+        if best_mask is None or not best_mask.any():
+            break
+        formats.append(best_fmt)
+        remaining = remaining[~best_mask.to_numpy()]
 
-        # Format forecast list
-        forecast_list = []
-        for _, row in future_forecast.iterrows():
-            forecast_list.append({
-                "ds": format_mdy(row['ds']),
-                "pred": max(0.0, float(row['yhat'])),
-                "pred_lower": max(0.0, float(row['yhat_lower'])),
-                "pred_upper": max(0.0, float(row['yhat_upper']))
-            })
+    return formats, 1.0 - len(remaining) / len(uniques)
 
-        # Generate insights
-        insights = generate_forecast_insights(
-            evaluation_results,
-            prophet_df,
-            future_forecast,
-            forecast_days
-        )
 
-        # Final metrics
-        final_metrics = evaluation_results.get('in_sample', {})
-        
+def parse_dates(values, formats):
+    """Parse a date column with explicit strptime formats, tried in order"""
+    if pd.api.types.is_datetime64_any_dtype(values):
+        return values
+    values = values.astype(object).where(values.isna(), values.astype(str).str.strip())
+    if not formats:
+        return pd.to_datetime(values, errors='coerce')
+
+    parsed = pd.to_datetime(values, format=formats[0], errors='coerce')
+    for fmt in formats[1:]:
+        missing = parsed.isna() & values.notna()
+        if not missing.any():
+            break
+        parsed[missing] = pd.to_datetime(values[missing], format=fmt, errors='coerce')
+    return parsed
+
+
+def schema_dates(values, schema):
+    """
+    Parse dates with the schema's formats. If a later upload with the same
+    header uses a different date style, re-sniff and refresh the schema.
+    """
+    parsed = parse_dates(values, schema['date_formats'])
+    non_empty = values.notna().sum()
+    if non_empty and parsed.notna().sum() < 0.5 * non_empty:
+        formats, _ = sniff_date_formats(values)
+        if formats and formats != schema['date_formats']:
+            print(f"  ↻ Date format changed for schema {schema['signature']}: {formats}")
+            schema['date_formats'] = formats
+            schema['date_format'] = formats[0]
+            parsed = parse_dates(values, formats)
+    return parsed
+
+
+def numeric_kind(values, sample_size=500):
+    """Classify a value column: integer, decimal, formatted, empty or text"""
+    sample = values.dropna().head(sample_size).astype(str).str.strip()
+    sample = sample[sample != ""]
+    if sample.empty:
+        return "empty"
+    if sample.str.fullmatch(r'[-+]?\d+').all():
+        return "integer"
+    if sample.str.fullmatch(r'[-+]?\d*\.?\d+').all():
+        return "decimal"
+    if parse_num_series(sample).notna().all():
+        return "formatted"
+    return "text"
+
+
+def infer_schema(df, layout=None):
+    """
+    Infer the upload layout once per header signature: the date column
+    with its strptime format, the outlet column and the SKU columns with
+    their numeric kinds. Returns (schema, cached).
+    `layout` forces the layout when the caller already knows it (appends).
+    """
+    columns = [str(c).strip() for c in df.columns]
+    signature = hashlib.sha1("\x1f".join(columns).encode("utf-8")).hexdigest()[:16]
+    cache_key = f"{signature}:{layout}" if layout else signature
+    schema = SCHEMA_CACHE.get(cache_key)
+    if schema is not None:
+        return schema, True
+
+    start = time.perf_counter()
+    if layout is None:
+        col_lower = [c.lower() for c in columns]
+        has_outlet = any('outlet' in c for c in col_lower)
+        layout = 'wide' if has_outlet and len(columns) > 5 else 'standard'
+
+    if layout == 'wide':
+        date_col, outlet_col, sku_cols = find_wide_columns(df)
+    else:
+        outlet_col, sku_cols = None, []
+        date_col = None
+        for cand in ["date", "ds", "datetime", "day", "timestamp"]:
+            date_col = next((c for c in df.columns if c.lower().strip() == cand), None)
+            if date_col is not None:
+                break
+        if date_col is None:
+            date_col = detect_date_column(df)
+        if date_col is None:
+            raise ValueError("No date column found")
+
+    formats, coverage = sniff_date_formats(df[date_col])
+
+    schema = {
+        "signature": signature,
+        "layout": layout,
+        "columns": columns,
+        "date_column": date_col,
+        "date_format": formats[0] if formats else None,
+        "date_formats": formats,
+        "date_coverage": round(float(coverage), 4),
+        "outlet_column": outlet_col,
+        "sku_columns": [{"name": col, "kind": numeric_kind(df[col])} for col in sku_cols],
+        "inference_ms": round((time.perf_counter() - start) * 1000, 2)
+    }
+    SCHEMA_CACHE.put(cache_key, schema, len(str(schema)))
+    print(f"✓ Inferred {layout} schema {signature} in {schema['inference_ms']} ms "
+          f"(date: {date_col} {schema['date_format']})")
+    return schema, False
+
+
+def clean_uploaded_frame(df):
+    """
+    Strip column whitespace and drop repeated header rows (DATE/OUTLET)
+    and summary rows such as the 'TOTAL PHYS' line from generate_data.py
+    """
+    df.columns = [str(c).strip() for c in df.columns]
+    if df.shape[1] >= 2:
+        second_col = df.columns[1]
+        first_values = df.iloc[:, 0].fillna("").astype(str).str.strip().str.upper()
+        second_values = df[second_col].astype(str).str.strip().str.upper()
+        mask_header = (second_values == "OUTLET") | (first_values == "DATE")
+        mask_summary = (first_values == "") & second_values.str.startswith("TOTAL")
+        df = df.loc[~(mask_header | mask_summary)].reset_index(drop=True)
+    return df
+
+
+def compute_dataset_id(raw_bytes):
+    """Content hash used as the dataset ID (identical uploads share an ID)"""
+    return hashlib.sha256(raw_bytes).hexdigest()[:24]
+
+
+def register_dataset(raw_bytes, filename=None):
+    """
+    Parse an uploaded CSV once and keep the frames in the dataset cache.
+    Returns (dataset, cached) where cached tells if the parse was skipped.
+    """
+    dataset_id = compute_dataset_id(raw_bytes)
+    dataset = DATASET_CACHE.get(dataset_id)
+    # Streamed datasets only hold aggregates; a full parse replaces them
+    if dataset is not None and dataset["mode"] != "stream":
+        return dataset, True
+    dataset = open_dataset_snapshot(dataset_id)
+    if dataset is not None:
+        return dataset, True
+
+    start = time.perf_counter()
+    df = pd.read_csv(io.BytesIO(raw_bytes), dtype=str, keep_default_na=False, na_values=[''])
+    frame = clean_uploaded_frame(df)
+    rows = int(len(frame))
+    schema, schema_cached = infer_schema(frame)
+
+    # Wide uploads keep only the sparse compact form; the string frame is dropped
+    compact = footprint = None
+    if schema['layout'] == 'wide':
+        compact = build_compact_dataset(frame, schema)
+        daily = compact_daily(compact)
+        aggregates = build_aggregates(compact, daily)
+        footprint = compact_nbytes(compact, aggregates["cube"])
+        frame = None
+        nbytes = int(footprint["total"] + footprint["cube"] + daily.memory_usage(deep=True).sum())
+    else:
+        daily = detect_format_and_process(frame.copy(), schema)
+        aggregates = build_aggregates(None, daily)
+        nbytes = int(frame.memory_usage(deep=True).sum() + daily.memory_usage(deep=True).sum())
+
+    dataset = {
+        "dataset_id": dataset_id,
+        "filename": filename,
+        "frame": frame,
+        "compact": compact,
+        "footprint": footprint,
+        "daily": daily,
+        "aggregates": aggregates,
+        "rows": rows,
+        "upload_bytes": len(raw_bytes),
+        "memory_bytes": nbytes,
+        "parse_seconds": round(time.perf_counter() - start, 4),
+        "created_at": pd.Timestamp.now().isoformat(),
+        "mode": "memory",
+        "schema": schema,
+        "schema_cached": schema_cached
+    }
+    DATASET_CACHE.put(dataset_id, dataset, nbytes)
+    print(f"✓ Registered dataset {dataset_id} ({rows} rows, {nbytes / 1024 / 1024:.2f} MB)")
+
+    try:
+        dataset["snapshot"] = write_dataset_snapshot(dataset)
+    except OSError as e:
+        print(f"⚠ Snapshot not written for {dataset_id}: {e}")
+    return dataset, False
+
+
+def dataset_frame(dataset):
+    """Copy of the row-level frame (kept for standard-layout uploads only)"""
+    if dataset.get("frame") is None:
+        raise ValueError(
+            "Dataset was ingested in streaming mode and only keeps daily, outlet and SKU "
+            "aggregates. Upload it without mode=stream for row-level analysis."
+        )
+    return dataset["frame"].copy()
+
+
+def dataset_compact(dataset):
+    """Sparse compact form of a wide-layout dataset"""
+    if dataset.get("compact") is None:
+        if dataset["mode"] == "stream":
+            raise ValueError(
+                "Dataset was ingested in streaming mode and only keeps daily, outlet and SKU "
+                "aggregates. Upload it without mode=stream for row-level analysis."
+            )
+        raise ValueError("This analysis needs the wide DATE/OUTLET/SKU layout")
+    return dataset["compact"]
+
+
+def describe_dataset(dataset):
+    """JSON-safe summary of a cached dataset"""
+    # Appended datasets are described from their segments without merging them
+    frames = dataset.daily_segments() if isinstance(dataset, AppendedDataset) else [dataset["daily"]]
+    frames = [daily for daily in frames if not daily.empty]
+    summary = {
+        "dataset_id": dataset["dataset_id"],
+        "filename": dataset["filename"],
+        "rows": dataset["rows"],
+        "daily_observations": int(sum(len(daily) for daily in frames)),
+        "upload_bytes": dataset["upload_bytes"],
+        "memory_bytes": dataset["memory_bytes"],
+        "parse_seconds": dataset["parse_seconds"],
+        "created_at": dataset["created_at"],
+        "mode": dataset["mode"]
+    }
+    if dataset.get("schema") is not None:
+        summary["schema"] = {**dataset["schema"], "cached": dataset["schema_cached"]}
+    if dataset.get("footprint") is not None:
+        summary["footprint"] = dataset["footprint"]
+    if "ingest" in dataset:
+        summary["ingest"] = dataset["ingest"]
+    if dataset.get("snapshot") is not None:
+        summary["snapshot"] = dataset["snapshot"]
+    if dataset.get("parent_id"):
+        summary["parent_id"] = dataset["parent_id"]
+    if "append" in dataset:
+        summary["append"] = dataset["append"]
+    if isinstance(dataset, AppendedDataset) and dataset.pending:
+        summary["pending_segments"] = len(dataset.segments)
+    if frames:
+        summary["date_range"] = {
+            "start": frames[0]["ds"].min().strftime("%Y-%m-%d"),
+            "end": frames[-1]["ds"].max().strftime("%Y-%m-%d")
+        }
+    return summary
+
+
+def requested_dataset_id():
+    """dataset_id sent with the request (form, query string or JSON body)"""
+    dataset_id = request.form.get("dataset_id") or request.args.get("dataset_id")
+    if not dataset_id and request.is_json:
+        dataset_id = (request.get_json(silent=True) or {}).get("dataset_id")
+    return str(dataset_id).strip() if dataset_id else None
+
+
+def get_request_dataset():
+    """
+    Resolve the dataset for an analysis request.
+    Accepts a `dataset_id` (form, query string or JSON) or an uploaded `file`;
+    uploads are hashed so a repeated file reuses the cached parse.
+    Returns None when nothing usable was sent.
+    """
+    dataset_id = requested_dataset_id()
+    if dataset_id:
+        dataset = DATASET_CACHE.get(dataset_id)
+        if dataset is None:
+            dataset = open_dataset_snapshot(dataset_id)
+        return reprice_dataset(dataset) if dataset is not None else None
+
+    if "file" in request.files:
+        file = request.files["file"]
+        dataset, _ = register_dataset(file.read(), file.filename)
+        return reprice_dataset(dataset)
+
+    return None
+
+
+def dataset_missing_response():
+    """Error response matching why get_request_dataset() returned None"""
+    dataset_id = requested_dataset_id()
+    if dataset_id:
+        return jsonify({
+            "error": f"Unknown dataset_id '{dataset_id}'. Upload the file again via POST /datasets."
+        }), 404
+    return jsonify({"error": "No file uploaded"}), 400
+
+
+# On-disk columnar snapshots of parsed wide datasets, one directory per
+# dataset_id holding .npy columns plus meta.json. They are reopened
+# memory-mapped, so restarts and other workers skip the CSV parse and
+# share the same page cache.
+SNAPSHOT_DIR = os.environ.get(
+    "DATASET_SNAPSHOT_DIR", os.path.join(os.path.dirname(__file__), "datasets", "snapshots")
+)
+SNAPSHOTS_ENABLED = os.environ.get("DATASET_SNAPSHOTS", "1") != "0"
+SNAPSHOT_VERSION = 2
+SNAPSHOT_ARRAYS = [
+    "cases_data", "cases_indices", "cases_indptr", "outlet_codes", "days",
+    "case_qty", "units", "daily_days", "daily_y", "daily_revenue"
+]
+
+
+def snapshot_path(dataset_id):
+    """Snapshot directory for a dataset_id, or None if the ID is not a content hash"""
+    if not dataset_id or len(dataset_id) != 24 or any(c not in "0123456789abcdef" for c in dataset_id):
+        return None
+    return os.path.join(SNAPSHOT_DIR, dataset_id)
+
+
+def directory_bytes(path):
+    """Total size of the files directly inside a directory"""
+    return sum(entry.stat().st_size for entry in os.scandir(path) if entry.is_file())
+
+
+def write_dataset_snapshot(dataset):
+    """
+    Persist a compact dataset as a columnar snapshot.
+    Files are written to a temp directory and renamed into place, so readers
+    never see a partial snapshot. Returns snapshot info, or None if skipped.
+    """
+    compact = dataset.get("compact")
+    path = snapshot_path(dataset["dataset_id"])
+    if not SNAPSHOTS_ENABLED or compact is None or path is None:
+        return None
+    if os.path.exists(os.path.join(path, "meta.json")):
+        return {"path": path, "bytes": directory_bytes(path), "written": False}
+
+    start = time.perf_counter()
+    cases = compact["cases"]
+    daily = dataset["daily"]
+    arrays = {
+        "cases_data": cases.data,
+        "cases_indices": cases.indices,
+        "cases_indptr": cases.indptr,
+        "outlet_codes": compact["outlet_codes"],
+        "days": compact["days"],
+        "case_qty": compact["case_qty"],
+        "units": cases @ compact["case_qty"],
+        "daily_days": (daily["ds"] - compact["date0"]).dt.days.to_numpy(dtype=np.int32),
+        "daily_y": daily["y"].to_numpy(dtype=float),
+        "daily_revenue": daily["revenue"].to_numpy(dtype=float)
+    }
+    meta = {
+        "version": SNAPSHOT_VERSION,
+        "dataset_id": dataset["dataset_id"],
+        "filename": dataset["filename"],
+        "rows": dataset["rows"],
+        "upload_bytes": dataset["upload_bytes"],
+        "created_at": dataset["created_at"],
+        "shape": list(cases.shape),
+        "skus": list(compact["skus"]),
+        "outlets": list(compact["outlets"]),
+        "date0": compact["date0"].isoformat(),
+        "date_format": compact["date_format"],
+        "rows_dropped": compact["rows_dropped"],
+        "schema": dataset["schema"],
+        "parent_id": dataset.get("parent_id"),
+        "price_fingerprint": dataset["aggregates"]["price_fingerprint"]
+    }
+
+    return save_snapshot(path, arrays, meta, start)
+
+
+def save_snapshot(path, arrays, meta, start):
+    """
+    Write snapshot columns and meta.json to a temp directory and rename it
+    into place, so readers never see a partial snapshot
+    """
+    os.makedirs(SNAPSHOT_DIR, exist_ok=True)
+    tmp_path = f"{path}.tmp-{os.getpid()}-{threading.get_ident()}"
+    os.makedirs(tmp_path, exist_ok=True)
+    try:
+        for name in SNAPSHOT_ARRAYS:
+            np.save(os.path.join(tmp_path, f"{name}.npy"), np.ascontiguousarray(arrays[name]))
+        with open(os.path.join(tmp_path, "meta.json"), "w") as f:
+            json.dump(meta, f)
+        os.rename(tmp_path, path)
+    except OSError:
+        # Another worker renamed its copy first (or the disk is read-only)
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        if not os.path.exists(os.path.join(path, "meta.json")):
+            raise
+
+    info = {
+        "path": path,
+        "bytes": directory_bytes(path),
+        "written": True,
+        "write_ms": round((time.perf_counter() - start) * 1000, 2)
+    }
+    print(f"✓ Snapshot written: {path} ({info['bytes'] / 1024:.1f} KB in {info['write_ms']} ms)")
+    return info
+
+
+def write_delta_snapshot(dataset, delta, delta_daily):
+    """
+    Persist an appended dataset as a delta snapshot: only the appended rows,
+    plus the parent_id whose snapshot holds everything before them. Skipped
+    (None) when the parent has no snapshot to chain onto.
+    """
+    path = snapshot_path(dataset["dataset_id"])
+    parent_path = snapshot_path(dataset["parent_id"])
+    if not SNAPSHOTS_ENABLED or path is None or parent_path is None:
+        return None
+    if os.path.exists(os.path.join(path, "meta.json")):
+        return {"path": path, "bytes": directory_bytes(path), "written": False}
+    if not os.path.exists(os.path.join(parent_path, "meta.json")):
+        print(f"⚠ No snapshot for parent {dataset['parent_id']}; delta snapshot skipped")
+        return None
+
+    start = time.perf_counter()
+    cases = delta["cases"]
+    arrays = {
+        "cases_data": cases.data,
+        "cases_indices": cases.indices,
+        "cases_indptr": cases.indptr,
+        "outlet_codes": delta["outlet_codes"],
+        "days": delta["days"],
+        "case_qty": delta["case_qty"],
+        "units": delta["units"],
+        "daily_days": (delta_daily["ds"] - delta["date0"]).dt.days.to_numpy(dtype=np.int32),
+        "daily_y": delta_daily["y"].to_numpy(dtype=float),
+        "daily_revenue": delta_daily["revenue"].to_numpy(dtype=float)
+    }
+    meta = {
+        "version": SNAPSHOT_VERSION,
+        "kind": "delta",
+        "dataset_id": dataset["dataset_id"],
+        "parent_id": dataset["parent_id"],
+        "filename": dataset["filename"],
+        "rows": dataset["rows"],
+        "upload_bytes": dataset["upload_bytes"],
+        "created_at": dataset["created_at"],
+        "shape": list(cases.shape),
+        "outlets": list(delta["outlets"]),
+        "rows_dropped": delta["rows_dropped"],
+        "append": dataset.get("append"),
+        "price_fingerprint": PRICE_BOOK.fingerprint
+    }
+    return save_snapshot(path, arrays, meta, start)
+
+
+def open_dataset_snapshot(dataset_id):
+    """
+    Reopen a dataset from its snapshot with memory-mapped (zero-copy) arrays.
+    Returns None when there is no usable snapshot for the ID.
+    """
+    path = snapshot_path(dataset_id)
+    if not SNAPSHOTS_ENABLED or path is None or not os.path.exists(os.path.join(path, "meta.json")):
+        return None
+
+    start = time.perf_counter()
+    with open(os.path.join(path, "meta.json")) as f:
+        meta = json.load(f)
+    if meta.get("version") != SNAPSHOT_VERSION:
+        return None
+    arrays = {name: np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r") for name in SNAPSHOT_ARRAYS}
+    if meta.get("kind") == "delta":
+        return open_delta_snapshot(path, meta, arrays, start)
+
+    compact = {
+        "cases": sparse.csr_matrix(
+            (arrays["cases_data"], arrays["cases_indices"], arrays["cases_indptr"]),
+            shape=tuple(meta["shape"]), copy=False
+        ),
+        "outlet_codes": arrays["outlet_codes"],
+        "outlets": meta["outlets"],
+        "days": arrays["days"],
+        "date0": pd.Timestamp(meta["date0"]),
+        "skus": meta["skus"],
+        "case_qty": arrays["case_qty"],
+        "units": arrays["units"],
+        "date_format": meta["date_format"],
+        "rows_dropped": meta["rows_dropped"]
+    }
+    daily = pd.DataFrame({
+        'ds': compact_dates(compact, arrays["daily_days"]),
+        'y': np.array(arrays["daily_y"]),
+        'revenue': np.array(arrays["daily_revenue"])
+    })
+
+    aggregates = build_aggregates(compact, daily)
+    # Stored daily revenue is priced with the book at write time
+    aggregates["price_fingerprint"] = meta.get("price_fingerprint")
+    footprint = compact_nbytes(compact, aggregates["cube"])
+
+    # Mapped pages live in the shared page cache; only count private memory
+    nbytes = int(daily.memory_usage(deep=True).sum() + sum(len(o) for o in meta["outlets"]) + footprint["cube"])
+    dataset = {
+        "dataset_id": meta["dataset_id"],
+        "filename": meta["filename"],
+        "frame": None,
+        "compact": compact,
+        "footprint": footprint,
+        "daily": daily,
+        "aggregates": aggregates,
+        "rows": meta["rows"],
+        "upload_bytes": meta["upload_bytes"],
+        "memory_bytes": nbytes,
+        "parse_seconds": 0.0,
+        "created_at": meta["created_at"],
+        "mode": "snapshot",
+        "schema": meta["schema"],
+        "schema_cached": True,
+        "parent_id": meta.get("parent_id"),
+        "snapshot": {
+            "path": path,
+            "bytes": directory_bytes(path),
+            "open_ms": round((time.perf_counter() - start) * 1000, 2)
+        }
+    }
+    DATASET_CACHE.put(dataset["dataset_id"], dataset, nbytes)
+    print(f"✓ Opened snapshot {dataset_id} in {dataset['snapshot']['open_ms']} ms")
+    return reprice_dataset(dataset)
+
+
+def open_delta_snapshot(path, meta, arrays, start):
+    """
+    Reopen an appended dataset from its delta snapshot chained onto the
+    parent's (opened first if needed). Merging waits for the first read.
+    """
+    parent = DATASET_CACHE.get(meta["parent_id"]) or open_dataset_snapshot(meta["parent_id"])
+    if parent is None:
+        print(f"⚠ Snapshot {meta['dataset_id']} needs parent {meta['parent_id']}, which is unavailable")
+        return None
+    base, _ = dataset_head(parent)
+    delta = {
+        **base,
+        "cases": sparse.csr_matrix(
+            (arrays["cases_data"], arrays["cases_indices"], arrays["cases_indptr"]),
+            shape=tuple(meta["shape"]), copy=False
+        ),
+        "outlet_codes": arrays["outlet_codes"],
+        "outlets": meta["outlets"],
+        "days": arrays["days"],
+        "units": arrays["units"],
+        "rows_dropped": meta["rows_dropped"]
+    }
+    delta_daily = pd.DataFrame({
+        'ds': compact_dates(delta, arrays["daily_days"]),
+        'y': np.array(arrays["daily_y"]),
+        'revenue': np.array(arrays["daily_revenue"])
+    })
+    dataset = chain_segment(
+        parent, delta, delta_daily, meta.get("price_fingerprint"),
+        dataset_id=meta["dataset_id"],
+        filename=meta["filename"],
+        rows=meta["rows"],
+        upload_bytes=meta["upload_bytes"],
+        parse_seconds=0.0,
+        created_at=meta["created_at"],
+        mode="snapshot",
+        parent_id=meta["parent_id"],
+        append=meta.get("append"),
+        snapshot={
+            "path": path,
+            "bytes": directory_bytes(path),
+            "open_ms": round((time.perf_counter() - start) * 1000, 2)
+        }
+    )
+    DATASET_CACHE.put(dataset["dataset_id"], dataset, dataset["memory_bytes"])
+    print(f"✓ Opened delta snapshot {meta['dataset_id']} in {dataset['snapshot']['open_ms']} ms")
+    return dataset
+
+
+def list_snapshots():
+    """Dataset IDs with a snapshot on disk"""
+    if not os.path.isdir(SNAPSHOT_DIR):
+        return []
+    return sorted(
+        name for name in os.listdir(SNAPSHOT_DIR)
+        if snapshot_path(name) and os.path.exists(os.path.join(SNAPSHOT_DIR, name, "meta.json"))
+    )
+
+
+def align_delta_compact(base, delta):
+    """
+    Re-express a compact delta in the base dataset's coordinates: day offsets
+    from the base date0, outlet codes into the base outlet table (new outlets
+    are appended) and SKU columns in the base column order
+    """
+    sku_index = {sku: i for i, sku in enumerate(base["skus"])}
+    unknown = [sku for sku in delta["skus"] if sku not in sku_index]
+    if unknown:
+        raise ValueError(f"Appended rows have SKU columns the dataset does not: {', '.join(unknown)}")
+    column_map = np.array([sku_index[sku] for sku in delta["skus"]], dtype=np.int32)
+    cases = delta["cases"]
+    cases = sparse.csr_matrix(
+        (cases.data, column_map[cases.indices], cases.indptr), shape=(cases.shape[0], len(base["skus"]))
+    )
+    cases.sort_indices()
+
+    positions = pd.Index(base["outlets"]).get_indexer(delta["outlets"])
+    new_outlets = [o for o, p in zip(delta["outlets"], positions) if p < 0]
+    positions[positions < 0] = len(base["outlets"]) + np.arange(len(new_outlets))
+    codes = np.where(delta["outlet_codes"] >= 0, positions[np.maximum(delta["outlet_codes"], 0)], -1)
+
+    offset = (delta["date0"] - base["date0"]).days
+    case_qty = base["case_qty"]
+    return {
+        **delta,
+        "cases": cases,
+        "outlet_codes": codes,
+        "outlets": list(base["outlets"]) + new_outlets,
+        "days": (delta["days"] + offset).astype(np.int32),
+        "date0": base["date0"],
+        "skus": base["skus"],
+        "case_qty": case_qty,
+        "units": cases @ case_qty
+    }, new_outlets
+
+
+class AppendedDataset(dict):
+    """
+    Dataset built by appends: a parent dataset plus delta segments, each
+    already aligned to the parent's outlet/SKU/day coordinates. The
+    concatenated compact form, daily series and aggregates are only merged
+    when first read, in one pass over every segment pending by then, so
+    appending costs O(delta) and a run of appends pays the O(history)
+    concatenation once instead of once per append.
+    """
+    MERGED_KEYS = ("compact", "daily", "aggregates")
+
+    def __init__(self, parent, segments):
+        super().__init__()
+        self.parent = parent
+        self.segments = segments  # [(delta compact, delta daily, price fingerprint)]
+        self.merge_lock = threading.Lock()
+
+    @property
+    def pending(self):
+        return bool(self.segments)
+
+    def __missing__(self, key):
+        if key in self.MERGED_KEYS and self.pending:
+            self.merge_segments()
+            return dict.__getitem__(self, key)
+        raise KeyError(key)
+
+    def get(self, key, default=None):
+        if key in self.MERGED_KEYS and self.pending:
+            self.merge_segments()
+        return dict.get(self, key, default)
+
+    def head(self):
+        """(compact, last_ds) at the end of the dataset, without merging"""
+        if not self.pending:
+            return dataset_compact(self), self["aggregates"]["last_ds"]
+        delta, daily, _ = self.segments[-1]
+        return delta, daily["ds"].max()
+
+    def daily_segments(self):
+        """Daily frames of the parent and each pending segment, in date order"""
+        if not self.pending:
+            return [self["daily"]]
+        return [self.parent["daily"]] + [daily for _, daily, _ in self.segments]
+
+    def merge_segments(self):
+        """Concatenate the parent and all pending segments (O(history), once)"""
+        with self.merge_lock:
+            if not self.pending:
+                return
+            start = time.perf_counter()
+            parent, segments = self.parent, self.segments
+            base = dataset_compact(parent)
+            deltas = [delta for delta, _, _ in segments]
+            delta = {
+                **deltas[-1],
+                "cases": sparse.vstack([d["cases"] for d in deltas], format="csr"),
+                "outlet_codes": np.concatenate([d["outlet_codes"] for d in deltas]),
+                "days": np.concatenate([d["days"] for d in deltas]),
+                "units": np.concatenate([d["units"] for d in deltas]),
+                "rows_dropped": sum(d["rows_dropped"] for d in deltas)
+            }
+            delta_daily = pd.concat([daily for _, daily, _ in segments], ignore_index=True)
+
+            n_outlets = len(delta["outlets"])
+            codes = np.concatenate([base["outlet_codes"], delta["outlet_codes"]])
+            compact = {
+                **base,
+                "cases": sparse.vstack([base["cases"], delta["cases"]], format="csr"),
+                "outlet_codes": codes.astype(np.int16 if n_outlets < np.iinfo(np.int16).max else np.int32),
+                "outlets": delta["outlets"],
+                "days": np.concatenate([base["days"], delta["days"]]),
+                "rows_dropped": base["rows_dropped"] + delta["rows_dropped"]
+            }
+            if "units" in base:
+                compact["units"] = np.concatenate([base["units"], delta["units"]])
+            daily = pd.concat([parent["daily"], delta_daily], ignore_index=True)
+            aggregates = merge_aggregates(parent["aggregates"], build_aggregates(delta, delta_daily), compact)
+            # Segments priced under different books are repriced as a whole on next use
+            fingerprints = {parent["aggregates"]["price_fingerprint"]} | {fp for _, _, fp in segments}
+            if fingerprints != {PRICE_BOOK.fingerprint}:
+                aggregates["price_fingerprint"] = None
+
+            footprint = compact_nbytes(compact, aggregates["cube"])
+            nbytes = int(footprint["total"] + footprint["cube"] + daily.memory_usage(deep=True).sum())
+            dict.update(self, compact=compact, daily=daily, aggregates=aggregates,
+                        footprint=footprint, memory_bytes=nbytes)
+            self.parent, self.segments = None, []
+            if self["dataset_id"] in DATASET_CACHE:
+                DATASET_CACHE.put(self["dataset_id"], self, nbytes)
+            print(f"✓ Merged {len(segments)} appended segment(s) into {self['dataset_id']} "
+                  f"in {(time.perf_counter() - start) * 1000:.1f} ms")
+
+
+def dataset_head(dataset):
+    """(compact, last stored date) of a wide dataset, without merging pending appends"""
+    if isinstance(dataset, AppendedDataset):
+        return dataset.head()
+    return dataset_compact(dataset), dataset["aggregates"]["last_ds"]
+
+
+def chain_segment(base_dataset, delta, delta_daily, price_fingerprint, **fields):
+    """
+    Dataset for base_dataset plus one aligned delta segment. Segments still
+    pending on the base carry over, so consecutive appends merge together.
+    """
+    if isinstance(base_dataset, AppendedDataset) and base_dataset.pending:
+        parent, segments = base_dataset.parent, base_dataset.segments
+    else:
+        parent, segments = base_dataset, []
+    segments = segments + [(delta, delta_daily, price_fingerprint)]
+    # The parent is cached under its own ID; only the segments are private here
+    nbytes = int(sum(
+        compact_nbytes(d)["total"] + daily.memory_usage(deep=True).sum() for d, daily, _ in segments
+    ))
+    dataset = AppendedDataset(parent, segments)
+    dataset.update({k: v for k, v in dict.items(base_dataset) if k not in AppendedDataset.MERGED_KEYS})
+    dataset.update(footprint=None, memory_bytes=nbytes, **fields)
+    return dataset
+
+
+APPEND_OVERLAP_MODES = ["reject", "skip"]   # rows on or before the last stored day
+
+
+def append_to_dataset(base_dataset, raw_bytes, filename=None, on_overlap="reject"):
+    """
+    Append new outlet-day rows to a wide dataset.
+    The delta is parsed on its own, checked against the last stored date,
+    aligned to the base coordinates and chained on as a segment; only the
+    delta is written to disk, as a snapshot that references the parent's.
+    Everything here is O(delta) plus the outlet/SKU tables. The merged
+    arrays, daily series and aggregates are built lazily on first read
+    (see AppendedDataset), which is still an O(history) copy. The result is
+    registered as a new dataset (parent_id points at the base).
+    """
+    if on_overlap not in APPEND_OVERLAP_MODES:
+        raise ValueError(f"Unknown on_overlap '{on_overlap}'. Use one of: {', '.join(APPEND_OVERLAP_MODES)}")
+    start = time.perf_counter()
+    base, last_ds = dataset_head(base_dataset)
+
+    df = pd.read_csv(io.BytesIO(raw_bytes), dtype=str, keep_default_na=False, na_values=[''])
+    frame = clean_uploaded_frame(df)
+    # The base fixes the layout; a delta may carry only a few SKU columns
+    schema, _ = infer_schema(frame, layout='wide')
+    if schema['outlet_column'] is None:
+        raise ValueError("Appended rows must use the wide DATE/OUTLET/SKU layout")
+
+    # Overlap check against the last stored date
+    dates = schema_dates(frame[schema['date_column']], schema).dt.normalize()
+    overlap = (dates <= last_ds).to_numpy() if last_ds is not None else np.zeros(len(frame), bool)
+    if overlap.any():
+        if on_overlap != "skip":
+            raise ValueError(
+                f"{int(overlap.sum())} appended rows fall on or before the last stored date "
+                f"({last_ds:%Y-%m-%d}). Send only new days, or pass on_overlap=skip to drop them."
+            )
+        frame = frame.loc[~overlap].reset_index(drop=True)
+    if frame.empty:
+        raise ValueError("No new rows to append")
+
+    delta, new_outlets = align_delta_compact(base, build_compact_dataset(frame, schema))
+    delta_daily = compact_daily(delta)
+
+    dataset_id = compute_dataset_id(base_dataset["dataset_id"].encode() + raw_bytes)
+    dataset = chain_segment(
+        base_dataset, delta, delta_daily, PRICE_BOOK.fingerprint,
+        dataset_id=dataset_id,
+        filename=filename or base_dataset["filename"],
+        rows=base_dataset["rows"] + len(frame),
+        upload_bytes=base_dataset["upload_bytes"] + len(raw_bytes),
+        created_at=pd.Timestamp.now().isoformat(),
+        mode="memory",
+        parent_id=base_dataset["dataset_id"],
+        snapshot=None,
+        append={
+            "rows_appended": int(len(frame)),
+            "rows_skipped_overlap": int(overlap.sum()),
+            "new_days": int(len(delta_daily)),
+            "new_outlets": new_outlets,
+            "seconds": round(time.perf_counter() - start, 4)
+        }
+    )
+    DATASET_CACHE.put(dataset_id, dataset, dataset["memory_bytes"])
+    print(f"✓ Appended {len(frame)} rows to {base_dataset['dataset_id']} → {dataset_id}")
+
+    try:
+        dataset["snapshot"] = write_delta_snapshot(dataset, delta, delta_daily)
+    except OSError as e:
+        print(f"⚠ Snapshot not written for {dataset_id}: {e}")
+    return dataset
+
+
+# Rows per chunk for streaming ingestion (POST /datasets with mode=stream)
+STREAM_CHUNK_ROWS = int(os.environ.get("STREAM_CHUNK_ROWS", 50000))
+
+
+class CountingReader:
+    """File wrapper that counts and hashes the bytes pandas reads through it"""
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.bytes_read = 0
+        self.sha256 = hashlib.sha256()
+
+    def read(self, size=-1):
+        data = self.stream.read(size)
+        self.bytes_read += len(data)
+        self.sha256.update(data if isinstance(data, bytes) else data.encode())
+        return data
+
+
+def peak_rss_bytes():
+    """Peak resident set size of this process, or None where unsupported"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is reported in bytes on macOS and kilobytes on Linux
+    return int(peak if sys.platform == "darwin" else peak * 1024)
+
+
+def stream_wide_aggregates(stream, chunk_rows=STREAM_CHUNK_ROWS):
+    """
+    Read a wide-format CSV (DATE, OUTLET, SKUs...) in fixed-size chunks and
+    fold every chunk into running daily, per-outlet and per-SKU aggregates.
+    Only the aggregates are kept, so memory stays flat however many years
+    of outlet data the file holds.
+    """
+    start = time.perf_counter()
+    rss_before = peak_rss_bytes()
+    reader = CountingReader(stream)
+
+    daily = None
+    outlets = None
+    sku_cases = None
+    schema = schema_cached = None
+    date_col = outlet_col = sku_cols = None
+    case_qty = None
+    sku_revenue = None
+    rows_read = rows_kept = chunks = 0
+
+    for chunk in pd.read_csv(reader, dtype=str, keep_default_na=False, na_values=[''],
+                             chunksize=chunk_rows):
+        chunks += 1
+        rows_read += len(chunk)
+        chunk = clean_uploaded_frame(chunk)
+        if chunk.empty:
+            continue
+
+        # Layout and date format are fixed by the first chunk
+        if schema is None:
+            schema, schema_cached = infer_schema(chunk)
+            if schema['layout'] != 'wide' or schema['outlet_column'] is None:
+                raise ValueError("Streaming ingestion needs the wide DATE/OUTLET/SKU layout")
+            date_col = schema['date_column']
+            outlet_col = schema['outlet_column']
+            sku_cols = [sku['name'] for sku in schema['sku_columns']]
+            case_qty = PRICE_BOOK.case_quantities(sku_cols)
+
+        dates = schema_dates(chunk[date_col], schema)
+        valid = dates.notna().to_numpy()
+        if not valid.any():
+            continue
+        rows_kept += int(valid.sum())
+
+        cases = np.nan_to_num(parse_num_matrix(chunk.loc[valid, sku_cols]), nan=0.0)
+        # Price each row as of its date (one price book join per distinct day)
+        day_codes, chunk_days = pd.factorize(dates[valid])
+        cell_revenue = cases * PRICE_BOOK.prices_asof(sku_cols, chunk_days)[day_codes]
+        part = pd.DataFrame({
+            'ds': dates[valid].to_numpy(),
+            'outlet': chunk.loc[valid, outlet_col].to_numpy(),
+            'units': cases @ case_qty,
+            'revenue': cell_revenue.sum(axis=1)
+        })
+
+        day_part = part.groupby('ds')[['units', 'revenue']].sum()
+        outlet_part = part.groupby('outlet').agg(
+            units=('units', 'sum'), revenue=('revenue', 'sum'), orders=('units', 'size')
+        )
+        sku_part = pd.Series(cases.sum(axis=0), index=sku_cols)
+        sku_revenue_part = pd.Series(cell_revenue.sum(axis=0), index=sku_cols)
+
+        daily = day_part if daily is None else daily.add(day_part, fill_value=0)
+        outlets = outlet_part if outlets is None else outlets.add(outlet_part, fill_value=0)
+        sku_cases = sku_part if sku_cases is None else sku_cases + sku_part
+        sku_revenue = sku_revenue_part if sku_revenue is None else sku_revenue + sku_revenue_part
+
+    if daily is None:
+        raise ValueError("No valid data after cleaning")
+
+    daily = daily.sort_index().reset_index()
+    daily.columns = ['ds', 'y', 'revenue']
+    outlets = outlets.sort_values('units', ascending=False)
+    sku_totals = pd.DataFrame({
+        'cases': sku_cases,
+        'units': sku_cases * case_qty,
+        'revenue': sku_revenue
+    })
+
+    rss_after = peak_rss_bytes()
+    ingest = {
+        "bytes_processed": reader.bytes_read,
+        "rows_processed": rows_read,
+        "rows_kept": rows_kept,
+        "chunks": chunks,
+        "chunk_rows": chunk_rows,
+        "seconds": round(time.perf_counter() - start, 4),
+        "peak_rss_bytes": rss_after,
+        "peak_rss_growth_bytes": (rss_after - rss_before) if rss_after is not None else None
+    }
+    print(f"✓ Streamed {rows_read:,} rows in {chunks} chunks "
+          f"({reader.bytes_read / 1024 / 1024:.1f} MB) → {len(daily)} daily observations")
+    ingest["schema_cached"] = schema_cached
+    return daily, outlets, sku_totals, schema, ingest, reader.sha256.hexdigest()[:24]
+
+
+def register_streamed_dataset(stream, filename=None, chunk_rows=STREAM_CHUNK_ROWS):
+    """
+    Streaming counterpart of register_dataset(): keeps only the daily,
+    per-outlet and per-SKU aggregates in the dataset cache
+    """
+    daily, outlets, sku_totals, schema, ingest, dataset_id = stream_wide_aggregates(stream, chunk_rows)
+
+    cached = DATASET_CACHE.get(dataset_id)
+    if cached is not None:
+        return cached, True
+
+    nbytes = int(daily.memory_usage(deep=True).sum() + outlets.memory_usage(deep=True).sum()
+                 + sku_totals.memory_usage(deep=True).sum())
+    dataset = {
+        "dataset_id": dataset_id,
+        "filename": filename,
+        "frame": None,
+        "compact": None,
+        "daily": daily,
+        "aggregates": build_aggregates(None, daily),
+        "outlet_totals": outlets,
+        "sku_totals": sku_totals,
+        "rows": ingest["rows_kept"],
+        "upload_bytes": ingest["bytes_processed"],
+        "memory_bytes": nbytes,
+        "parse_seconds": ingest["seconds"],
+        "created_at": pd.Timestamp.now().isoformat(),
+        "mode": "stream",
+        "schema": schema,
+        "schema_cached": ingest.pop("schema_cached"),
+        "ingest": ingest
+    }
+    DATASET_CACHE.put(dataset_id, dataset, nbytes)
+    return dataset, False
+
+
+@app.route("/datasets", methods=["POST"])
+def upload_dataset():
+    """
+    Upload a CSV once and get a dataset_id usable by every analysis endpoint
+    """
+    try:
+        if "file" not in request.files:
+            return jsonify({"error": "No file uploaded"}), 400
+
+        file = request.files["file"]
+        mode = request.form.get("mode", "memory").lower()
+        if mode == "stream":
+            chunk_rows = int(request.form.get("chunk_rows", STREAM_CHUNK_ROWS))
+            dataset, cached = register_streamed_dataset(file.stream, file.filename, chunk_rows)
+        else:
+            dataset, cached = register_dataset(file.read(), file.filename)
+
+        return jsonify({
+            **describe_dataset(dataset),
+            "cached": cached,
+            "cache": DATASET_CACHE.stats()
+        })
+
+    except Exception as e:
+        import traceback
+        print(f"Dataset upload error: {e}")
+        print(traceback.format_exc())
+        return jsonify({"error": str(e)}), 400
+
+
+@app.route("/datasets/<dataset_id>/append", methods=["POST"])
+def append_dataset(dataset_id):
+    """
+    Append only the new days to an existing dataset. Returns the ID of the
+    extended dataset; the original stays available under its own ID.
+    """
+    try:
+        if "file" not in request.files:
+            return jsonify({"error": "No file uploaded"}), 400
+
+        base = DATASET_CACHE.get(dataset_id) or open_dataset_snapshot(dataset_id)
+        if base is None:
+            return jsonify({
+                "error": f"Unknown dataset_id '{dataset_id}'. Upload the file again via POST /datasets."
+            }), 404
+
+        file = request.files["file"]
+        on_overlap = request.form.get("on_overlap", "reject").strip().lower()
+        dataset = append_to_dataset(base, file.read(), file.filename, on_overlap)
+
+        return jsonify({
+            **describe_dataset(dataset),
+            "cache": DATASET_CACHE.stats()
+        })
+
+    except Exception as e:
+        import traceback
+        print(f"Dataset append error: {e}")
+        print(traceback.format_exc())
+        return jsonify({"error": str(e)}), 400
+
+
+@app.route("/datasets", methods=["GET"])
+def list_datasets():
+    """List cached datasets with cache statistics and on-disk snapshots"""
+    return jsonify({
+        "datasets": [describe_dataset(d) for _, d in DATASET_CACHE.items()],
+        "cache": DATASET_CACHE.stats(),
+        "snapshots": list_snapshots()
+    })
+
+
+# Calendar feature store: Philippine public holidays, paydays (15th and month
+# end, plus the days after), school calendar windows and weekday / month
+# indicators, precomputed once per calendar year and sliced for any dates.
+# School windows are MM-DD ranges (DepEd's usual June-March school year);
+# override them with CALENDAR_SCHOOL_TERMS / CALENDAR_BACK_TO_SCHOOL as JSON.
+CALENDAR_COUNTRY = os.environ.get("CALENDAR_COUNTRY", "PH")
+CALENDAR_PAYDAY_WINDOW_DAYS = int(os.environ.get("CALENDAR_PAYDAY_WINDOW_DAYS", 2))
+CALENDAR_SCHOOL_TERMS = json.loads(os.environ.get(
+    "CALENDAR_SCHOOL_TERMS", '[["06-15", "12-19"], ["01-05", "03-31"]]'
+))
+CALENDAR_BACK_TO_SCHOOL = json.loads(os.environ.get("CALENDAR_BACK_TO_SCHOOL", '[["05-15", "06-14"]]'))
+CALENDAR_CACHE = LRUCache("calendar cache", 16 * 1024 * 1024)
+
+# Calendar features usable as Prophet regressors (see with_calendar); /forecast
+# adds them unless FORECAST_CALENDAR=0 or the request sends calendar=0
+CALENDAR_REGRESSORS = ["holiday", "payday_window", "school_in_session", "back_to_school"]
+FORECAST_CALENDAR = os.environ.get("FORECAST_CALENDAR", "1") != "0"
+
+
+def calendar_windows(dates, windows):
+    """1.0 on the days of a year that fall in any MM-DD window (inclusive)"""
+    month_day = dates.month * 100 + dates.day
+    inside = np.zeros(len(dates), dtype=bool)
+    for start, end in windows:
+        lo, hi = (int(part.replace("-", "")) for part in (start, end))
+        inside |= (month_day >= lo) & (month_day <= hi) if lo <= hi else (month_day >= lo) | (month_day <= hi)
+    return inside.astype(float)
+
+
+def calendar_year(year):
+    """Feature arrays for every day of one year (cached)"""
+    key = (CALENDAR_COUNTRY, year)
+    block = CALENDAR_CACHE.get(key)
+    if block is not None:
+        return block
+
+    dates = pd.date_range(f"{year}-01-01", f"{year}-12-31", freq="D")
+    names = np.full(len(dates), "", dtype=object)
+    if holidays is not None:
+        for day, name in holidays.country_holidays(CALENDAR_COUNTRY, years=year).items():
+            names[(pd.Timestamp(day) - dates[0]).days] = name
+    day = dates.day.to_numpy()
+    days_in_month = dates.days_in_month.to_numpy()
+    weekday = dates.dayofweek.to_numpy()
+    month = dates.month.to_numpy()
+    block = {
+        "ds": dates.to_numpy(dtype="datetime64[D]"),
+        "holiday": (names != "").astype(float),
+        "holiday_name": names,
+        "payday": ((day == 15) | (day == days_in_month)).astype(float),
+        # Payday itself plus the spending days after it (into the next month)
+        "payday_window": (((day >= 15) & (day <= 15 + CALENDAR_PAYDAY_WINDOW_DAYS))
+                          | (day == days_in_month) | (day <= CALENDAR_PAYDAY_WINDOW_DAYS)).astype(float),
+        "school_in_session": calendar_windows(dates, CALENDAR_SCHOOL_TERMS),
+        "back_to_school": calendar_windows(dates, CALENDAR_BACK_TO_SCHOOL),
+        "weekday": weekday,
+        "month": month,
+        "is_weekend": (weekday >= 5).astype(float),
+        "weekday_indicators": np.eye(7, dtype=np.int8)[weekday],
+        "month_indicators": np.eye(12, dtype=np.int8)[month - 1]
+    }
+    nbytes = sum(v.nbytes for v in block.values() if v.dtype != object) + 64 * len(dates)
+    CALENDAR_CACHE.put(key, block, nbytes)
+    return block
+
+
+def calendar_features(dates):
+    """
+    Calendar feature arrays aligned with `dates` (any order, gaps allowed),
+    gathered from the cached yearly blocks
+    """
+    days = pd.to_datetime(pd.Series(dates)).to_numpy(dtype="datetime64[D]")
+    if len(days) == 0:
+        return {name: np.array([]) for name in ["ds"] + CALENDAR_REGRESSORS}
+    first = int(str(days.min())[:4])
+    last = int(str(days.max())[:4])
+    blocks = [calendar_year(year) for year in range(first, last + 1)]
+    offsets = (days - blocks[0]["ds"][0]).astype(np.int64)
+    return {name: (np.concatenate([b[name] for b in blocks]) if len(blocks) > 1 else blocks[0][name])[offsets]
+            for name in blocks[0]}
+
+
+def with_calendar(model, frame):
+    """`frame` plus the calendar regressor columns the model was built with"""
+    names = [name for name in model.extra_regressors if name in CALENDAR_REGRESSORS]
+    if not names:
+        return frame
+    features = calendar_features(frame['ds'])
+    return frame.assign(**{name: features[name] for name in names})
+
+
+CALENDAR_FACTOR_LABELS = {
+    "is_weekend": "Weekend Effect",
+    "holiday": "Philippine Holidays",
+    "payday_window": "Payday Window",
+    "school_in_session": "School in Session",
+    "back_to_school": "Back-to-School Season"
+}
+
+
+def calendar_effects(daily, features=None):
+    """
+    Demand on calendar-feature days vs the overall mean (impact, %) and the
+    feature's correlation with daily demand, one entry per feature
+    """
+    y = daily['y'].to_numpy(dtype=float)
+    features = features or calendar_features(daily['ds'])
+    avg = y.mean() if len(y) else 0.0
+    effects = []
+    for name, label in CALENDAR_FACTOR_LABELS.items():
+        flag = features[name] > 0
+        days = int(flag.sum())
+        if days == 0:
+            continue
+        impact = (y[flag].mean() - avg) / avg * 100 if avg > 0 else 0.0
+        varies = 0 < days < len(y) and y.std() > 0
+        effects.append({
+            "factor": label,
+            "feature": name,
+            "impact": round(float(impact), 2),
+            "correlation": round(float(np.corrcoef(flag, y)[0, 1]), 4) if varies else 0.0,
+            "days": days
+        })
+    return effects
+
+
+# Fitted Prophet models keyed by training series, parameters and seasonalities.
+# Kept in an LRU and, unless MODEL_CACHE_DIR is set empty, persisted as JSON.
+MODEL_CACHE_MAX_MB = float(os.environ.get("MODEL_CACHE_MAX_MB", 256))
+MODEL_CACHE = LRUCache("model cache", int(MODEL_CACHE_MAX_MB * 1024 * 1024))
+MODEL_CACHE_DIR = os.environ.get("MODEL_CACHE_DIR", os.path.join(os.path.dirname(__file__), "model", "cache"))
+
+# Extra seasonalities added to every /forecast model
+FORECAST_SEASONALITIES = [{"name": "monthly", "period": 30.5, "fourier_order": 5}]
+
+
+def series_fingerprint(df):
+    """Hash of a (ds, y) training series"""
+    h = hashlib.sha256()
+    h.update(df['ds'].to_numpy(dtype='datetime64[ns]').tobytes())
+    h.update(df['y'].to_numpy(dtype=float).tobytes())
+    return h.hexdigest()[:24]
+
+
+def model_config_key(params, seasonalities):
+    """Hash of the Prophet params + seasonalities (the model, minus its data)"""
+    payload = json.dumps({"params": params, "seasonalities": seasonalities}, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()[:24]
+
+
+def model_cache_key(df, params, seasonalities):
+    """Cache key of a fitted model: training series + Prophet params + seasonalities"""
+    payload = json.dumps({
+        "series": series_fingerprint(df),
+        "params": params,
+        "seasonalities": seasonalities
+    }, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()[:24]
+
+
+# Warm starts: when a series only gained days, the Stan optimizer starts from
+# the parameters of the cached fit of its longest cached prefix (same params
+# and seasonalities). Larger changes fall back to a cold fit.
+WARM_START_ENABLED = os.environ.get("PROPHET_WARM_START", "1") != "0"
+WARM_START_MAX_NEW_DAYS = 90
+WARM_START_MAX_NEW_FRACTION = 0.25
+WARM_START_MAX_SCALE_CHANGE = 0.2   # relative change of max |y| (Prophet's y scale)
+STAN_FIT_ARGS = {"save_iterations": True}  # lets stan_iterations() read the output CSV
+MODEL_LINEAGE = {}                  # (config key, first ds) -> fitted model keys
+MODEL_LINEAGE_LOCK = threading.Lock()
+MODEL_KEY_LOCKS = {}                # model key -> [lock, threads holding or waiting]
+MODEL_KEY_LOCKS_LOCK = threading.Lock()
+
+
+@contextmanager
+def model_key_lock(key, cancel=None):
+    """
+    Single flight per model key: held while that model is fitted or
+    evaluated, so concurrent identical requests (a /forecast call and a job
+    worker, say) wait for one fit instead of each running it. Waiting
+    checks `cancel` every FIT_POOL_POLL_SECONDS.
+    """
+    with MODEL_KEY_LOCKS_LOCK:
+        slot = MODEL_KEY_LOCKS.setdefault(key, [threading.RLock(), 0])
+        slot[1] += 1
+    try:
+        while not slot[0].acquire(timeout=FIT_POOL_POLL_SECONDS):
+            raise_if_cancelled(cancel)
+        try:
+            yield
+        finally:
+            slot[0].release()
+    finally:
+        with MODEL_KEY_LOCKS_LOCK:
+            slot[1] -= 1
+            if not slot[1]:
+                del MODEL_KEY_LOCKS[key]
+
+
+def stan_iterations(model):
+    """
+    Optimizer iterations of the last Prophet fit, counted from the rows of
+    CmdStan's optimizer output CSV (the fit must run with STAN_FIT_ARGS,
+    which saves every iteration; the first row is the initial point). The
+    parsed rows are released afterwards, since only the final parameters
+    are kept. None when the fit result is unavailable.
+    """
+    backend = getattr(model, "stan_backend", None)
+    fit = getattr(backend, "stan_fit", None)
+    saved = fit is not None and fit.metadata.cmdstan_config.get("save_iterations")
+    rows = fit.optimized_iterations_np if saved else None
+    if backend is not None:
+        backend.stan_fit = None
+    return max(len(rows) - 1, 0) if rows is not None else None
+
+
+def warm_start_init(model):
+    """Stan init values taken from a fitted model"""
+    return {
+        "k": float(model.params['k'][0][0]),
+        "m": float(model.params['m'][0][0]),
+        "sigma_obs": float(model.params['sigma_obs'][0][0]),
+        "delta": np.asarray(model.params['delta'][0], dtype=float),
+        "beta": np.asarray(model.params['beta'][0], dtype=float)
+    }
+
+
+def remember_lineage(entry):
+    lineage = (entry["config_key"], entry["first_ds"])
+    with MODEL_LINEAGE_LOCK:
+        keys = MODEL_LINEAGE.setdefault(lineage, [])
+        if entry["key"] not in keys:
+            keys.append(entry["key"])
+
+
+def lineage_candidates(config_key, first_ds):
+    """Cached model metadata sharing a config and start day (memory, then disk)"""
+    with MODEL_LINEAGE_LOCK:
+        keys = list(MODEL_LINEAGE.get((config_key, first_ds), []))
+    candidates = [entry for entry in (MODEL_CACHE.get(key) for key in keys) if entry is not None]
+    if candidates or not MODEL_CACHE_DIR or not os.path.isdir(MODEL_CACHE_DIR):
+        return candidates
+    for name in os.listdir(MODEL_CACHE_DIR):
+        if not name.endswith(".meta.json"):
+            continue
+        try:
+            with open(os.path.join(MODEL_CACHE_DIR, name)) as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            continue
+        if meta.get("config_key") == config_key and meta.get("first_ds") == first_ds:
+            candidates.append(meta)
+    return candidates
+
+
+def find_warm_start(df, params, seasonalities):
+    """
+    (previous entry, None) for the longest cached fit whose training series is
+    a prefix of `df`, or (None, reason) when a cold fit is needed.
+    """
+    if not WARM_START_ENABLED:
+        return None, "Warm starts disabled"
+    config_key = model_config_key(params, seasonalities)
+    first_ds = df['ds'].iloc[0].isoformat()
+    candidates = sorted(
+        (c for c in lineage_candidates(config_key, first_ds) if c.get("rows", 0) < len(df)),
+        key=lambda c: c["rows"], reverse=True
+    )
+    if not candidates:
+        return None, "No earlier fit of this series"
+
+    reason = None
+    y_max = float(df['y'].abs().max())
+    for candidate in candidates:
+        new_days = len(df) - candidate["rows"]
+        if new_days > WARM_START_MAX_NEW_DAYS or new_days > len(df) * WARM_START_MAX_NEW_FRACTION:
+            reason = reason or f"{new_days} new days since the last fit"
+            continue
+        if series_fingerprint(df.iloc[:candidate["rows"]]) != candidate["series_fingerprint"]:
+            reason = reason or "Earlier days changed since the last fit"
+            continue
+        if not candidate["y_max"] or abs(y_max / candidate["y_max"] - 1) > WARM_START_MAX_SCALE_CHANGE:
+            reason = reason or "Sales scale changed since the last fit"
+            continue
+        return candidate, None
+    return None, reason
+
+
+def build_prophet(params, seasonalities):
+    """
+    Unfitted Prophet model with the given params and extra seasonalities.
+    params["calendar"] lists calendar regressors to add (CALENDAR_REGRESSORS);
+    fit and predict frames get their columns from with_calendar().
+    """
+    params = dict(params)
+    regressors = params.pop("calendar", None) or []
+    model = Prophet(**params)
+    for seasonality in seasonalities:
+        model.add_seasonality(**seasonality)
+    for name in regressors:
+        model.add_regressor(name)
+    return model
+
+
+def model_cache_paths(key):
+    return (os.path.join(MODEL_CACHE_DIR, f"{key}.json"),
+            os.path.join(MODEL_CACHE_DIR, f"{key}.meta.json"))
+
+
+def persist_cached_model(entry):
+    """Write a cache entry (model JSON + metadata) to MODEL_CACHE_DIR"""
+    if not MODEL_CACHE_DIR:
+        return
+    model_path, meta_path = model_cache_paths(entry["key"])
+    try:
+        os.makedirs(MODEL_CACHE_DIR, exist_ok=True)
+        if not os.path.exists(model_path):
+            tmp_path = f"{model_path}.tmp-{os.getpid()}"
+            with open(tmp_path, "w") as f:
+                f.write(entry["model_json"])
+            os.replace(tmp_path, model_path)
+        meta = {k: v for k, v in entry.items() if k not in ("model", "model_json", "in_sample")}
+        tmp_path = f"{meta_path}.tmp-{os.getpid()}"
+        with open(tmp_path, "w") as f:
+            json.dump(meta, f, default=str)
+        os.replace(tmp_path, meta_path)
+    except OSError as e:
+        print(f"⚠ Model cache not persisted: {e}")
+
+
+def load_cached_model(key):
+    """Cache entry from MODEL_CACHE_DIR, or None"""
+    if not MODEL_CACHE_DIR:
+        return None
+    model_path, meta_path = model_cache_paths(key)
+    if not (os.path.exists(model_path) and os.path.exists(meta_path)):
+        return None
+    try:
+        with open(model_path) as f:
+            model_json = f.read()
+        with open(meta_path) as f:
+            meta = json.load(f)
+        return {**meta, "model": model_from_json(model_json), "model_json": model_json}
+    except Exception as e:
+        print(f"⚠ Ignoring unreadable cached model {key}: {e}")
+        return None
+
+
+def get_fitted_prophet(df, params, seasonalities=FORECAST_SEASONALITIES, cancel=None):
+    """
+    Fitted Prophet model for a training series, reusing a cached fit when the
+    series, params and seasonalities match. Returns (entry, source) where
+    source is "memory", "disk" or None (freshly fitted). The entry also
+    carries the model's evaluation once computed. Concurrent calls for the
+    same key fit once (see model_key_lock).
+    """
+    key = model_cache_key(df, params, seasonalities)
+    entry = MODEL_CACHE.get(key)
+    if entry is not None:
+        print(f"✓ Model cache hit ({key})")
+        return entry, "memory"
+
+    with model_key_lock(key, cancel):
+        entry = MODEL_CACHE.get(key)
+        if entry is not None:
+            print(f"✓ Model fitted by a concurrent request ({key})")
+            return entry, "memory"
+
+        entry = load_cached_model(key)
+        if entry is not None:
+            MODEL_CACHE.put(key, entry, len(entry["model_json"]))
+            if "config_key" in entry:
+                remember_lineage(entry)
+            print(f"✓ Model loaded from disk cache ({key})")
+            return entry, "disk"
+
+        previous, cold_reason = find_warm_start(df, params, seasonalities)
+        init = None
+        if previous is not None:
+            try:
+                previous_model = previous.get("model") or load_cached_model(previous["key"])["model"]
+                init = warm_start_init(previous_model)
+            except Exception as e:
+                previous, cold_reason = None, f"Earlier fit unusable: {e}"
+
+        print(f"Training Prophet model with optimized parameters ({'warm start' if init else 'cold start'})...")
+        start = time.perf_counter()
+        model = build_prophet(params, seasonalities)
+        try:
+            if init:
+                model.fit(with_calendar(model, df), init=init, **STAN_FIT_ARGS)
+            else:
+                model.fit(with_calendar(model, df), **STAN_FIT_ARGS)
+        except Exception as e:
+            if init is None:
+                raise
+            print(f"⚠ Warm start failed ({e}); refitting from cold")
+            previous, cold_reason, init = None, f"Warm start failed: {e}", None
+            model = build_prophet(params, seasonalities)
+            model.fit(with_calendar(model, df), **STAN_FIT_ARGS)
+        fit_seconds = time.perf_counter() - start
+        iterations = stan_iterations(model)
+        print(f"✓ Model training complete ({fit_seconds:.2f}s, {iterations} iterations)\n")
+
+        fit = {
+            "mode": "warm" if init else "cold",
+            "iterations": iterations,
+            "fit_seconds": round(fit_seconds, 3)
+        }
+        if previous is not None:
+            fit["warm_from"] = {
+                "key": previous["key"],
+                "new_days": len(df) - previous["rows"],
+                **{k: v for k, v in previous.get("fit", {}).items() if k in ("mode", "iterations", "fit_seconds")}
+            }
+        else:
+            fit["cold_reason"] = cold_reason
+
+        model_json = model_to_json(model)
+        entry = {
+            "key": key,
+            "model": model,
+            "model_json": model_json,
+            "params": params,
+            "seasonalities": seasonalities,
+            "config_key": model_config_key(params, seasonalities),
+            "series_fingerprint": series_fingerprint(df),
+            "first_ds": df['ds'].iloc[0].isoformat(),
+            "rows": len(df),
+            "y_max": float(df['y'].abs().max()),
+            "fit_seconds": round(fit_seconds, 3),
+            "fit": fit,
+            "created_at": pd.Timestamp.now().isoformat()
+        }
+        MODEL_CACHE.put(key, entry, len(model_json))
+        remember_lineage(entry)
+        persist_cached_model(entry)
+        return entry, None
+
+
+# One process pool shared by CV folds, tuning candidates and hierarchy
+# chunks, created on first use and kept for the life of the server. Workers
+# come from a forkserver (spawn where that is unavailable) rather than a fork
+# of this multi-threaded process, which can copy a lock held by another
+# thread into the child.
+FIT_POOL_WORKERS = int(os.environ.get("FIT_POOL_WORKERS", os.cpu_count() or 1))
+FIT_POOL_START_METHOD = os.environ.get("FIT_POOL_START_METHOD", "forkserver")
+FIT_POOL_POLL_SECONDS = 0.25      # how often a waiting caller checks for cancellation
+FIT_POOL = None
+FIT_POOL_LOCK = threading.Lock()
+
+
+def fit_pool():
+    """The shared fit process pool, created on first use"""
+    global FIT_POOL
+    with FIT_POOL_LOCK:
+        if FIT_POOL is None:
+            method = FIT_POOL_START_METHOD
+            if method not in multiprocessing.get_all_start_methods():
+                method = "spawn"
+            FIT_POOL = ProcessPoolExecutor(max_workers=FIT_POOL_WORKERS,
+                                           mp_context=multiprocessing.get_context(method))
+            print(f"✓ Fit pool started ({FIT_POOL_WORKERS} workers, {method})")
+        return FIT_POOL
+
+
+def discard_fit_pool(pool):
+    """Drop a broken pool so the next fit_pool() call starts a fresh one"""
+    global FIT_POOL
+    with FIT_POOL_LOCK:
+        if FIT_POOL is pool:
+            FIT_POOL = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+def raise_if_cancelled(cancel):
+    """Stop a forecast job between units of work once its cancel event is set"""
+    if cancel is not None and cancel.is_set():
+        raise ForecastJobCancelled()
+
+
+def gather_futures(futures, cancel=None):
+    """
+    Results of `futures` in order. If `cancel` is set while waiting, the
+    futures that have not started are cancelled and ForecastJobCancelled is
+    raised; ones already running finish in the background and are dropped.
+    """
+    pending = set(futures)
+    while pending:
+        _, pending = wait(pending, timeout=FIT_POOL_POLL_SECONDS, return_when=FIRST_COMPLETED)
+        if cancel is not None and cancel.is_set():
+            for future in pending:
+                future.cancel()
+            raise ForecastJobCancelled()
+    return [future.result() for future in futures]
+
+
+def fit_pool_map(fn, arg_lists, cancel=None):
+    """fn(*args) for every args on the shared fit pool, results in order"""
+    pool = fit_pool()
+    try:
+        return gather_futures([pool.submit(fn, *args) for args in arg_lists], cancel)
+    except BrokenProcessPool:
+        discard_fit_pool(pool)
+        raise
+
+
+# Cross-validation for the overfitting check. Cutoffs sit on a grid anchored
+# at the first day (first + initial, then every period), so appending days only
+# adds cutoffs at the end. A fold depends only on the data up to
+# cutoff + horizon, so folds are cached under a hash of that prefix together
+# with the params; appended datasets reuse every earlier fold.
+CV_INITIAL_DAYS = 60
+CV_PERIOD_DAYS = 15
+CV_HORIZON_DAYS = 30
+CV_PARALLEL = os.environ.get("CV_PARALLEL", "processes")  # processes | threads | none
+CV_WORKERS = int(os.environ.get("CV_WORKERS", os.cpu_count() or 1))
+CV_FOLD_CACHE_MAX_MB = float(os.environ.get("CV_FOLD_CACHE_MAX_MB", 64))
+CV_FOLD_CACHE = LRUCache("cv fold cache", int(CV_FOLD_CACHE_MAX_MB * 1024 * 1024))
+CV_FOLD_DIR = os.path.join(MODEL_CACHE_DIR, "cv") if MODEL_CACHE_DIR else ""
+
+
+def cv_cutoffs(ds, initial_days=CV_INITIAL_DAYS, period_days=CV_PERIOD_DAYS, horizon_days=CV_HORIZON_DAYS):
+    """Cutoff dates on the grid anchored at the first day of the series"""
+    start = ds.iloc[0] + pd.Timedelta(days=initial_days)
+    end = ds.iloc[-1] - pd.Timedelta(days=horizon_days)
+    if start > end:
+        return []
+    return list(pd.date_range(start, end, freq=f"{period_days}D"))
+
+
+def cv_fold_keys(df, cutoffs, params, seasonalities, horizon_days=CV_HORIZON_DAYS):
+    """
+    Cache key per cutoff: hash of the series prefix through cutoff + horizon,
+    the params, seasonalities, cutoff and horizon. Prefixes are hashed
+    incrementally, so this is a single pass over the series.
+    """
+    ds = df['ds'].to_numpy(dtype='datetime64[ns]')
+    y = df['y'].to_numpy(dtype=float)
+    ends = np.searchsorted(ds, np.array([c + pd.Timedelta(days=horizon_days) for c in cutoffs],
+                                        dtype='datetime64[ns]'), side='right')
+    config = json.dumps({"params": params, "seasonalities": seasonalities}, sort_keys=True, default=str)
+
+    ds_hash, y_hash = hashlib.sha256(), hashlib.sha256()
+    keys, position = [], 0
+    for cutoff, end in zip(cutoffs, ends):
+        ds_hash.update(ds[position:end].tobytes())
+        y_hash.update(y[position:end].tobytes())
+        position = end
+        payload = f"{ds_hash.copy().hexdigest()}|{y_hash.copy().hexdigest()}|{config}|{cutoff.isoformat()}|{horizon_days}"
+        keys.append(hashlib.sha256(payload.encode("utf-8")).hexdigest()[:24])
+    return keys
+
+
+def fit_cv_fold(history, params, seasonalities, cutoff, horizon_days=CV_HORIZON_DAYS):
+    """
+    One CV fold: fit on history up to the cutoff, predict the horizon after
+    it. Runs in worker processes, so it takes and returns plain frames.
+    """
+    train = history[history['ds'] <= cutoff]
+    test = history[(history['ds'] > cutoff) & (history['ds'] <= cutoff + pd.Timedelta(days=horizon_days))]
+    # Only yhat is scored, so skip the uncertainty sampling
+    model = build_prophet({**params, "uncertainty_samples": 0}, seasonalities)
+    model.fit(with_calendar(model, train))
+    yhat = model.predict(with_calendar(model, test[['ds']]))['yhat'].to_numpy()
+    return pd.DataFrame({
+        "ds": test['ds'].to_numpy(),
+        "yhat": yhat,
+        "y": test['y'].to_numpy(dtype=float),
+        "cutoff": cutoff
+    })
+
+
+def load_cv_fold(key):
+    """Cached fold from memory or CV_FOLD_DIR, or None"""
+    fold = CV_FOLD_CACHE.get(key)
+    if fold is not None or not CV_FOLD_DIR:
+        return fold
+    path = os.path.join(CV_FOLD_DIR, f"{key}.json")
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path) as f:
+            stored = json.load(f)
+        fold = pd.DataFrame({
+            "ds": pd.to_datetime(np.array(stored["ds"], dtype='int64')),
+            "yhat": np.array(stored["yhat"], dtype=float),
+            "y": np.array(stored["y"], dtype=float),
+            "cutoff": pd.Timestamp(stored["cutoff"])
+        })
+    except (OSError, ValueError, KeyError) as e:
+        print(f"⚠ Ignoring unreadable CV fold {key}: {e}")
+        return None
+    CV_FOLD_CACHE.put(key, fold, int(fold.memory_usage(index=False).sum()))
+    return fold
+
+
+def store_cv_fold(key, fold):
+    CV_FOLD_CACHE.put(key, fold, int(fold.memory_usage(index=False).sum()))
+    if not CV_FOLD_DIR:
+        return
+    path = os.path.join(CV_FOLD_DIR, f"{key}.json")
+    try:
+        os.makedirs(CV_FOLD_DIR, exist_ok=True)
+        tmp_path = f"{path}.tmp-{os.getpid()}"
+        with open(tmp_path, "w") as f:
+            json.dump({
+                "ds": fold['ds'].to_numpy(dtype='datetime64[ns]').astype('int64').tolist(),
+                "yhat": fold['yhat'].tolist(),
+                "y": fold['y'].tolist(),
+                "cutoff": fold['cutoff'].iloc[0].isoformat()
+            }, f)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        print(f"⚠ CV fold not persisted: {e}")
+
+
+def run_cv_folds(history, params, seasonalities, cutoffs, cancel=None):
+    """
+    Fit the given cutoffs, spread over a pool according to CV_PARALLEL.
+    `cancel` (a threading.Event) is checked between folds.
+    """
+    workers = min(CV_WORKERS, len(cutoffs))
+    if CV_PARALLEL == "processes":
+        workers = min(workers, FIT_POOL_WORKERS)
+    if CV_PARALLEL in ("processes", "threads") and workers > 1:
+        tasks = [(history, params, seasonalities, cutoff) for cutoff in cutoffs]
+        try:
+            if CV_PARALLEL == "processes":
+                return fit_pool_map(fit_cv_fold, tasks, cancel), CV_PARALLEL, workers
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                futures = [pool.submit(fit_cv_fold, *task) for task in tasks]
+                return gather_futures(futures, cancel), CV_PARALLEL, workers
+        except ForecastJobCancelled:
+            raise
+        except Exception as e:
+            print(f"⚠ Parallel cross-validation failed ({e}); running folds serially")
+    folds = []
+    for cutoff in cutoffs:
+        raise_if_cancelled(cancel)
+        folds.append(fit_cv_fold(history, params, seasonalities, cutoff))
+    return folds, "serial", 1
+
+
+def cross_validate_cached(prophet_df, params, seasonalities=FORECAST_SEASONALITIES, last=None, cancel=None):
+    """
+    Rolling-origin cross-validation over cv_cutoffs() (only the `last` ones if
+    given), reusing cached folds and fitting only the missing ones.
+    Returns (df_cv, run summary).
+    """
+    start = time.perf_counter()
+    history = prophet_df[['ds', 'y']].sort_values('ds').reset_index(drop=True)
+    cutoffs = cv_cutoffs(history['ds'])
+    if not cutoffs:
+        raise ValueError("Not enough history for a cross-validation cutoff")
+
+    keys = cv_fold_keys(history, cutoffs, params, seasonalities)
+    if last:
+        cutoffs, keys = cutoffs[-last:], keys[-last:]
+    folds = {key: load_cv_fold(key) for key in keys}
+    missing = [(key, cutoff) for key, cutoff in zip(keys, cutoffs) if folds[key] is None]
+
+    mode, workers = "cached", 0
+    if missing:
+        fitted, mode, workers = run_cv_folds(history, params, seasonalities, [c for _, c in missing], cancel)
+        for (key, _), fold in zip(missing, fitted):
+            store_cv_fold(key, fold)
+            folds[key] = fold
+
+    df_cv = pd.concat([folds[key] for key in keys], ignore_index=True)
+    summary = {
+        "folds": len(keys),
+        "cached_folds": len(keys) - len(missing),
+        "fitted_folds": len(missing),
+        "mode": mode,
+        "workers": workers,
+        "seconds": round(time.perf_counter() - start, 3)
+    }
+    print(f"✓ Cross-validation: {summary['folds']} folds "
+          f"({summary['cached_folds']} cached, {summary['fitted_folds']} fitted, {mode}) "
+          f"in {summary['seconds']:.2f}s")
+    return df_cv, summary
+
+
+# Vectorized baseline models. Each takes Y (series x days) and returns
+# (forecasts, fitted): forecasts has shape (origins x series x horizon), one
+# block per forecast origin (history length), and fitted holds the in-sample
+# one-step-ahead predictions (NaN during warm-up). All series are handled at
+# once, so a backtest over every CV cutoff costs a single pass.
+BASELINE_SEASON = 7
+MOVING_AVERAGE_WINDOW = 28
+HOLT_WINTERS_PARAMS = {"alpha": 0.2, "beta": 0.02, "gamma": 0.1, "phi": 0.98}
+FORECAST_MODELS = ["prophet", "auto", "seasonal_naive", "moving_average", "holt_winters"]
+
+# Model selection: Prophet is backtested on the last few CV folds and only
+# used when its MAE beats the best baseline by MODEL_SELECTION_MARGIN
+MODEL_SELECTION_FOLDS = 4
+MODEL_SELECTION_MARGIN = float(os.environ.get("MODEL_SELECTION_MARGIN", 0.05))
+
+
+def seasonal_naive_forecast(Y, horizon, origins, season=BASELINE_SEASON):
+    """Repeat the last full week"""
+    steps = np.arange(horizon) % season
+    forecasts = np.stack([Y[:, o - season:o][:, steps] for o in origins])
+    fitted = np.full(Y.shape, np.nan)
+    fitted[:, season:] = Y[:, :-season]
+    return forecasts, fitted
+
+
+def moving_average_forecast(Y, horizon, origins, window=MOVING_AVERAGE_WINDOW):
+    """Flat forecast at the trailing `window`-day mean"""
+    csum = np.concatenate([np.zeros((Y.shape[0], 1)), np.cumsum(Y, axis=1)], axis=1)
+    origins = np.asarray(origins)
+    starts = np.maximum(origins - window, 0)
+    means = (csum[:, origins] - csum[:, starts]) / (origins - starts)
+    forecasts = np.repeat(means.T[:, :, None], horizon, axis=2)
+    fitted = np.full(Y.shape, np.nan)
+    fitted[:, window:] = (csum[:, window:-1] - csum[:, :-window - 1]) / window
+    return forecasts, fitted
+
+
+def holt_winters_forecast(Y, horizon, origins, season=BASELINE_SEASON, alpha=0.2, beta=0.02, gamma=0.1, phi=0.98):
+    """
+    Additive Holt-Winters with a damped trend. One pass over time updates all
+    series together; the state is read off at each origin.
+    """
+    n, T = Y.shape
+    level = Y[:, :season].mean(axis=1)
+    trend = np.zeros(n)
+    seasonal = Y[:, :season] - level[:, None]
+    damping = np.cumsum(phi ** np.arange(1, horizon + 1))
+    steps = np.arange(horizon)
+
+    wanted = {int(o): i for i, o in enumerate(origins)}
+    forecasts = np.zeros((len(origins), n, horizon))
+    fitted = np.full(Y.shape, np.nan)
+    for t in range(T):
+        s = seasonal[:, t % season]
+        fitted[:, t] = level + phi * trend + s
+        new_level = alpha * (Y[:, t] - s) + (1 - alpha) * (level + phi * trend)
+        trend = beta * (new_level - level) + (1 - beta) * phi * trend
+        seasonal[:, t % season] = gamma * (Y[:, t] - new_level) + (1 - gamma) * s
+        level = new_level
+        if t + 1 in wanted:
+            forecasts[wanted[t + 1]] = (level[:, None] + damping[None, :] * trend[:, None]
+                                        + seasonal[:, (t + 1 + steps) % season])
+    fitted[:, :season] = np.nan
+    return forecasts, fitted
+
+
+BASELINE_MODELS = {
+    "seasonal_naive": seasonal_naive_forecast,
+    "moving_average": moving_average_forecast,
+    "holt_winters": lambda Y, horizon, origins: holt_winters_forecast(Y, horizon, origins, **HOLT_WINTERS_PARAMS)
+}
+
+
+def regular_daily_series(prophet_df):
+    """Daily (ds, y) on a gap-free calendar; missing days are interpolated"""
+    series = prophet_df.set_index('ds')['y'].astype(float).asfreq('D')
+    return series.interpolate(method='time').fillna(0.0)
+
+
+def backtest_baselines(series, cutoffs, horizon_days=CV_HORIZON_DAYS):
+    """
+    Backtest every baseline on the CV cutoffs. Returns {name: cv frame with
+    ds, yhat, y, cutoff} matching the Prophet fold layout.
+    """
+    y = series.to_numpy()
+    origins = [(cutoff - series.index[0]).days + 1 for cutoff in cutoffs]
+    actual_idx = np.array(origins)[:, None] + np.arange(horizon_days)[None, :]
+    valid = actual_idx < len(y)
+    frames = {}
+    for name, model in BASELINE_MODELS.items():
+        forecasts, _ = model(y[None, :], horizon_days, origins)
+        yhat = np.clip(forecasts[:, 0, :], 0, None)
+        frames[name] = pd.DataFrame({
+            "ds": series.index[actual_idx[valid]],
+            "yhat": yhat[valid],
+            "y": y[actual_idx[valid]],
+            "cutoff": np.repeat(np.array(cutoffs, dtype='datetime64[ns]'), valid.sum(axis=1))
+        })
+    return frames
+
+
+def baseline_forecast_result(series, name, forecast_days, interval_width, df_cv=None):
+    """
+    Prophet-shaped forecast frame (ds, yhat, yhat_lower, yhat_upper) for a
+    baseline: in-sample one-step fits plus the future horizon. Intervals come
+    from backtest error quantiles per horizon step, widened by sqrt(h / 30)
+    beyond the backtest horizon.
+    """
+    y = series.to_numpy()
+    forecasts, fitted = BASELINE_MODELS[name](y[None, :], forecast_days, [len(y)])
+    yhat = np.concatenate([fitted[0], forecasts[0, 0]])
+    dates = series.index.append(pd.date_range(series.index[-1] + pd.Timedelta(days=1), periods=forecast_days, freq='D'))
+
+    lower, upper = np.zeros(forecast_days), np.zeros(forecast_days)
+    if df_cv is not None and len(df_cv):
+        step = ((df_cv['ds'] - df_cv['cutoff']).dt.days - 1).to_numpy()
+        errors = (df_cv['y'] - df_cv['yhat']).to_numpy()
+        tail = (1 - interval_width) / 2
+        by_step = pd.DataFrame({"step": step, "error": errors}).groupby("step")["error"]
+        q_low = by_step.quantile(tail).to_numpy()
+        q_high = by_step.quantile(1 - tail).to_numpy()
+        h = np.arange(forecast_days)
+        idx = np.minimum(h, len(q_low) - 1)
+        scale = np.sqrt(np.maximum(h + 1, len(q_low)) / len(q_low))
+        lower, upper = q_low[idx] * scale, q_high[idx] * scale
+
+    return pd.DataFrame({
+        "ds": dates,
+        "yhat": yhat,
+        "yhat_lower": np.concatenate([fitted[0], forecasts[0, 0] + lower]),
+        "yhat_upper": np.concatenate([fitted[0], forecasts[0, 0] + upper])
+    })
+
+
+def cv_summary(df_cv):
+    metrics = calculate_metrics(df_cv['y'].values, df_cv['yhat'].values)
+    return {k: metrics[k] for k in ("mae", "rmse", "mape", "accuracy")}
+
+
+def select_forecast_model(prophet_df, params, mode, seasonalities=FORECAST_SEASONALITIES, cancel=None):
+    """
+    Backtest the baselines on the CV cutoffs and, in auto mode, Prophet on the
+    last MODEL_SELECTION_FOLDS of them (cached folds, reused by the full CV).
+    Returns the selection report; `chosen` is "prophet" or a baseline name.
+    """
+    start = time.perf_counter()
+    series = regular_daily_series(prophet_df)
+    cutoffs = cv_cutoffs(series.index.to_series())
+    report = {"mode": mode, "margin": MODEL_SELECTION_MARGIN, "candidates": {}}
+    if not cutoffs:
+        report.update(chosen="prophet" if mode == "auto" else mode, reason="Too little history to backtest",
+                      selection_seconds=round(time.perf_counter() - start, 3))
+        return report, series, {}
+
+    frames = backtest_baselines(series, cutoffs)
+    recent = set(cutoffs[-MODEL_SELECTION_FOLDS:])
+    for name, frame in frames.items():
+        report["candidates"][name] = {
+            "backtest": cv_summary(frame),
+            "recent": cv_summary(frame[frame['cutoff'].isin(recent)])
+        }
+    best = min(frames, key=lambda name: report["candidates"][name]["recent"]["mae"])
+    report["best_baseline"] = best
+    report["baseline_seconds"] = round(time.perf_counter() - start, 3)
+
+    if mode != "auto":
+        report.update(chosen=mode, reason="Requested explicitly")
+    else:
+        prophet_cv, prophet_run = cross_validate_cached(
+            prophet_df, params, seasonalities, last=MODEL_SELECTION_FOLDS, cancel=cancel
+        )
+        prophet_recent = cv_summary(prophet_cv)
+        report["candidates"]["prophet"] = {"recent": prophet_recent, "cv_run": prophet_run}
+        best_mae = report["candidates"][best]["recent"]["mae"]
+        if prophet_recent["mae"] < best_mae * (1 - MODEL_SELECTION_MARGIN):
+            report.update(chosen="prophet", reason=(
+                f"Prophet MAE {prophet_recent['mae']:,.2f} beats {best} {best_mae:,.2f} "
+                f"by more than {MODEL_SELECTION_MARGIN:.0%}"))
+        else:
+            report.update(chosen=best, reason=(
+                f"{best} MAE {best_mae:,.2f} is within {MODEL_SELECTION_MARGIN:.0%} of "
+                f"Prophet {prophet_recent['mae']:,.2f}"))
+        if prophet_run["fitted_folds"]:
+            report["prophet_fold_seconds"] = round(prophet_run["seconds"] / prophet_run["fitted_folds"], 3)
+
+    report["selection_seconds"] = round(time.perf_counter() - start, 3)
+    print(f"✓ Model selection ({mode}): {report['chosen']} - {report['reason']}")
+    return report, series, frames
+
+
+# Optional hyperparameter tuning (/forecast tune=1): a bounded grid over the
+# prior scales, seasonality mode and monthly Fourier order, scored on the most
+# recent CV folds with successive halving (each rung keeps the best third and
+# adds folds). Folds share the CV fold cache; the winner is cached per series.
+TUNING_GRID = {
+    "changepoint_prior_scale": [0.01, 0.05, 0.1, 0.5],
+    "seasonality_prior_scale": [0.1, 1.0, 10.0],
+    "seasonality_mode": ["additive", "multiplicative"],
+    "monthly_fourier_order": [3, 5, 8]
+}
+TUNING_RUNGS = [1, 3, 6]            # folds scored per rung, most recent first
+TUNING_KEEP_FRACTION = 1 / 3
+TUNING_WORKERS = int(os.environ.get("TUNING_WORKERS", os.cpu_count() or 1))
+TUNING_CACHE = LRUCache("tuning cache", 4 * 1024 * 1024)
+TUNING_DIR = os.path.join(MODEL_CACHE_DIR, "tuning") if MODEL_CACHE_DIR else ""
+
+
+def tuning_candidates(base_params):
+    """(params, seasonalities) per grid point, the heuristic choice first"""
+    candidates = [(base_params, FORECAST_SEASONALITIES)]
+    for cps in TUNING_GRID["changepoint_prior_scale"]:
+        for sps in TUNING_GRID["seasonality_prior_scale"]:
+            for mode in TUNING_GRID["seasonality_mode"]:
+                for order in TUNING_GRID["monthly_fourier_order"]:
+                    params = {**base_params, "changepoint_prior_scale": cps,
+                              "seasonality_prior_scale": sps, "seasonality_mode": mode}
+                    seasonalities = [{**FORECAST_SEASONALITIES[0], "fourier_order": order}]
+                    if (params, seasonalities) != candidates[0]:
+                        candidates.append((params, seasonalities))
+    return candidates
+
+
+def load_tuned_config(fingerprint):
+    tuned = TUNING_CACHE.get(fingerprint)
+    if tuned is not None or not TUNING_DIR:
+        return tuned
+    path = os.path.join(TUNING_DIR, f"{fingerprint}.json")
+    if os.path.exists(path):
+        try:
+            with open(path) as f:
+                tuned = json.load(f)
+            TUNING_CACHE.put(fingerprint, tuned, os.path.getsize(path))
+        except (OSError, ValueError) as e:
+            print(f"⚠ Ignoring unreadable tuning result {fingerprint}: {e}")
+    return tuned
+
+
+def store_tuned_config(fingerprint, tuned):
+    payload = json.dumps(tuned, default=str)
+    TUNING_CACHE.put(fingerprint, tuned, len(payload))
+    if not TUNING_DIR:
+        return
+    try:
+        os.makedirs(TUNING_DIR, exist_ok=True)
+        path = os.path.join(TUNING_DIR, f"{fingerprint}.json")
+        tmp_path = f"{path}.tmp-{os.getpid()}"
+        with open(tmp_path, "w") as f:
+            f.write(payload)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        print(f"⚠ Tuning result not persisted: {e}")
+
+
+def tune_prophet_params(prophet_df, base_params, cancel=None):
+    """
+    Best (params, seasonalities) for a series by rolling-origin MAE, plus a
+    report. Cached per series fingerprint, so repeat requests cost nothing.
+    `cancel` is checked between candidate fits.
+    """
+    fingerprint = series_fingerprint(prophet_df)
+    if base_params.get("calendar"):
+        fingerprint += "-calendar"
+    tuned = load_tuned_config(fingerprint)
+    if tuned is not None:
+        print(f"✓ Tuned parameters from cache ({fingerprint})")
+        return tuned["params"], tuned["seasonalities"], {**tuned["report"], "cached": True}
+
+    start = time.perf_counter()
+    history = prophet_df[['ds', 'y']].sort_values('ds').reset_index(drop=True)
+    cutoffs = cv_cutoffs(history['ds'])[-TUNING_RUNGS[-1]:][::-1]
+    if not cutoffs:
+        raise ValueError("Not enough history to tune (need at least 90 days)")
+
+    candidates = tuning_candidates(base_params)
+    alive = list(range(len(candidates)))
+    all_cutoffs = cv_cutoffs(history['ds'])
+    keys = {i: dict(zip(all_cutoffs, cv_fold_keys(history, all_cutoffs, *candidates[i]))) for i in alive}
+    folds_by = {i: {} for i in alive}     # candidate -> {cutoff: fold frame}
+    scores = {}                           # candidate -> (MAE, folds) at its last rung
+    rungs, fits = [], 0
+
+    print(f"\n{'='*60}")
+    print(f"HYPERPARAMETER TUNING ({len(candidates)} configurations)")
+    print(f"{'='*60}")
+    workers = max(1, min(TUNING_WORKERS, FIT_POOL_WORKERS, len(candidates)))
+    for rung, n_folds in enumerate(TUNING_RUNGS):
+        rung_start = time.perf_counter()
+        tasks = []
+        for i in alive:
+            for cutoff in cutoffs[:n_folds]:
+                if cutoff in folds_by[i]:
+                    continue
+                fold = load_cv_fold(keys[i][cutoff])
+                if fold is not None:
+                    folds_by[i][cutoff] = fold
+                else:
+                    tasks.append((i, cutoff))
+        if workers > 1:
+            results = fit_pool_map(fit_cv_fold, [(history, *candidates[i], cutoff) for i, cutoff in tasks], cancel)
+        else:
+            results = []
+            for i, cutoff in tasks:
+                raise_if_cancelled(cancel)
+                results.append(fit_cv_fold(history, *candidates[i], cutoff))
+        for (i, cutoff), fold in zip(tasks, results):
+            store_cv_fold(keys[i][cutoff], fold)
+            folds_by[i][cutoff] = fold
+        fits += len(tasks)
+
+        for i in alive:
+            folds = pd.concat([folds_by[i][c] for c in cutoffs[:n_folds]])
+            scores[i] = (float(np.abs(folds['y'] - folds['yhat']).mean()), n_folds)
+        ranked = sorted(alive, key=lambda i: scores[i][0])
+        rungs.append({
+            "folds": n_folds,
+            "configurations": len(alive),
+            "fits": len(tasks),
+            "best_mae": round(scores[ranked[0]][0], 2),
+            "seconds": round(time.perf_counter() - rung_start, 3)
+        })
+        print(f"  ✓ Rung {rung + 1}: {len(alive)} configs x {n_folds} folds "
+              f"({len(tasks)} fits), best MAE {scores[ranked[0]][0]:,.2f}")
+        # The heuristic choice always survives as the reference
+        alive = ranked[:max(1, int(np.ceil(len(ranked) * TUNING_KEEP_FRACTION)))]
+        if 0 not in alive:
+            alive.append(0)
+
+    best = min(alive, key=lambda i: scores[i][0])
+    params, seasonalities = candidates[best]
+    report = {
+        "cached": False,
+        "configurations": len(candidates),
+        "fits": fits,
+        "workers": workers,
+        "rungs": rungs,
+        "best": {
+            "changepoint_prior_scale": params["changepoint_prior_scale"],
+            "seasonality_prior_scale": params["seasonality_prior_scale"],
+            "seasonality_mode": params["seasonality_mode"],
+            "monthly_fourier_order": seasonalities[0]["fourier_order"],
+            "mae": round(scores[best][0], 2),
+            "folds": scores[best][1]
+        },
+        "heuristic": {"mae": round(scores[0][0], 2), "folds": scores[0][1]},
+        "seconds": round(time.perf_counter() - start, 3)
+    }
+    print(f"✓ Best: {report['best']} in {report['seconds']:.1f}s")
+    print(f"{'='*60}\n")
+    store_tuned_config(fingerprint, {"params": params, "seasonalities": seasonalities, "report": report})
+    return params, seasonalities, report
+
+
+# Prediction of future rows only. "sampled" keeps Prophet's simulated bounds
+# (uncertainty_samples draws, default the model's own); "analytic" uses a
+# closed-form normal approximation of the same trend + noise model; "none"
+# returns point forecasts.
+FORECAST_INTERVALS = ["sampled", "analytic", "none"]
+
+
+def future_dates(prophet_df, forecast_days, start=None):
+    """The days after the series (or from `start`) that a forecast response covers"""
+    start = start if start is not None else prophet_df['ds'].max() + pd.Timedelta(days=1)
+    return pd.DataFrame({"ds": pd.date_range(start, periods=forecast_days, freq='D')})
+
+
+def analytic_interval_sd(model, result):
+    """
+    Standard deviation of each predicted day under Prophet's uncertainty
+    model: observation noise plus future trend changes, which arrive at the
+    historical changepoint rate with Laplace(0, mean |delta|) slope shifts.
+    That gives a trend variance of S * 2 * lambda^2 * h^3 / 3 at h (scaled
+    time) past the history, where S is the number of changepoints.
+    """
+    # Scaled time as setup_dataframe computes it (which would also demand every regressor column)
+    t = ((pd.to_datetime(result['ds']) - model.start) / model.t_scale).to_numpy()
+    h = np.clip(t - model.history['t'].max(), 0, None)
+    rate = len(model.changepoints_t)
+    laplace_scale = float(np.mean(np.abs(model.params['delta']))) + 1e-8
+    trend_sd = np.sqrt(rate * 2 * laplace_scale ** 2 * h ** 3 / 3) * model.y_scale
+    if 'multiplicative_terms' in result:
+        trend_sd = trend_sd * np.abs(1 + result['multiplicative_terms'].to_numpy())
+    noise_sd = float(np.mean(model.params['sigma_obs'])) * model.y_scale
+    return np.sqrt(trend_sd ** 2 + noise_sd ** 2)
+
+
+def predict_future(model, future, intervals="sampled", uncertainty_samples=None):
+    """
+    Predict only the given rows, without mutating the (shared, cached) model.
+    Returns ds, yhat, yhat_lower, yhat_upper (+ Prophet's component columns).
+    """
+    samples = model.uncertainty_samples if uncertainty_samples is None else int(uncertainty_samples)
+    lean = copy.copy(model)
+    lean.uncertainty_samples = samples if intervals == "sampled" else 0
+    result = lean.predict(with_calendar(model, future))
+    if intervals == "analytic":
+        z = stats.norm.ppf(0.5 + model.interval_width / 2)
+        sd = analytic_interval_sd(model, result)
+        result['yhat_lower'] = result['yhat'] - z * sd
+        result['yhat_upper'] = result['yhat'] + z * sd
+    elif 'yhat_lower' not in result:
+        result['yhat_lower'] = result['yhat']
+        result['yhat_upper'] = result['yhat']
+    return result
+
+
+def in_sample_fit(model_entry):
+    """Point fit over the training days, computed once per cached model"""
+    if "in_sample" not in model_entry:
+        model = model_entry["model"]
+        model_entry["in_sample"] = predict_future(model, model.history[['ds']].copy(), "none")[
+            ['ds', 'yhat', 'yhat_lower', 'yhat_upper']
+        ]
+    return model_entry["in_sample"]
+
+
+def registry_compatibility(prophet_df, meta):
+    """
+    How a registered model relates to the dataset it is served against:
+    whether the dataset's rows over the model's training range hash to the
+    model's training fingerprint, and where the forecast starts. A model
+    trained past the dataset's last day forecasts from the day after its
+    own training end, since the days in between are already inside the fit.
+    """
+    dataset_end = prophet_df['ds'].max()
+    if not meta.get("training_end"):
+        return {"dataset_end": dataset_end.strftime("%Y-%m-%d"), "forecast_start": None,
+                "series_fingerprint_match": None, "warnings": ["Model has no recorded training range"]}
+    training_start, training_end = pd.Timestamp(meta["training_start"]), pd.Timestamp(meta["training_end"])
+    window = prophet_df[(prophet_df['ds'] >= training_start) & (prophet_df['ds'] <= training_end)][['ds', 'y']]
+    match = bool(len(window)) and series_fingerprint(window) == meta.get("series_fingerprint")
+    forecast_start = max(dataset_end, training_end) + pd.Timedelta(days=1)
+
+    warnings = []
+    if training_end > dataset_end:
+        warnings.append(
+            f"Model was trained through {training_end:%Y-%m-%d}, after the dataset's last day "
+            f"({dataset_end:%Y-%m-%d}); the forecast starts on {forecast_start:%Y-%m-%d}."
+        )
+    elif training_end < dataset_end:
+        warnings.append(
+            f"Dataset has {(dataset_end - training_end).days} days after the model's training end "
+            f"({training_end:%Y-%m-%d}) that the model has not seen; register a retrained model to use them."
+        )
+    if not match:
+        warnings.append("Dataset rows over the training range differ from the series the model was trained on.")
+    return {
+        "training_start": training_start.strftime("%Y-%m-%d"),
+        "training_end": training_end.strftime("%Y-%m-%d"),
+        "dataset_end": dataset_end.strftime("%Y-%m-%d"),
+        "forecast_start": forecast_start.strftime("%Y-%m-%d"),
+        "series_fingerprint_match": match,
+        "warnings": warnings
+    }
+
+
+def registered_model_evaluation(prophet_df, model, meta):
+    """
+    Evaluation for a registered model: its stored metrics, with the in-sample
+    fit recomputed on the days the model and the dataset share
+    """
+    evaluation = dict(meta.get("metrics") or {})
+    training_start, training_end = pd.Timestamp(meta["training_start"]), pd.Timestamp(meta["training_end"])
+    overlap = prophet_df[(prophet_df['ds'] >= training_start) & (prophet_df['ds'] <= training_end)][['ds', 'y']]
+    if len(overlap):
+        fitted = predict_future(model, overlap[['ds']].reset_index(drop=True), "none")
+        overlap = overlap.merge(fitted[['ds', 'yhat']], on='ds', how='inner')
+    else:
+        overlap = overlap.assign(yhat=np.nan)
+    evaluation['in_sample'] = calculate_metrics(overlap['y'].values, overlap['yhat'].values)
+    evaluation['registry_overlap_days'] = int(len(overlap))
+    return evaluation
+
+
+# /forecast response layouts. "full" is the original payload the dashboard
+# reads; "columnar" sends one dates array (history then forecast, split at
+# history_length) and one typed array per series, without None padding or
+# repeated series. `fields` projects either layout to a comma-separated list
+# of top-level keys or "key.subkey" entries (e.g. "series.yhat,metrics").
+FORECAST_RESPONSE_FORMATS = ["full", "columnar"]
+FORECAST_RESPONSE_SUMMARY = ["model_used", "monthly_total", "monthly_revenue", "forecast_days", "metrics",
+                             "evaluation", "insights", "model_params", "model_cache", "predict",
+                             "model_selection", "tuning", "registered_model", "registered"]
+FORECAST_RESPONSE_FIELDS = {
+    "full": ["forecast", "graph", "scenario_results", "decisions", "feature_importance",
+             "revenue_forecast"] + FORECAST_RESPONSE_SUMMARY,
+    "columnar": ["format", "dates", "history_length", "series"] + FORECAST_RESPONSE_SUMMARY
+}
+COLUMNAR_DECIMALS = int(os.environ.get("COLUMNAR_DECIMALS", 2))
+GZIP_MIN_BYTES = int(os.environ.get("GZIP_MIN_BYTES", 1024))
+GZIP_LEVEL = int(os.environ.get("GZIP_LEVEL", 6))
+
+
+def parse_response_fields(value, response_format):
+    """`fields` form value -> {top-level key: set of subkeys or None}; None means everything"""
+    if not value:
+        return None
+    fields = {}
+    for item in (part.strip() for part in value.split(",")):
+        if not item:
+            continue
+        key, _, sub = item.partition(".")
+        if key not in FORECAST_RESPONSE_FIELDS[response_format]:
+            raise ValueError(f"Unknown field '{key}' for the {response_format} format. "
+                             f"Use any of: {', '.join(FORECAST_RESPONSE_FIELDS[response_format])}")
+        if sub and fields.get(key, set()) is not None:
+            fields.setdefault(key, set()).add(sub)
+        else:
+            fields[key] = None
+    return fields or None
+
+
+def project_response(payload, fields):
+    """Keep only the requested keys (and subkeys) of a response payload"""
+    if fields is None:
+        return payload
+    projected = {}
+    for key, subkeys in fields.items():
+        value = payload.get(key)
+        if subkeys is not None:
+            if not isinstance(value, dict):
+                raise ValueError(f"Field '{key}' has no subfields")
+            unknown = subkeys - set(value)
+            if unknown:
+                raise ValueError(f"Unknown subfield(s) {', '.join(sorted(unknown))} of '{key}'. "
+                                 f"Use any of: {', '.join(value)}")
+            value = {sub: value[sub] for sub in value if sub in subkeys}
+        projected[key] = value
+    return projected
+
+
+def column_values(values, decimals=None):
+    """Float array -> JSON list (NaN becomes null), rounded in one NumPy pass"""
+    values = np.asarray(values, dtype=float)
+    if decimals is not None:
+        values = np.round(values, decimals)
+    if np.isnan(values).any():
+        return [None if np.isnan(v) else v for v in values.tolist()]
+    return values.tolist()
+
+
+def json_response(payload, status=200):
+    """
+    Compact JSON response, gzip-compressed when the client accepts it and
+    the body is at least GZIP_MIN_BYTES
+    """
+    body = json.dumps(payload, separators=(",", ":"), default=app.json.default).encode("utf-8")
+    response = app.response_class(body, status=status, mimetype="application/json")
+    response.vary.add("Accept-Encoding")
+    if len(body) >= GZIP_MIN_BYTES and "gzip" in request.accept_encodings:
+        response.set_data(gzip.compress(body, compresslevel=GZIP_LEVEL))
+        response.headers["Content-Encoding"] = "gzip"
+    return response
+
+
+# Base forecasts (future days only) of recent run_forecast calls, so event
+# overlays can be recomputed without another fit or predict
+BASE_FORECAST_CACHE_MAX_MB = float(os.environ.get("BASE_FORECAST_CACHE_MAX_MB", 64))
+BASE_FORECAST_CACHE = LRUCache("base forecast cache", int(BASE_FORECAST_CACHE_MAX_MB * 1024 * 1024))
+EVENT_OVERLAY_MAX_EVENTS = int(os.environ.get("EVENT_OVERLAY_MAX_EVENTS", 500))
+EVENT_IMPACT_TYPES = ["percent", "units"]
+
+
+def clamp_forecast_days(forecast_days):
+    """Requested horizon -> the 30..730 days a forecast covers"""
+    return max(30, min(int(forecast_days), 730))
+
+
+def base_forecast_key(dataset_id, forecast_days, model="prophet", tune=False, registry_model=None,
+                      intervals="sampled", uncertainty_samples=None, use_calendar=None, **_):
+    """Dataset + the run_forecast options that change the predicted values"""
+    options = [dataset_id, clamp_forecast_days(forecast_days), model, bool(tune), registry_model,
+               intervals, uncertainty_samples, bool(FORECAST_CALENDAR if use_calendar is None else use_calendar)]
+    return hashlib.sha256(json.dumps(options).encode("utf-8")).hexdigest()[:16]
+
+
+def parse_overlay_events(events):
+    """
+    Event dicts (the dashboard's shape: id, typeLabel, startDate, endDate,
+    impact in percent; or start/end/label and impact_type "units") ->
+    day-number arrays plus the normalized events
+    """
+    if not isinstance(events, list):
+        raise ValueError("events must be a list")
+    if len(events) > EVENT_OVERLAY_MAX_EVENTS:
+        raise ValueError(f"Too many events ({len(events)}); the limit is {EVENT_OVERLAY_MAX_EVENTS}")
+
+    parsed = []
+    for i, event in enumerate(events):
+        if not isinstance(event, dict):
+            raise ValueError(f"Event {i + 1} must be an object")
+        start = event.get("startDate") or event.get("start")
+        if not start:
+            raise ValueError(f"Event {i + 1} has no start date")
+        end = event.get("endDate") or event.get("end") or start
+        try:
+            start, end = pd.Timestamp(str(start)[:10]), pd.Timestamp(str(end)[:10])
+            impact = float(event.get("impact", 0))
+        except (TypeError, ValueError):
+            raise ValueError(f"Event {i + 1} has an invalid date or impact")
+        if end < start:
+            raise ValueError(f"Event {i + 1} ends before it starts")
+        impact_type = event.get("impact_type", "percent")
+        if impact_type not in EVENT_IMPACT_TYPES:
+            raise ValueError(f"Event {i + 1}: unknown impact_type '{impact_type}'. "
+                             f"Use one of: {', '.join(EVENT_IMPACT_TYPES)}")
+        event_id = event.get("id", i + 1)
+        label = event.get("typeLabel") or event.get("label") or event.get("type") or "event"
+        parsed.append({
+            "key": f"{label}_{event_id}",
+            "id": event_id,
+            "label": label,
+            "start": start.strftime("%Y-%m-%d"),
+            "end": end.strftime("%Y-%m-%d"),
+            "impact": impact,
+            "impact_type": impact_type
+        })
+
+    starts = np.array([e["start"] for e in parsed], dtype="datetime64[D]").astype(np.int64)
+    ends = np.array([e["end"] for e in parsed], dtype="datetime64[D]").astype(np.int64)
+    return parsed, starts, ends
+
+
+def apply_event_overlay(base, events):
+    """
+    Add dated event impacts to a cached base forecast. Every event is an
+    interval mask over the forecast days; percent impacts scale the (non-
+    negative) baseline, unit impacts add per day, and overlapping events add
+    up. Bounds shift with the total impact.
+    """
+    parsed, starts, ends = parse_overlay_events(events)
+    days = base["ds"].astype(np.int64)
+    baseline = np.maximum(base["yhat"], 0.0)
+
+    mask = (days[None, :] >= starts[:, None]) & (days[None, :] <= ends[:, None])
+    impacts = np.array([e["impact"] for e in parsed], dtype=float)
+    percent = np.array([e["impact_type"] == "percent" for e in parsed], dtype=bool)
+    per_day = np.where(percent[:, None], baseline[None, :] * (impacts / 100.0)[:, None], impacts[:, None])
+    contributions = np.where(mask, per_day, 0.0)
+    total_impact = contributions.sum(axis=0)
+
+    predicted = np.maximum(baseline + total_impact, 0.0)
+    for event, active, contribution in zip(parsed, mask.sum(axis=1), contributions.sum(axis=1)):
+        event["days_in_horizon"] = int(active)
+        event["total_units"] = round(float(contribution), COLUMNAR_DECIMALS)
+
+    return {
+        "dates": np.datetime_as_string(base["ds"], unit="D").tolist(),
+        "baseline": column_values(baseline, COLUMNAR_DECIMALS),
+        "predicted": column_values(predicted, COLUMNAR_DECIMALS),
+        "lower": column_values(np.maximum(base["yhat_lower"] + total_impact, 0.0), COLUMNAR_DECIMALS),
+        "upper": column_values(np.maximum(base["yhat_upper"] + total_impact, 0.0), COLUMNAR_DECIMALS),
+        "total_impact": column_values(total_impact, COLUMNAR_DECIMALS),
+        "contributions": {event["key"]: column_values(row, COLUMNAR_DECIMALS)
+                          for event, row in zip(parsed, contributions)},
+        "events": parsed,
+        "totals": {
+            "baseline": round(float(baseline.sum()), COLUMNAR_DECIMALS),
+            "predicted": round(float(predicted.sum()), COLUMNAR_DECIMALS),
+            "impact": round(float(predicted.sum() - baseline.sum()), COLUMNAR_DECIMALS)
+        },
+        "model_used": base["model_used"]
+    }
+
+
+def run_forecast(dataset, forecast_days, progress=None, model="prophet", tune=False,
+                 registry_model=None, register=None, intervals="sampled", uncertainty_samples=None,
+                 response_format="full", fields=None, use_calendar=FORECAST_CALENDAR, cancel=None):
+    """
+    Fit (or reuse) the Prophet model for a dataset and build the /forecast
+    payload. `model` is "prophet", "auto" (backtest the baselines and use
+    Prophet only if it wins by MODEL_SELECTION_MARGIN) or a baseline name;
+    `tune` grid-searches the Prophet params first (see tune_prophet_params).
+    `registry_model` ("name" or "name@version") serves a registered model
+    without training; `register` stores the fitted model under that name.
+    Only the future rows are predicted; `intervals` / `uncertainty_samples`
+    choose how their bounds are computed (see predict_future).
+    `response_format` / `fields` pick the payload layout and projection
+    (see FORECAST_RESPONSE_FORMATS). `use_calendar` adds the calendar feature
+    store's regressors (holidays, paydays, school windows) to Prophet.
+    `progress(stage)` is called as each stage starts (tune, select, fit,
+    predict, cv, insights); `cancel` (a threading.Event) is also checked
+    between CV folds and tuning candidates. Raises ValueError when the data
+    cannot be forecast.
+    """
+    progress = progress or (lambda stage: None)
+    forecast_days = clamp_forecast_days(forecast_days)
+    if model not in FORECAST_MODELS:
+        raise ValueError(f"Unknown model '{model}'. Use one of: {', '.join(FORECAST_MODELS)}")
+    if intervals not in FORECAST_INTERVALS:
+        raise ValueError(f"Unknown intervals '{intervals}'. Use one of: {', '.join(FORECAST_INTERVALS)}")
+    if response_format not in FORECAST_RESPONSE_FORMATS:
+        raise ValueError(f"Unknown format '{response_format}'. "
+                         f"Use one of: {', '.join(FORECAST_RESPONSE_FORMATS)}")
+    fields = parse_response_fields(fields, response_format)
+
+    # Parsed once per upload (see register_dataset)
+    prophet_df = dataset["daily"].copy()
+    
+    if prophet_df.empty:
+        raise ValueError("No valid data after cleaning")
+
+    # Remove duplicates and sort
+    prophet_df = prophet_df.drop_duplicates(subset=['ds'], keep='first')
+    prophet_df = prophet_df.sort_values('ds').reset_index(drop=True)
+    
+    # Data quality checks
+    print(f"\n{'='*60}")
+    print("DATA QUALITY REPORT")
+    print(f"{'='*60}")
+    print(f"Total records: {len(prophet_df)}")
+    print(f"Date range: {prophet_df['ds'].min().date()} to {prophet_df['ds'].max().date()}")
+    print(f"Time span: {(prophet_df['ds'].max() - prophet_df['ds'].min()).days} days")
+    print(f"\nTarget Variable Statistics:")
+    print(f"  Mean:     {prophet_df['y'].mean():>10.2f}")
+    print(f"  Median:   {prophet_df['y'].median():>10.2f}")
+    print(f"  Std Dev:  {prophet_df['y'].std():>10.2f}")
+    print(f"  Min:      {prophet_df['y'].min():>10.2f}")
+    print(f"  Max:      {prophet_df['y'].max():>10.2f}")
+    print(f"  Zeros:    {(prophet_df['y'] == 0).sum()} ({(prophet_df['y'] == 0).sum()/len(prophet_df)*100:.1f}%)")
+    print(f"{'='*60}\n")
+    
+    # Check for minimum data requirements
+    if len(prophet_df) < 30:
+        raise ValueError(f"Insufficient data for forecasting. Need at least 30 days, got {len(prophet_df)}")
+
+    seasonalities, tuning, selection, registered = FORECAST_SEASONALITIES, None, None, None
+    if registry_model:
+        # Registered model: no tuning, selection, training or CV
+        name, version = parse_model_ref(registry_model)
+        prophet_model, registered = MODEL_REGISTRY.load(name, version)
+        registered = {**registered, "compatibility": registry_compatibility(prophet_df, registered)}
+        for warning in registered["compatibility"]["warnings"]:
+            print(f"⚠ {registered['name']}@{registered['version']}: {warning}")
+        model_params = registered["params"]
+        chosen = "registry"
+    else:
+        # Get optimized parameters (heuristic, or grid-searched when tuning)
+        model_params = get_optimized_prophet_params(prophet_df)
+        if use_calendar:
+            model_params = {**model_params, "calendar": list(CALENDAR_REGRESSORS)}
+        if tune:
+            progress("tune")
+            model_params, seasonalities, tuning = tune_prophet_params(prophet_df, model_params, cancel)
+
+        # Backtest the baseline tier first unless Prophet was asked for
+        progress("select")
+        chosen = "prophet"
+        if model != "prophet":
+            selection, series, baseline_cv = select_forecast_model(prophet_df, model_params, model, seasonalities, cancel)
+            chosen = selection["chosen"]
+
+    if chosen == "registry":
+        progress("predict")
+        model_entry, cache_source = None, None
+        predict_start = time.perf_counter()
+        forecast_start = registered["compatibility"]["forecast_start"]
+        forecast_result = predict_future(
+            prophet_model,
+            future_dates(prophet_df, forecast_days, pd.Timestamp(forecast_start) if forecast_start else None),
+            intervals, uncertainty_samples
+        )
+        predict_seconds = time.perf_counter() - predict_start
+    elif chosen == "prophet":
+        # Train Prophet model (or reuse the cached fit for this series + params)
+        progress("fit")
+        model_entry, cache_source = get_fitted_prophet(prophet_df, model_params, seasonalities, cancel)
+        prophet_model = model_entry["model"]
+
+        # Generate forecast
+        progress("predict")
+        predict_start = time.perf_counter()
+        forecast_result = predict_future(
+            prophet_model, future_dates(prophet_df, forecast_days), intervals, uncertainty_samples
+        )
+        predict_seconds = time.perf_counter() - predict_start
+    else:
+        progress("predict")
+        model_entry = None
+        predict_start = time.perf_counter()
+        forecast_result = baseline_forecast_result(
+            series, chosen, forecast_days, model_params['interval_width'], baseline_cv.get(chosen)
+        )
+        predict_seconds = time.perf_counter() - predict_start
+
+    # Apply bounds
+    forecast_result['yhat'] = forecast_result['yhat'].clip(lower=0)
+    forecast_result['yhat_lower'] = forecast_result['yhat_lower'].clip(lower=0)
+    forecast_result['yhat_upper'] = forecast_result['yhat_upper'].clip(lower=0)
+
+    # Evaluate model performance (depends only on the fit, so cached with it)
+    progress("cv")
+    if chosen == "registry":
+        evaluation_results = registered_model_evaluation(prophet_df, prophet_model, registered)
+    elif model_entry is None:
+        evaluation_results = evaluate_model_performance(
+            prophet_df, None, forecast_result, baseline_cv=baseline_cv.get(chosen), cancel=cancel
+        )
+    else:
+        with model_key_lock(model_entry["key"], cancel):
+            if "evaluation" not in model_entry:
+                # In-sample rows come from the fit, not from another predict pass
+                model_entry["evaluation"] = evaluate_model_performance(
+                    prophet_df, prophet_model, in_sample_fit(model_entry), model_params, seasonalities,
+                    cancel=cancel
+                )
+                persist_cached_model(model_entry)
+        evaluation_results = model_entry["evaluation"]
+
+    registration = None
+    if register and model_entry is not None:
+        registration = MODEL_REGISTRY.register(register, model_entry["model_json"], {
+            **model_training_meta(prophet_model),
+            "params": model_params,
+            "seasonalities": seasonalities,
+            "metrics": evaluation_results,
+            "dataset_id": dataset["dataset_id"],
+            "model_cache_key": model_entry["key"],
+            "source": "forecast"
+        })
+
+    if selection is not None and chosen != "prophet" and "prophet_fold_seconds" in selection:
+        # Skipped: the full Prophet fit plus the remaining CV folds
+        folds = len(cv_cutoffs(prophet_df['ds']))
+        selection["time_saved_seconds"] = round(
+            selection["prophet_fold_seconds"] * (1 + max(folds - MODEL_SELECTION_FOLDS, 0)), 2
+        )
+
+    # Extract future forecast
+    future_forecast = forecast_result[forecast_result['ds'] > prophet_df['ds'].max()].head(forecast_days).copy()
+
+    # Prepare response data as arrays; the payload is built from these
+    history_ds = prophet_df['ds']
+    forecast_ds = future_forecast['ds']
+    forecast_values = np.nan_to_num(future_forecast['yhat'].to_numpy(dtype=float))
+    forecast_lower = np.nan_to_num(future_forecast['yhat_lower'].to_numpy(dtype=float))
+    forecast_upper = np.nan_to_num(future_forecast['yhat_upper'].to_numpy(dtype=float))
+    total_forecast = float(forecast_values.sum())
+
+    # Generate insights
+    progress("insights")
+    insights = None
+    if fields is None or "insights" in fields:
+        insights = generate_forecast_insights(
+            evaluation_results,
+            prophet_df,
+            future_forecast,
+            forecast_days
+        )
+
+    # Final metrics
+    final_metrics = evaluation_results.get('in_sample', {})
+    
+    print(f"\n{'='*60}")
+    print("FORECAST GENERATION COMPLETE")
+    print(f"{'='*60}")
+    print(f"✓ Generated {forecast_days}-day forecast")
+    print(f"✓ Model accuracy: {final_metrics.get('accuracy', 0):.2f}%")
+    print(f"✓ Total forecast demand: {total_forecast:,.0f} units")
+    print(f"{'='*60}\n")
+
+    # Calculate revenue metrics
+    forecast_revenue = np.zeros(len(forecast_values))
+    if 'revenue' in prophet_df.columns:
+        # Ensure revenue column is numeric
+        prophet_df['revenue'] = pd.to_numeric(prophet_df['revenue'], errors='coerce').fillna(0)
+        
+        total_revenue = float(prophet_df['revenue'].sum())
+        avg_daily_revenue = float(prophet_df['revenue'].mean())
+        
+        # Project revenue for forecast period (price book as of each date)
+        unit_prices = forecast_unit_prices(dataset, forecast_ds)
+        if unit_prices is not None:
+            forecast_revenue = future_forecast['yhat'].to_numpy(dtype=float) * unit_prices
+        elif total_revenue > 0 and prophet_df['y'].sum() > 0:
+            avg_price_per_unit = total_revenue / prophet_df['y'].sum()
+            forecast_revenue = future_forecast['yhat'].to_numpy(dtype=float) * avg_price_per_unit
+    else:
+        total_revenue = 0
+        avg_daily_revenue = 0
+
+    summary = {
+        "model_used": ("prophet_optimized" if chosen == "prophet"
+                       else f"registry:{registered['name']}@{registered['version']}" if chosen == "registry"
+                       else f"baseline_{chosen}"),
+        "monthly_total": total_forecast,
+        "monthly_revenue": float(forecast_revenue.sum()),
+        "forecast_days": forecast_days,
+        "metrics": {
+            **final_metrics,
+            "total_revenue": total_revenue,
+            "avg_daily_revenue": avg_daily_revenue,
+            "avg_price_per_unit": total_revenue / prophet_df['y'].sum() if prophet_df['y'].sum() > 0 else 0
+        },
+        "evaluation": evaluation_results,
+        "insights": insights,
+        "model_params": model_params,
+        "model_cache": {
+            "key": model_entry["key"],
+            "hit": cache_source is not None,
+            "source": cache_source,
+            "fit_seconds": model_entry["fit_seconds"],
+            "fit": model_entry.get("fit"),
+            "predict_seconds": round(predict_seconds, 3),
+            "cache": MODEL_CACHE.stats()
+        } if model_entry is not None else None,
+        "predict": {
+            "rows": int(len(forecast_result)),
+            "intervals": intervals if chosen in ("prophet", "registry") else "backtest_quantiles",
+            "uncertainty_samples": uncertainty_samples,
+            "seconds": round(predict_seconds, 3)
+        },
+        "model_selection": selection,
+        "tuning": tuning,
+        "registered_model": {k: v for k, v in registered.items() if k != "metrics"} if registered else None,
+        "registered": {"name": registration["name"], "version": registration["version"]} if registration else None
+    }
+
+    # Keep the base forecast for event overlays (/forecast/overlay)
+    base = {
+        "ds": forecast_ds.to_numpy(dtype="datetime64[D]"),
+        "yhat": forecast_values,
+        "yhat_lower": forecast_lower,
+        "yhat_upper": forecast_upper,
+        "model_used": summary["model_used"]
+    }
+    BASE_FORECAST_CACHE.put(
+        base_forecast_key(dataset["dataset_id"], forecast_days, model, tune, registry_model,
+                          intervals, uncertainty_samples, use_calendar),
+        base, sum(base[k].nbytes for k in ("ds", "yhat", "yhat_lower", "yhat_upper"))
+    )
+
+    if response_format == "columnar":
+        return project_response({
+            "format": "columnar",
+            "dates": history_ds.dt.strftime("%Y-%m-%d").tolist() + forecast_ds.dt.strftime("%Y-%m-%d").tolist(),
+            "history_length": int(len(history_ds)),
+            "series": {
+                "actual": column_values(prophet_df['y']),
+                "yhat": column_values(forecast_values, COLUMNAR_DECIMALS),
+                "yhat_lower": column_values(forecast_lower, COLUMNAR_DECIMALS),
+                "yhat_upper": column_values(forecast_upper, COLUMNAR_DECIMALS),
+                "revenue": column_values(forecast_revenue, COLUMNAR_DECIMALS)
+            },
+            **summary
+        }, fields)
+
+    # Full layout: history and forecast padded onto one date axis
+    history_pad = [None] * len(history_ds)
+    forecast_pad = [None] * len(forecast_ds)
+    predicted = forecast_values.tolist()
+    combined_predicted = history_pad + predicted
+    graph_series = {
+        "actual": prophet_df['y'].tolist() + forecast_pad,
+        "baseline": combined_predicted,
+        "base": combined_predicted,
+        "predicted": combined_predicted,
+        "lower_bound": history_pad + forecast_lower.tolist(),
+        "upper_bound": history_pad + forecast_upper.tolist()
+    }
+
+    # Forecast list (M/D/Y dates, clipped at zero)
+    mdy = (forecast_ds.dt.month.astype(str) + "/" + forecast_ds.dt.day.astype(str) + "/"
+           + forecast_ds.dt.year.astype(str)).tolist()
+    forecast_list = [
+        {"ds": ds, "pred": pred, "pred_lower": lower, "pred_upper": upper}
+        for ds, pred, lower, upper in zip(
+            mdy,
+            np.maximum(future_forecast['yhat'].to_numpy(dtype=float), 0.0).tolist(),
+            np.maximum(future_forecast['yhat_lower'].to_numpy(dtype=float), 0.0).tolist(),
+            np.maximum(future_forecast['yhat_upper'].to_numpy(dtype=float), 0.0).tolist()
+        )
+    ]
+
+    # Response payload including revenue data
+    return project_response({
+        "forecast": forecast_list,
+        "graph": {
+            "dates": history_ds.dt.strftime("%Y-%m-%d").tolist() + forecast_ds.dt.strftime("%Y-%m-%d").tolist(),
+            "series": graph_series
+        },
+        "scenario_results": {"base": predicted},
+        "decisions": [],
+        "feature_importance": None,
+        **summary,
+        "revenue_forecast": forecast_revenue.tolist()
+    }, fields)
+
+
+def registry_name(value):
+    """`register` form value -> registry model name (None when not registering)"""
+    if not value or value.lower() in ("0", "false", "no"):
+        return None
+    return DEFAULT_MODEL_NAME if value.lower() in ("1", "true", "yes") else value
+
+
+def forecast_options(form):
+    """run_forecast() keyword options from /forecast (or /forecast/jobs) form fields"""
+    samples = form.get("uncertainty_samples")
+    return {
+        "model": form.get("model", "prophet"),
+        "tune": form.get("tune", "").lower() in ("1", "true", "yes"),
+        "registry_model": form.get("registry_model") or None,
+        "register": registry_name(form.get("register")),
+        "intervals": form.get("intervals", "sampled"),
+        "uncertainty_samples": int(samples) if samples not in (None, "") else None,
+        "response_format": form.get("format", "full"),
+        "fields": form.get("fields") or None,
+        "use_calendar": (form.get("calendar").lower() not in ("0", "false", "no")
+                         if form.get("calendar") else FORECAST_CALENDAR)
+    }
+
+
+@app.route("/forecast", methods=["POST"])
+def forecast():
+    """
+    Enhanced forecast endpoint with automatic model evaluation and optimization
+    """
+    try:
+        dataset = get_request_dataset()
+        if dataset is None:
+            return dataset_missing_response()
+
+        return json_response(run_forecast(dataset, request.form.get("days", 30), **forecast_options(request.form)))
+
+    except Exception as e:
+        import traceback
         print(f"\n{'='*60}")
-        print("FORECAST GENERATION COMPLETE")
+        print("ERROR IN FORECAST")
         print(f"{'='*60}")
-        print(f"✓ Generated {forecast_days}-day forecast")
-        print(f"✓ Model accuracy: {final_metrics.get('accuracy', 0):.2f}%")
-        print(f"✓ Total forecast demand: {sum(forecast_values):,.0f} units")
+        print(f"{e}")
+        print(traceback.format_exc())
         print(f"{'='*60}\n")
+        return jsonify({"error": str(e)}), 400
+
+
+@app.route("/forecast/overlay", methods=["POST"])
+def forecast_overlay():
+    """
+    Apply dated events to the cached base forecast of a dataset.
+    JSON body: dataset_id, days, events and the /forecast options (model,
+    intervals, ...). The base forecast is computed once (as /forecast would)
+    and reused, so editing events costs no fit or predict.
+    Returns the adjusted series and each event's daily contribution.
+    """
+    try:
+        payload = request.get_json(silent=True)
+        if not payload or "events" not in payload:
+            return jsonify({"error": "Send JSON with dataset_id, days and events"}), 400
+        dataset_id = requested_dataset_id()
+        if not dataset_id:
+            return dataset_missing_response()
+
+        options = forecast_options({k: str(v) for k, v in payload.items() if isinstance(v, (str, int, float, bool))})
+        days = payload.get("days", 30)
+        key = base_forecast_key(dataset_id, days, **options)
+        start = time.perf_counter()
+        base = BASE_FORECAST_CACHE.get(key)
+        hit = base is not None
+        if not hit:
+            dataset = get_request_dataset()
+            if dataset is None:
+                return dataset_missing_response()
+            run_forecast(dataset, days, **{**options, "register": None, "response_format": "columnar",
+                                           "fields": "model_used"})
+            base = BASE_FORECAST_CACHE.get(key)
+        base_seconds = time.perf_counter() - start
+
+        overlay_start = time.perf_counter()
+        result = apply_event_overlay(base, payload["events"])
+        result["base_forecast"] = {
+            "key": key,
+            "hit": hit,
+            "seconds": round(base_seconds, 3),
+            "cache": BASE_FORECAST_CACHE.stats()
+        }
+        result["overlay_ms"] = round((time.perf_counter() - overlay_start) * 1000, 2)
+        return json_response(result)
+
+    except Exception as e:
+        import traceback
+        print(traceback.format_exc())
+        return jsonify({"error": str(e)}), 400
 
-        # Calculate revenue metrics
-        if 'revenue' in prophet_df.columns:
-            # Ensure revenue column is numeric
-            prophet_df['revenue'] = pd.to_numeric(prophet_df['revenue'], errors='coerce').fillna(0)
-            
-            total_revenue = float(prophet_df['revenue'].sum())
-            avg_daily_revenue = float(prophet_df['revenue'].mean())
-            
-            # Project revenue for forecast period
-            forecast_revenue = []
-            if total_revenue > 0 and prophet_df['y'].sum() > 0:
-                avg_price_per_unit = total_revenue / prophet_df['y'].sum()
-                for _, row in future_forecast.iterrows():
-                    forecast_revenue.append(float(row['yhat']) * avg_price_per_unit)
-            else:
-                forecast_revenue = [0] * len(forecast_values)
-        else:
-            total_revenue = 0
-            avg_daily_revenue = 0
-            forecast_revenue = [0] * len(forecast_values)
 
-        # Update the return jsonify to include revenue data
+@app.route("/models", methods=["GET"])
+def list_models():
+    """Registered models and their versions (metadata only, nothing is loaded)"""
+    try:
+        catalog = MODEL_REGISTRY.catalog()
         return jsonify({
-            "model_used": "prophet_optimized",
-            "forecast": forecast_list,
-            "graph": {"dates": combined_dates, "series": graph_series},
-            "scenario_results": {"base": forecast_values},
-            "decisions": [],
-            "feature_importance": None,
-            "monthly_total": float(sum(forecast_values)),
-            "monthly_revenue": sum(forecast_revenue),  # NEW
-            "forecast_days": forecast_days,
-            "metrics": {
-                **final_metrics,
-                "total_revenue": total_revenue,  # NEW
-                "avg_daily_revenue": avg_daily_revenue,  # NEW
-                "avg_price_per_unit": total_revenue / prophet_df['y'].sum() if prophet_df['y'].sum() > 0 else 0  # NEW
+            "models": {
+                name: [{k: v for k, v in meta.items() if k != "metrics"} for meta in versions]
+                for name, versions in catalog.items()
             },
-            "evaluation": evaluation_results,
-            "insights": insights,
-            "model_params": model_params,
-            "revenue_forecast": forecast_revenue  # NEW
+            "registry_dir": MODEL_REGISTRY_DIR
         })
+    except Exception as e:
+        import traceback
+        print(traceback.format_exc())
+        return jsonify({"error": str(e)}), 400
+
+
+@app.route("/models/<name>", methods=["GET"])
+def get_model(name):
+    """Metadata of one registered version (`version` query param, default latest)"""
+    try:
+        version = request.args.get("version")
+        return jsonify(MODEL_REGISTRY.meta(name, int(version) if version else None))
+    except LookupError as e:
+        return jsonify({"error": str(e)}), 404
+    except Exception as e:
+        return jsonify({"error": str(e)}), 400
+
 
+# Asynchronous forecast jobs. Work runs on a bounded thread pool; finished
+# jobs (done, failed or cancelled) are kept for FORECAST_JOB_TTL_SECONDS.
+FORECAST_JOB_WORKERS = int(os.environ.get("FORECAST_JOB_WORKERS", 2))
+FORECAST_JOB_MAX_PENDING = int(os.environ.get("FORECAST_JOB_MAX_PENDING", 16))
+FORECAST_JOB_TTL_SECONDS = float(os.environ.get("FORECAST_JOB_TTL_SECONDS", 3600))
+FORECAST_JOB_STAGES = ["parse", "tune", "select", "fit", "predict", "cv", "insights"]
+FORECAST_JOB_ACTIVE = ("queued", "running", "cancelling")
+FORECAST_JOB_EXECUTOR = ThreadPoolExecutor(max_workers=FORECAST_JOB_WORKERS, thread_name_prefix="forecast-job")
+FORECAST_JOBS = {}
+FORECAST_JOBS_LOCK = threading.Lock()
+
+
+class ForecastJobCancelled(Exception):
+    """Raised inside a running job when it has been cancelled"""
+
+
+def purge_forecast_jobs():
+    """Drop finished jobs whose results have outlived the TTL"""
+    now = time.time()
+    with FORECAST_JOBS_LOCK:
+        expired = [job_id for job_id, job in FORECAST_JOBS.items()
+                   if job["finished_at"] is not None and now - job["finished_at"] > FORECAST_JOB_TTL_SECONDS]
+        for job_id in expired:
+            del FORECAST_JOBS[job_id]
+    return len(expired)
+
+
+def forecast_job_progress(job, stage):
+    """Mark `stage` as started; stops the job here if it was cancelled"""
+    if job["cancel"].is_set():
+        raise ForecastJobCancelled()
+    now = time.time()
+    with FORECAST_JOBS_LOCK:
+        for entry in job["stages"]:
+            if entry["status"] == "running":
+                entry["status"] = "done"
+                entry["seconds"] = round(now - entry["started_at"], 3)
+        for entry in job["stages"]:
+            if entry["name"] == stage:
+                entry["status"] = "running"
+                entry["started_at"] = now
+        job["stage"] = stage
+
+
+def new_forecast_job(kind, stages, dataset_id, days, options):
+    """Job record in the queued state (register it in FORECAST_JOBS under the lock)"""
+    return {
+        "job_id": uuid.uuid4().hex,
+        "kind": kind,
+        "status": "queued",
+        "stage": None,
+        "stages": [{"name": name, "status": "pending", "seconds": None} for name in stages],
+        "dataset_id": dataset_id,
+        "days": days,
+        "options": options,
+        "created_at": time.time(),
+        "started_at": None,
+        "finished_at": None,
+        "result": None,
+        "error": None,
+        "cancel": threading.Event()
+    }
 
+
+def run_forecast_job(job, dataset, upload):
+    """Parse the upload if needed, then run the forecast"""
+    forecast_job_progress(job, "parse")
+    if dataset is None:
+        dataset, _ = register_dataset(*upload)
+        dataset = reprice_dataset(dataset)
+        job["dataset_id"] = dataset["dataset_id"]
+    return run_forecast(dataset, job["days"], lambda stage: forecast_job_progress(job, stage),
+                        cancel=job["cancel"], **job["options"])
+
+
+def run_job(job, work):
+    """Executor body for every job kind: run `work()` and record the outcome"""
+    with FORECAST_JOBS_LOCK:
+        if job["status"] != "queued":
+            return
+        job["status"] = "running"
+        job["started_at"] = time.time()
+    try:
+        result = work()
+        forecast_job_progress(job, None)
+        status, error = "done", None
+    except ForecastJobCancelled:
+        result, status, error = None, "cancelled", None
+        print(f"⚠ {job['kind'].capitalize()} job {job['job_id']} cancelled")
     except Exception as e:
         import traceback
         print(f"\n{'='*60}")
-        print("ERROR IN FORECAST")
+        print(f"ERROR IN {job['kind'].upper()} JOB {job['job_id']}")
         print(f"{'='*60}")
-        print(f"{e}")
         print(traceback.format_exc())
-        print(f"{'='*60}\n")
+        result, status, error = None, "failed", str(e)
+
+    now = time.time()
+    with FORECAST_JOBS_LOCK:
+        for entry in job["stages"]:
+            if entry["status"] == "running":
+                entry["status"] = "cancelled" if status == "cancelled" else status
+                entry["seconds"] = round(now - entry["started_at"], 3)
+            elif entry["status"] == "pending" and status == "done":
+                entry["status"] = "skipped"
+        job.update(status=status, result=result, error=error, finished_at=now)
+
+
+def forecast_job_view(job, include_result=True):
+    """JSON-safe view of a job"""
+    stages = [{k: v for k, v in entry.items() if k != "started_at"} for entry in job["stages"]]
+    done = sum(entry["status"] == "done" for entry in job["stages"])
+    view = {
+        "job_id": job["job_id"],
+        "kind": job["kind"],
+        "status": job["status"],
+        "stage": job["stage"],
+        "stages": stages,
+        "progress": round(done / len(stages), 2),
+        "dataset_id": job["dataset_id"],
+        "days": job["days"],
+        "options": job["options"],
+        "created_at": job["created_at"],
+        "started_at": job["started_at"],
+        "finished_at": job["finished_at"],
+        "error": job["error"],
+        "cancel_requested": job["cancel"].is_set()
+    }
+    if job["finished_at"] is not None:
+        view["expires_at"] = job["finished_at"] + FORECAST_JOB_TTL_SECONDS
+    if include_result and job["status"] == "done":
+        view["result"] = job["result"]
+    return view
+
+
+@app.route("/forecast/jobs", methods=["POST"])
+def create_forecast_job():
+    """
+    Queue a forecast and return its job_id immediately.
+    Takes the same inputs as /forecast (dataset_id or file, days).
+    """
+    try:
+        purge_forecast_jobs()
+        dataset, upload = None, None
+        if requested_dataset_id():
+            dataset = get_request_dataset()
+            if dataset is None:
+                return dataset_missing_response()
+        elif "file" in request.files:
+            file = request.files["file"]
+            upload = (file.read(), file.filename)
+        else:
+            return dataset_missing_response()
+
+        with FORECAST_JOBS_LOCK:
+            pending = sum(job["status"] in FORECAST_JOB_ACTIVE for job in FORECAST_JOBS.values())
+            if pending >= FORECAST_JOB_MAX_PENDING:
+                return jsonify({
+                    "error": f"Too many forecast jobs in progress ({pending}). Try again later."
+                }), 429
+
+            job = new_forecast_job(
+                "forecast", FORECAST_JOB_STAGES,
+                dataset["dataset_id"] if dataset is not None else None,
+                int(request.form.get("days", 30)), forecast_options(request.form)
+            )
+            job_id = job["job_id"]
+            FORECAST_JOBS[job_id] = job
+
+        job["future"] = FORECAST_JOB_EXECUTOR.submit(run_job, job, lambda: run_forecast_job(job, dataset, upload))
+        print(f"✓ Forecast job {job_id} queued")
+
+        response = forecast_job_view(job, include_result=False)
+        response["status_url"] = f"/forecast/jobs/{job_id}"
+        return jsonify(response), 202
+
+    except Exception as e:
+        import traceback
+        print(traceback.format_exc())
+        return jsonify({"error": str(e)}), 400
+
+
+@app.route("/forecast/jobs", methods=["GET"])
+def list_forecast_jobs():
+    """Known forecast and hierarchy jobs, without results"""
+    purge_forecast_jobs()
+    with FORECAST_JOBS_LOCK:
+        jobs = [forecast_job_view(job, include_result=False) for job in FORECAST_JOBS.values()]
+    return jsonify({
+        "jobs": sorted(jobs, key=lambda job: job["created_at"], reverse=True),
+        "workers": FORECAST_JOB_WORKERS,
+        "max_pending": FORECAST_JOB_MAX_PENDING,
+        "ttl_seconds": FORECAST_JOB_TTL_SECONDS
+    })
+
+
+@app.route("/forecast/jobs/<job_id>", methods=["GET"])
+def get_forecast_job(job_id):
+    """Status and per-stage progress of a job; includes the result once done"""
+    purge_forecast_jobs()
+    job = FORECAST_JOBS.get(job_id)
+    if job is None:
+        return jsonify({"error": f"Unknown or expired forecast job '{job_id}'"}), 404
+    with FORECAST_JOBS_LOCK:
+        return json_response(forecast_job_view(job))
+
+
+@app.route("/forecast/jobs/<job_id>/cancel", methods=["POST"])
+def cancel_forecast_job(job_id):
+    """
+    Cancel a job. Queued jobs never start; running jobs report "cancelling"
+    and stop at the next stage, CV fold or tuning candidate (fits that are
+    already running in the pool finish but are discarded).
+    """
+    job = FORECAST_JOBS.get(job_id)
+    if job is None:
+        return jsonify({"error": f"Unknown or expired forecast job '{job_id}'"}), 404
+
+    job["cancel"].set()
+    with FORECAST_JOBS_LOCK:
+        if job["status"] == "queued":
+            if job.get("future") is not None:
+                job["future"].cancel()
+            job.update(status="cancelled", finished_at=time.time())
+        elif job["status"] == "running":
+            job["status"] = "cancelling"
+        view = forecast_job_view(job, include_result=False)
+    print(f"✓ Forecast job {job_id} cancellation requested ({view['status']})")
+    return jsonify(view)
+
+
+# Hierarchical forecasts: total, category, brand, SKU, outlet and the bottom
+# outlet x SKU series, fitted level by level over a process pool and then
+# reconciled so every level adds up. Base forecasts are cached per dataset,
+# scope and horizon, so switching the reconciliation method does not refit;
+# a cache miss is built as a job on FORECAST_JOB_EXECUTOR with one progress
+# stage per level.
+HIERARCHY_WORKERS = int(os.environ.get("HIERARCHY_WORKERS", os.cpu_count() or 1))
+HIERARCHY_MIN_NONZERO_DAYS = 30      # sparser series get a flat recent-mean forecast
+HIERARCHY_RECENT_DAYS = 28
+HIERARCHY_LEVELS = ["total", "category", "brand", "sku", "outlet", "outlet_sku"]
+HIERARCHY_JOB_STAGES = ["structure"] + HIERARCHY_LEVELS + ["reconcile"]
+RECONCILIATION_METHODS = ["bottom_up", "top_down", "ols", "wls"]
+HIERARCHY_CACHE_MAX_MB = float(os.environ.get("HIERARCHY_CACHE_MAX_MB", 128))
+HIERARCHY_CACHE = LRUCache("hierarchy cache", int(HIERARCHY_CACHE_MAX_MB * 1024 * 1024))
+UNASSIGNED_OUTLET = "Unassigned"
+
+
+def hierarchy_bottom_series(dataset, outlets=None, skus=None):
+    """
+    Daily units per active outlet x SKU pair: (days x pairs) matrix plus the
+    pair outlet and SKU names. Rows without an outlet go to UNASSIGNED_OUTLET.
+    """
+    compact = dataset_compact(dataset)
+    cube = dataset["aggregates"]["cube"]
+    outlet_names = list(compact["outlets"]) + [UNASSIGNED_OUTLET]
+    sku_names = list(compact["skus"])
+    n_skus = len(sku_names)
+
+    units = sparse.csr_matrix(cube["day_outlet_sku"]).multiply(compact["case_qty"]).tocoo()
+    slots = np.where(cube["pair_outlets"] >= 0, cube["pair_outlets"], len(outlet_names) - 1)
+    day_pos = np.searchsorted(cube["day_index"], cube["pair_days"])
+    pairs = slots[units.row].astype(np.int64) * n_skus + units.col
+    pair_ids, columns = np.unique(pairs, return_inverse=True)
+    matrix = np.zeros((len(cube["day_index"]), len(pair_ids)))
+    np.add.at(matrix, (day_pos[units.row], columns), units.data)
+
+    pair_outlets = np.array(outlet_names, dtype=object)[pair_ids // n_skus]
+    pair_skus = np.array(sku_names, dtype=object)[pair_ids % n_skus]
+    keep = matrix.sum(axis=0) > 0
+    for names, wanted, label in ((pair_outlets, outlets, "outlet"), (pair_skus, skus, "SKU")):
+        if wanted:
+            unknown = [name for name in wanted if name not in set(names)]
+            if unknown:
+                raise ValueError(f"Unknown {label}(s): {', '.join(unknown)}")
+            keep &= np.isin(names, wanted)
+    return matrix[:, keep], pair_outlets[keep], pair_skus[keep]
+
+
+def hierarchy_structure(pair_outlets, pair_skus):
+    """
+    Level list [(level, names, codes)] over the bottom pairs and the summing
+    matrix S (all series x bottom pairs), rows in level order
+    """
+    attributes = {
+        "total": np.full(len(pair_skus), "Total", dtype=object),
+        "category": np.array([SKU_METADATA.get(sku, UNKNOWN_SKU)['category'] for sku in pair_skus], dtype=object),
+        "brand": np.array([SKU_METADATA.get(sku, UNKNOWN_SKU)['brand'] for sku in pair_skus], dtype=object),
+        "sku": pair_skus,
+        "outlet": pair_outlets,
+        "outlet_sku": np.array([f"{o} | {k}" for o, k in zip(pair_outlets, pair_skus)], dtype=object)
+    }
+    levels, blocks = [], []
+    for level in HIERARCHY_LEVELS:
+        codes, names = pd.factorize(attributes[level])
+        levels.append((level, list(names), codes))
+        blocks.append(indicator_matrix(codes, len(names)))
+    return levels, sparse.vstack(blocks).tocsr()
+
+
+def fit_hierarchy_chunk(dates, history, params, seasonalities, horizon):
+    """
+    Point forecasts for a block of series (days x k history) over `horizon`
+    days. Runs in worker processes. Returns (k x horizon, prophet fit count).
+    """
+    future = pd.DataFrame({"ds": pd.date_range(dates[-1] + pd.Timedelta(days=1), periods=horizon, freq='D')})
+    forecasts = np.zeros((history.shape[1], horizon))
+    # Rows are days with sales only, so the fallback averages calendar days
+    # (a day with no row sold nothing) rather than the last rows
+    window = min(HIERARCHY_RECENT_DAYS, (dates[-1] - dates[0]).days + 1) if len(dates) else 0
+    recent = dates > dates[-1] - pd.Timedelta(days=window) if len(dates) else np.zeros(0, bool)
+    fits = 0
+    for j in range(history.shape[1]):
+        y = history[:, j]
+        if np.count_nonzero(y) < HIERARCHY_MIN_NONZERO_DAYS:
+            forecasts[j] = y[recent].sum() / window if window else 0.0
+            continue
+        model = build_prophet({**params, "uncertainty_samples": 0}, seasonalities)
+        model.fit(with_calendar(model, pd.DataFrame({"ds": dates, "y": y})))
+        forecasts[j] = model.predict(with_calendar(model, future))['yhat'].to_numpy()
+        fits += 1
+    return np.clip(forecasts, 0, None), fits
+
+
+def fit_hierarchy_levels(dates, series, level_slices, params, seasonalities, horizon,
+                         progress=None, cancel=None):
+    """
+    Base forecasts for every series (days x n history), level by level over
+    the shared fit pool. Returns the (n x horizon) forecasts and per-level timings.
+    `progress(level)` is called as each level starts; `cancel` is checked
+    between chunks.
+    """
+    progress = progress or (lambda stage: None)
+    workers = max(1, min(HIERARCHY_WORKERS, FIT_POOL_WORKERS, series.shape[1]))
+    forecasts = np.zeros((series.shape[1], horizon))
+    timings = {}
+    for level, rows in level_slices:
+        progress(level)
+        start = time.perf_counter()
+        count = rows.stop - rows.start
+        chunk = max(1, -(-count // (workers * 4)))
+        bounds = [(lo, min(lo + chunk, rows.stop)) for lo in range(rows.start, rows.stop, chunk)]
+        if workers > 1:
+            results = fit_pool_map(fit_hierarchy_chunk, [(dates, series[:, lo:hi], params, seasonalities, horizon)
+                                                         for lo, hi in bounds], cancel)
+        else:
+            results = []
+            for lo, hi in bounds:
+                raise_if_cancelled(cancel)
+                results.append(fit_hierarchy_chunk(dates, series[:, lo:hi], params, seasonalities, horizon))
+        fits = 0
+        for (lo, hi), (block, block_fits) in zip(bounds, results):
+            forecasts[lo:hi] = block
+            fits += block_fits
+        timings[level] = {
+            "series": count,
+            "prophet_fits": fits,
+            "fallback_fits": count - fits,
+            "seconds": round(time.perf_counter() - start, 3)
+        }
+        print(f"  ✓ {level}: {count} series ({fits} Prophet fits) in {timings[level]['seconds']:.2f}s")
+    return forecasts, timings, workers
+
+
+def reconcile_forecasts(S, base, method, proportions):
+    """
+    Coherent forecasts for all series from base forecasts (series x horizon).
+    bottom_up keeps the bottom level, top_down splits the total by historical
+    proportions, ols / wls project onto the coherent subspace (wls weights
+    each series by the number of bottom series it sums). Reconciled bottom
+    forecasts are clipped at zero before aggregating, so results stay coherent.
+    """
+    n_bottom = S.shape[1]
+    if method == "bottom_up":
+        bottom = base[-n_bottom:]
+    elif method == "top_down":
+        bottom = proportions[:, None] * base[0][None, :]
+    elif method in ("ols", "wls"):
+        weights = 1.0 / np.asarray(S.sum(axis=1)).ravel() if method == "wls" else np.ones(S.shape[0])
+        St_W = S.T.multiply(weights).tocsr()
+        gram = (St_W @ S).toarray()
+        bottom = np.linalg.solve(gram, St_W @ base)
+    else:
+        raise ValueError(f"Unknown reconciliation method '{method}'. Use one of: {', '.join(RECONCILIATION_METHODS)}")
+    bottom = np.clip(bottom, 0, None)
+    return S @ bottom
+
+
+def hierarchy_cache_key(dataset, horizon, outlets=None, skus=None):
+    return (dataset["dataset_id"], horizon, tuple(outlets or ()), tuple(skus or ()))
+
+
+def hierarchy_base_forecasts(dataset, horizon, outlets=None, skus=None, progress=None, cancel=None):
+    """
+    Cached base forecasts, structure and history for a dataset scope.
+    `progress` / `cancel` are passed to fit_hierarchy_levels on a cache miss.
+    """
+    key = hierarchy_cache_key(dataset, horizon, outlets, skus)
+    cached = HIERARCHY_CACHE.get(key)
+    if cached is not None:
+        print("✓ Hierarchy base forecasts from cache")
+        return cached, True
+
+    if progress is not None:
+        progress("structure")
+    bottom, pair_outlets, pair_skus = hierarchy_bottom_series(dataset, outlets, skus)
+    if bottom.shape[1] == 0:
+        raise ValueError("No sales in the selected outlets/SKUs")
+    dates = pd.DatetimeIndex(dataset["aggregates"]["calendar"]['date'])
+    levels, S = hierarchy_structure(pair_outlets, pair_skus)
+    series = np.asarray((S @ bottom.T).T)
+
+    total = pd.DataFrame({"ds": dates, "y": series[:, 0]})
+    params = get_optimized_prophet_params(total)
+
+    level_slices, row = [], 0
+    for level, names, _ in levels:
+        level_slices.append((level, slice(row, row + len(names))))
+        row += len(names)
+
+    print(f"\n{'='*60}")
+    print(f"HIERARCHICAL FORECAST ({series.shape[1]} series, {horizon} days)")
+    print(f"{'='*60}")
+    base, timings, workers = fit_hierarchy_levels(
+        dates, series, level_slices, params, FORECAST_SEASONALITIES, horizon, progress, cancel
+    )
+    print(f"{'='*60}\n")
+
+    history_totals = series.sum(axis=0)
+    entry = {
+        "dates": pd.date_range(dates[-1] + pd.Timedelta(days=1), periods=horizon, freq='D'),
+        "levels": levels,
+        "level_slices": level_slices,
+        "S": S,
+        "base": base,
+        "proportions": history_totals[-S.shape[1]:] / history_totals[0] if history_totals[0] > 0
+                       else np.full(S.shape[1], 1.0 / S.shape[1]),
+        "timings": timings,
+        "workers": workers,
+        "params": params
+    }
+    HIERARCHY_CACHE.put(key, entry, base.nbytes * 2 + S.data.nbytes * 3)
+    return entry, False
+
+
+def hierarchy_response(entry, cached, method, include_bottom, start):
+    """Reconcile cached base forecasts with `method` and build the response payload"""
+    reconcile_start = time.perf_counter()
+    reconciled = reconcile_forecasts(entry["S"], entry["base"], method, entry["proportions"])
+    reconcile_seconds = time.perf_counter() - reconcile_start
+
+    levels = {}
+    for (level, names, _), (_, rows) in zip(entry["levels"], entry["level_slices"]):
+        if level == "outlet_sku" and not include_bottom:
+            continue
+        block = reconciled[rows]
+        levels[level] = {
+            "series": {name: [round(float(v), 2) for v in values] for name, values in zip(names, block)},
+            "totals": {name: round(float(values.sum()), 2) for name, values in zip(names, block)},
+            "base_totals": {name: round(float(values.sum()), 2)
+                            for name, values in zip(names, entry["base"][rows])},
+            **entry["timings"][level]
+        }
+
+    # Largest gap between the total and each level's sum (0 when coherent)
+    total = reconciled[0]
+    coherence = {
+        level: round(float(np.abs(reconciled[rows].sum(axis=0) - total).max()), 6)
+        for level, rows in entry["level_slices"]
+    }
+
+    return {
+        "method": method,
+        "forecast_days": len(entry["dates"]),
+        "dates": entry["dates"].strftime("%Y-%m-%d").tolist(),
+        "levels": levels,
+        "coherence_max_gap": coherence,
+        "model_params": entry["params"],
+        "timing": {
+            "cached_base_forecasts": cached,
+            "workers": entry["workers"],
+            "fit_seconds": {level: t["seconds"] for level, t in entry["timings"].items()},
+            "reconcile_seconds": round(reconcile_seconds, 3),
+            "total_seconds": round(time.perf_counter() - start, 3)
+        }
+    }
+
+
+def run_hierarchy_job(job, dataset):
+    """Build the base forecasts level by level, then reconcile"""
+    options = job["options"]
+    progress = lambda stage: forecast_job_progress(job, stage)
+    start = time.perf_counter()
+    entry, cached = hierarchy_base_forecasts(
+        dataset, job["days"], options["outlets"], options["skus"], progress, job["cancel"]
+    )
+    progress("reconcile")
+    return hierarchy_response(entry, cached, options["method"], options["include_bottom"], start)
+
+
+@app.route("/forecast/hierarchy", methods=["POST"])
+def forecast_hierarchy():
+    """
+    Reconciled forecasts per category, brand, SKU and outlet (and optionally
+    each outlet x SKU pair) that add up to the total.
+    Params: days, method (bottom_up | top_down | ols | wls), outlets, skus,
+    include_bottom. Answers directly when the base forecasts for the scope
+    are cached; otherwise queues the build and returns 202 with a job_id
+    to poll at /forecast/jobs/<job_id> (an identical build in progress is
+    reused).
+    """
+    try:
+        dataset = get_request_dataset()
+        if dataset is None:
+            return dataset_missing_response()
+        params = request.get_json(silent=True) if request.is_json else request.form
+        params = params or {}
+        horizon = max(1, min(int(params.get("days", 30)), 365))
+        method = params.get("method", "wls")
+        if method not in RECONCILIATION_METHODS:
+            return jsonify({
+                "error": f"Unknown reconciliation method '{method}'. Use one of: {', '.join(RECONCILIATION_METHODS)}"
+            }), 400
+        include_bottom = str(params.get("include_bottom", "")).lower() in ("1", "true", "yes")
+        outlets, skus = name_list(params.get("outlets")), name_list(params.get("skus"))
+
+        start = time.perf_counter()
+        key = hierarchy_cache_key(dataset, horizon, outlets, skus)
+        entry = HIERARCHY_CACHE.get(key)
+        if entry is not None:
+            print("✓ Hierarchy base forecasts from cache")
+            return jsonify(hierarchy_response(entry, True, method, include_bottom, start))
+
+        # Catch typos before queuing a build
+        compact = dataset_compact(dataset)
+        for names, known, label in ((outlets, list(compact["outlets"]) + [UNASSIGNED_OUTLET], "outlet"),
+                                    (skus, compact["skus"], "SKU")):
+            unknown = [name for name in names if name not in set(known)]
+            if unknown:
+                return jsonify({"error": f"Unknown {label}(s): {', '.join(unknown)}"}), 400
+
+        purge_forecast_jobs()
+        with FORECAST_JOBS_LOCK:
+            job = next((job for job in FORECAST_JOBS.values()
+                        if job.get("hierarchy_key") == key and job["status"] in FORECAST_JOB_ACTIVE
+                        and job["options"]["method"] == method
+                        and job["options"]["include_bottom"] == include_bottom), None)
+            if job is None:
+                pending = sum(job["status"] in FORECAST_JOB_ACTIVE for job in FORECAST_JOBS.values())
+                if pending >= FORECAST_JOB_MAX_PENDING:
+                    return jsonify({
+                        "error": f"Too many forecast jobs in progress ({pending}). Try again later."
+                    }), 429
+                job = new_forecast_job("hierarchy", HIERARCHY_JOB_STAGES, dataset["dataset_id"], horizon, {
+                    "method": method, "outlets": outlets, "skus": skus, "include_bottom": include_bottom
+                })
+                job["hierarchy_key"] = key
+                FORECAST_JOBS[job["job_id"]] = job
+                job["future"] = FORECAST_JOB_EXECUTOR.submit(
+                    run_job, job, lambda: run_hierarchy_job(job, dataset)
+                )
+                print(f"✓ Hierarchy job {job['job_id']} queued")
+            response = forecast_job_view(job, include_result=False)
+        response["status_url"] = f"/forecast/jobs/{job['job_id']}"
+        return jsonify(response), 202
+
+    except Exception as e:
+        import traceback
+        print(traceback.format_exc())
+        return jsonify({"error": str(e)}), 400
+
+
+@app.route("/backtest/metrics", methods=["POST"])
+def backtest_metrics():
+    """
+    Metrics for a bulk backtest sent as JSON columns: `y`, `yhat`, `cutoff`
+    and either `ds` or a 1-based horizon `step`, plus optional `series`.
+    Returns overall, per-step, per-week, per-series and per-cutoff metrics.
+    """
+    try:
+        payload = request.get_json(silent=True)
+        if not payload or "y" not in payload or "yhat" not in payload:
+            return jsonify({"error": "Send JSON columns y, yhat, cutoff and ds (or step)"}), 400
+
+        start = time.perf_counter()
+        frame = pd.DataFrame({
+            "y": np.asarray(payload["y"], dtype=float),
+            "yhat": np.asarray(payload["yhat"], dtype=float),
+            "cutoff": pd.to_datetime(payload.get("cutoff", "1970-01-01"))
+        })
+        if "ds" in payload:
+            frame["ds"] = pd.to_datetime(payload["ds"])
+        elif "step" in payload:
+            frame["ds"] = frame["cutoff"] + pd.to_timedelta(np.asarray(payload["step"], dtype=np.int64), unit='D')
+        else:
+            return jsonify({"error": "Send either ds or step"}), 400
+        series_col = None
+        if payload.get("series") is not None:
+            frame["series"] = np.asarray(payload["series"]).astype(str)
+            series_col = "series"
+
+        report = backtest_report(backtest_table(frame, series_col), int(payload.get("bucket_days", 7)))
+        report["compute_ms"] = round((time.perf_counter() - start) * 1000, 2)
+        return jsonify(report)
+
+    except Exception as e:
+        import traceback
+        print(traceback.format_exc())
         return jsonify({"error": str(e)}), 400
 
 
@@ -806,20 +4990,11 @@ def decision_support():
     Enhanced decision support using Gemini AI for insights
     """
     try:
-        if "file" not in request.files:
-            return jsonify({"error": "No file uploaded"}), 400
+        dataset = get_request_dataset()
+        if dataset is None:
+            return dataset_missing_response()
 
-        file = request.files["file"]
-        df = pd.read_csv(file, dtype=str, keep_default_na=False, na_values=[''])
-        
-        # Clean data
-        if df.shape[1] >= 2:
-            second_col = df.columns[1]
-            mask_header = (df[second_col].astype(str).str.strip().str.upper() == "OUTLET") | \
-                         (df.iloc[:, 0].astype(str).str.strip().str.upper() == "DATE")
-            df = df.loc[~mask_header].reset_index(drop=True)
-        
-        prophet_df = detect_format_and_process(df)
+        prophet_df = dataset["daily"].copy()
         
         # Calculate comprehensive metrics
         total_sales = prophet_df['y'].sum()
@@ -840,12 +5015,9 @@ def decision_support():
         
         # Store analysis (if available)
         store_metrics = {}
-        if 'OUTLET' in df.columns or 'outlet' in df.columns:
-            outlet_col = 'OUTLET' if 'OUTLET' in df.columns else 'outlet'
-            for col in df.columns[2:]:
-                df[col] = pd.to_numeric(df[col], errors='coerce').fillna(0)
-            df['total'] = df.iloc[:, 2:].sum(axis=1)
-            store_totals = df.groupby(outlet_col)['total'].sum().sort_values(ascending=False)
+        compact = dataset.get("compact")
+        if compact is not None and compact["outlets"]:
+            store_totals = outlet_totals_series(dataset).sort_values(ascending=False)
             store_metrics = {
                 "top_store": store_totals.index[0] if len(store_totals) > 0 else "N/A",
                 "top_store_sales": float(store_totals.iloc[0]) if len(store_totals) > 0 else 0,
@@ -1044,56 +5216,44 @@ def generate_fallback_insights(total_sales, avg_daily, trend, cv, monthly_avg, s
 @app.route("/store-demand-causes", methods=["POST"])
 def store_demand_causes():
     try:
-        if "file" not in request.files:
-            return jsonify({"error": "No file uploaded"}), 400
+        dataset = get_request_dataset()
+        if dataset is None:
+            return dataset_missing_response()
 
-        file = request.files["file"]
-        df = pd.read_csv(file, dtype=str, keep_default_na=False, na_values=[''])
-        
-        # Clean data
-        if df.shape[1] >= 2:
-            second_col = df.columns[1]
-            mask_header = (df[second_col].astype(str).str.strip().str.upper() == "OUTLET") | \
-                         (df.iloc[:, 0].astype(str).str.strip().str.upper() == "DATE")
-            df = df.loc[~mask_header].reset_index(drop=True)
-
-        # Process data
-        prophet_df = detect_format_and_process(df)
-        
-        # Find date and outlet columns from original df
-        date_col = None
-        outlet_col = None
-        for col in df.columns:
-            if col.lower().strip() in ['date', 'datetime', 'ds', 'day']:
-                date_col = col
-            elif 'outlet' in col.lower():
-                outlet_col = col
-        
-        if not outlet_col or not date_col:
+        compact = dataset.get("compact")
+        if compact is None or not compact["outlets"]:
             return jsonify({"causes": []})
         
-        # Parse dates
-        df[date_col] = pd.to_datetime(df[date_col], errors='coerce')
-        df = df.dropna(subset=[date_col])
+        # Total cases per outlet-day row, ordered by outlet then date
+        totals = compact_row_cases(compact)
+        codes = compact["outlet_codes"]
+        days = compact["days"]
+        order = np.lexsort((np.arange(len(days)), days, codes))
+        order = order[codes[order] >= 0]
+        sorted_codes = codes[order]
+        sorted_totals = totals[order]
+        sorted_days = days[order]
+        last_day = int(days.max())
         
-        # Calculate total sales per store
-        sku_cols = [col for col in df.columns if col not in [date_col, outlet_col]]
-        for col in sku_cols:
-            df[col] = parse_num_series(df[col])
-        df['total'] = df[sku_cols].sum(axis=1)
+        # Group boundaries, running sums for window means and std
+        starts = np.flatnonzero(np.r_[True, sorted_codes[1:] != sorted_codes[:-1]])
+        ends = np.r_[starts[1:], len(sorted_codes)]
+        csum = np.r_[0.0, np.cumsum(sorted_totals)]
+        csq = np.r_[0.0, np.cumsum(sorted_totals ** 2)]
         
-        # Analyze each store
+        # Analyze each store (in order of first appearance)
         store_causes = []
-        for store in df[outlet_col].unique():
-            store_data = df[df[outlet_col] == store].copy()
-            store_data = store_data.sort_values(date_col)
-            
-            if len(store_data) < 7:
+        for start, end in sorted(zip(starts, ends), key=lambda g: sorted_codes[g[0]]):
+            n = end - start
+            if n < 7:
                 continue
+            store = compact["outlets"][sorted_codes[start]]
             
             # Calculate trends
-            recent_avg = store_data.tail(7)['total'].mean()
-            overall_avg = store_data['total'].mean()
+            recent_avg = (csum[end] - csum[end - 7]) / 7
+            overall_avg = (csum[end] - csum[start]) / n
+            variance = (csq[end] - csq[start] - n * overall_avg ** 2) / (n - 1)
+            std_dev = np.sqrt(max(variance, 0.0))
             
             # Detect patterns
             cause = ""
@@ -1108,7 +5268,7 @@ def store_demand_causes():
             elif recent_avg > overall_avg * 1.5:
                 cause = "📈 Increased ordering (high demand or promotion)"
                 status = "good"
-            elif store_data['total'].std() > overall_avg * 0.8:
+            elif std_dev > overall_avg * 0.8:
                 cause = "📊 Highly variable ordering pattern"
                 status = "variable"
             else:
@@ -1116,7 +5276,7 @@ def store_demand_causes():
                 status = "stable"
             
             # Check for stopped ordering
-            days_since_last_order = (df[date_col].max() - store_data[date_col].max()).days
+            days_since_last_order = last_day - int(sorted_days[end - 1])
             if days_since_last_order > 14:
                 cause = f"❌ Stopped ordering ({days_since_last_order} days ago)"
                 status = "stopped"
@@ -1128,7 +5288,7 @@ def store_demand_causes():
                 "recent_avg": float(recent_avg),
                 "overall_avg": float(overall_avg),
                 "days_since_last_order": int(days_since_last_order),
-                "total_orders": int(len(store_data))
+                "total_orders": int(n)
             })
         
         # Sort by status priority
@@ -1146,30 +5306,33 @@ def store_demand_causes():
 @app.route("/store-analytics", methods=["POST"])
 def store_analytics():
     try:
-        if "file" not in request.files:
-            return jsonify({"error": "No file uploaded"}), 400
+        dataset = get_request_dataset()
+        if dataset is None:
+            return dataset_missing_response()
 
-        file = request.files["file"]
-        df = pd.read_csv(file, dtype=str, keep_default_na=False, na_values=[''])
-        
-        # Clean duplicate headers
-        if df.shape[1] >= 2:
-            second_col = df.columns[1]
-            mask_header = (df[second_col].astype(str).str.strip().str.upper() == "OUTLET") | \
-                          (df.iloc[:, 0].astype(str).str.strip().str.upper() == "DATE")
-            df = df.loc[~mask_header].reset_index(drop=True)
-
-        # Fill numeric columns
-        for col in df.columns[2:]:
-            df[col] = pd.to_numeric(df[col], errors='coerce').fillna(0)
+        compact = dataset_compact(dataset)
+        outlets = compact["outlets"]
+        cube = dataset["aggregates"]["cube"]
         
         # Total demand per store
-        df['total'] = df.iloc[:, 2:].sum(axis=1)
-        store_totals = df.groupby('OUTLET')['total'].sum().sort_values(ascending=False)
+        store_totals = outlet_totals_series(dataset).sort_values(ascending=False)
         
-        # Days with highest demand per store
-        store_days = df.groupby(['OUTLET', 'DATE'])['total'].sum().reset_index()
-        top_days = store_days.groupby('OUTLET').apply(lambda x: x.sort_values('total', ascending=False).head(3).to_dict(orient='records')).to_dict()
+        # Days with highest demand per store, from the (day, outlet) cube cells
+        keep = cube["pair_outlets"] >= 0
+        pair_totals = np.asarray(cube["day_outlet_sku"].sum(axis=1), dtype=float).ravel()[keep]
+        pair_codes = cube["pair_outlets"][keep]
+        pair_days = cube["pair_days"][keep]
+        
+        # Highest totals first within each outlet, keep the top 3
+        order = np.lexsort((-pair_totals, pair_codes))
+        rank = np.arange(len(order)) - np.searchsorted(pair_codes[order], pair_codes[order])
+        top = order[rank < 3]
+        top_dates = compact_dates(compact, pair_days[top]).strftime(compact["date_format"])
+        
+        top_days = {}
+        for code, date, total in zip(pair_codes[top], top_dates, pair_totals[top]):
+            outlet = outlets[code]
+            top_days.setdefault(outlet, []).append({"OUTLET": outlet, "DATE": date, "total": float(total)})
         
         # Top stores
         top_stores = store_totals.head(5).to_dict()
@@ -1213,127 +5376,70 @@ GEMINI_API_URL = "https://generativelanguage.googleapis.com/v1beta/models/gemini
 @app.route("/category-analysis", methods=["POST"])
 def category_analysis():
     try:
-        if "file" not in request.files:
-            return jsonify({"error": "No file uploaded"}), 400
+        dataset = get_request_dataset()
+        if dataset is None:
+            return dataset_missing_response()
+
+        compact = dataset.get("compact")
+        if compact is not None:
+            # Per-SKU totals and brand/size/category rollups come from the cube
+            sku_cols = list(compact["skus"])
+            sku_cases = dataset["aggregates"]["sku_cases"]
+            case_qty = compact["case_qty"]
+            revenue = dataset["aggregates"]["sku_revenue"]
+            dimensions = dataset["aggregates"]["dimensions"]
+        else:
+            df = dataset_frame(dataset)
 
-        file = request.files["file"]
-        df = pd.read_csv(file, dtype=str, keep_default_na=False, na_values=[''])
-        
-        # Clean duplicate headers
-        if df.shape[1] >= 2:
-            second_col = df.columns[1]
-            mask_header = (df[second_col].astype(str).str.strip().str.upper() == "OUTLET") | \
-                         (df.iloc[:, 0].astype(str).str.strip().str.upper() == "DATE")
-            df = df.loc[~mask_header].reset_index(drop=True)
-
-        # Identify SKU columns (everything except DATE and OUTLET)
-        date_col = None
-        outlet_col = None
-        
-        for col in df.columns:
-            if col.lower().strip() in ['date', 'datetime', 'ds', 'day']:
-                date_col = col
-            elif 'outlet' in col.lower():
-                outlet_col = col
+            # Identify SKU columns (everything except DATE and OUTLET)
+            date_col = None
+            outlet_col = None
+            
+            for col in df.columns:
+                if col.lower().strip() in ['date', 'datetime', 'ds', 'day']:
+                    date_col = col
+                elif 'outlet' in col.lower():
+                    outlet_col = col
+            
+            sku_cols = [col for col in df.columns if col not in [date_col, outlet_col]]
+
+            # Convert to numeric (cases) in one pass over the SKU block
+            sku_cases = np.nansum(parse_num_matrix(df[sku_cols]), axis=0)
+            case_qty, case_price = case_vectors(sku_cols)
+            revenue = sku_cases * case_price
+            dimensions = sku_dimension_rollups(sku_cols, sku_cases, case_qty, revenue)
         
-        sku_cols = [col for col in df.columns if col not in [date_col, outlet_col]]
+        # ENHANCED: Calculate per-SKU metrics with bottle size (SKUs that sold)
+        sold = np.flatnonzero(sku_cases > 0)
+        units = sku_cases * case_qty
         
-        # ENHANCED: Calculate per-SKU metrics with bottle size
         sku_details = []
-        brands = {}
-        bottle_sizes = {}
-        categories = {}
-        
-        total_cases = 0
-        total_units = 0
-        total_revenue = 0
-        top_sku = None
-        max_units = 0
-        
-        for sku in sku_cols:
-            # Convert to numeric (cases)
-            df[sku] = parse_num_series(df[sku])
-            cases = df[sku].sum()
-            
-            if cases <= 0:
-                continue
-            
-            # Get SKU metadata
-            sku_info = SKU_METADATA.get(sku.strip(), {
-                'brand': 'Unknown',
-                'size': 'N/A',
-                'category': 'Other'
-            })
-            
-            # Get case quantity and price
-            case_qty = {
-                'MD8': 24, 'MD12': 24, 'MD290': 24, 'MD750': 12, 'MD1L': 12, 
-                'MD1.25': 12, 'MD1.5': 12, 'MD1.5/6': 6,
-                'P8': 24, 'P290': 24, 'P750': 12, 'P1L': 12, 
-                'P1.25': 12, 'P1.5': 12, 'P1.5/6': 6,
-                'S7': 24, 'SS8': 24, 'SS290': 24, 'SEV290': 24, 
-                'S1.25': 12, 'S1.5': 12,
-                'GBB350': 24, 'GBB500': 24, 'GTF350': 24, 'GR500': 24, 
-                'GO500': 24, 'GB900': 12, 'GBB8': 24, 'GBB237': 24,
-                'MILKIS': 30, 'MILKIS500': 20,
-                'TRO8': 24,
-                'PW350': 24, 'PW500': 24, 'PW1L': 12
-            }.get(sku.strip(), 1)
-            
-            case_price = {
-                'MD8': 380, 'MD12': 480, 'MD290': 380, 'MD750': 540, 'MD1L': 650,
-                'MD1.25': 720, 'MD1.5': 840, 'MD1.5/6': 420,
-                'P8': 380, 'P290': 380, 'P750': 540, 'P1L': 650,
-                'P1.25': 720, 'P1.5': 840, 'P1.5/6': 420,
-                'S7': 350, 'SS8': 380, 'SS290': 380, 'SEV290': 380,
-                'S1.25': 720, 'S1.5': 840,
-                'GBB350': 780, 'GBB500': 980, 'GTF350': 780, 'GR500': 980,
-                'GO500': 980, 'GB900': 780, 'GBB8': 480, 'GBB237': 550,
-                'MILKIS': 900, 'MILKIS500': 1200,
-                'TRO8': 420,
-                'PW350': 130, 'PW500': 150, 'PW1L': 170
-            }.get(sku.strip(), 0)
-            
-            # Calculate units and revenue
-            units = cases * case_qty
-            revenue = cases * case_price
-            
-            # Track totals
-            total_cases += cases
-            total_units += units
-            total_revenue += revenue
-            
-            # Track top SKU
-            if units > max_units:
-                max_units = units
-                top_sku = {
-                    'sku': sku,
-                    'brand': sku_info['brand'],
-                    'bottle_size': sku_info['size'],
-                    'cases': float(cases),
-                    'units': float(units),
-                    'revenue': float(revenue)
-                }
-            
-            # Add to SKU details
+        for i in sold:
+            sku_info = SKU_METADATA.get(sku_cols[i].strip(), UNKNOWN_SKU)
             sku_details.append({
-                'sku': sku,
+                'sku': sku_cols[i],
                 'brand': sku_info['brand'],
                 'bottle_size': sku_info['size'],  # ⭐ NEW
                 'category': sku_info['category'],
-                'cases': float(cases),
-                'units': float(units),
-                'revenue': float(revenue)
+                'cases': float(sku_cases[i]),
+                'units': float(units[i]),
+                'revenue': float(revenue[i])
             })
-            
-            # Aggregate by brand
-            brands[sku_info['brand']] = brands.get(sku_info['brand'], 0) + units
-            
-            # Aggregate by bottle size
-            bottle_sizes[sku_info['size']] = bottle_sizes.get(sku_info['size'], 0) + units
-            
-            # Aggregate by category
-            categories[sku_info['category']] = categories.get(sku_info['category'], 0) + units
+        
+        total_cases = sku_cases[sold].sum()
+        total_units = units[sold].sum()
+        total_revenue = revenue[sold].sum()
+        
+        # Track top SKU (first SKU with the most units)
+        top_sku = None
+        if len(sold) and units[sold].max() > 0:
+            top = sku_details[int(np.argmax(units[sold]))]
+            top_sku = {key: top[key] for key in ('sku', 'brand', 'bottle_size', 'cases', 'units', 'revenue')}
+        
+        # Brand, bottle size and category totals
+        brands = dimensions["brand"]["units"].to_dict()
+        bottle_sizes = dimensions["size"]["units"].to_dict()
+        categories = dimensions["category"]["units"].to_dict()
         
         # Sort and format results
         sorted_brands = sorted([{'brand': k, 'sales': float(v)} for k, v in brands.items()], 
@@ -1368,47 +5474,31 @@ def category_analysis():
 @app.route("/causal-factors-report", methods=["POST"])
 def causal_factors_report():
     try:
-        if "file" not in request.files:
-            return jsonify({"error": "No file uploaded"}), 400
+        dataset = get_request_dataset()
+        if dataset is None:
+            return dataset_missing_response()
 
-        file = request.files["file"]
-        df = pd.read_csv(file, dtype=str, keep_default_na=False, na_values=[''])
-        
-        # Clean data
-        if df.shape[1] >= 2:
-            second_col = df.columns[1]
-            mask_header = (df[second_col].astype(str).str.strip().str.upper() == "OUTLET") | \
-                         (df.iloc[:, 0].astype(str).str.strip().str.upper() == "DATE")
-            df = df.loc[~mask_header].reset_index(drop=True)
-
-        prophet_df = detect_format_and_process(df)
+        prophet_df = dataset["daily"].copy()
         
         if prophet_df.empty:
             return jsonify({"factors": []})
 
-        # Analyze external factors
-        prophet_df['month'] = prophet_df['ds'].dt.month
-        prophet_df['day_of_week'] = prophet_df['ds'].dt.dayofweek
-        prophet_df['is_weekend'] = prophet_df['day_of_week'].isin([5, 6])
-        
-        # Calculate correlations
-        avg_sales = prophet_df['y'].mean()
-        
-        factors = []
-        
-        # Weekend effect
-        weekend_sales = prophet_df[prophet_df['is_weekend']]['y'].mean()
-        weekend_impact = ((weekend_sales - avg_sales) / avg_sales * 100) if avg_sales > 0 else 0
-        factors.append({
-            "factor": "Weekend Effect",
-            "impact": round(float(weekend_impact), 2)
-        })
-        
+        # Analyze external factors (calendar features come from the feature store)
+        features = calendar_features(prophet_df['ds'])
+        y = prophet_df['y'].to_numpy(dtype=float)
+        avg_sales = y.mean()
+
+        # Weekend, holiday, payday and school-calendar effects
+        factors = [{k: effect[k] for k in ("factor", "impact", "correlation")}
+                   for effect in calendar_effects(prophet_df, features)]
+
         # Monthly seasonality
-        monthly_avg = prophet_df.groupby('month')['y'].mean()
-        peak_month = monthly_avg.idxmax()
+        month_days = features['month_indicators'].sum(axis=0)
+        month_totals = y @ features['month_indicators']
+        monthly_avg = np.where(month_days > 0, month_totals / np.maximum(month_days, 1), -np.inf)
+        peak_month = int(monthly_avg.argmax()) + 1
         peak_impact = ((monthly_avg.max() - avg_sales) / avg_sales * 100) if avg_sales > 0 else 0
-        factors.append({
+        factors.insert(1, {
             "factor": f"Peak Season ({calendar.month_abbr[peak_month]})",
             "impact": round(float(peak_impact), 2)
         })
@@ -1437,40 +5527,24 @@ def causal_factors_report():
 @app.route("/full-reports", methods=["POST"])
 def full_reports():
     try:
-        if "file" not in request.files:
-            return jsonify({"error": "No file uploaded"}), 400
+        dataset = get_request_dataset()
+        if dataset is None:
+            return dataset_missing_response()
 
-        file = request.files["file"]
-        df = pd.read_csv(file, dtype=str, keep_default_na=False, na_values=[''])
-        
-        # Clean data
-        if df.shape[1] >= 2:
-            second_col = df.columns[1]
-            mask_header = (df[second_col].astype(str).str.strip().str.upper() == "OUTLET") | \
-                         (df.iloc[:, 0].astype(str).str.strip().str.upper() == "DATE")
-            df = df.loc[~mask_header].reset_index(drop=True)
-
-        prophet_df = detect_format_and_process(df)
-        
-        if prophet_df.empty:
+        if dataset["daily"].empty:
             return jsonify({"monthly": [], "weekly": [], "yearly": []})
 
+        # Rollups are maintained with the dataset (and updated on append)
+        rollups = dataset["aggregates"]
+
         # Monthly reports
-        prophet_df['year_month'] = prophet_df['ds'].dt.to_period('M')
-        monthly = prophet_df.groupby('year_month')['y'].sum().reset_index()
-        monthly['month'] = monthly['year_month'].astype(str)
-        monthly_data = monthly[['month', 'y']].rename(columns={'y': 'total_sales'}).to_dict('records')
+        monthly_data = [{"month": k, "total_sales": float(v)} for k, v in rollups["monthly"]["y"].items()]
 
         # Weekly reports
-        prophet_df['year_week'] = prophet_df['ds'].dt.to_period('W')
-        weekly = prophet_df.groupby('year_week')['y'].sum().reset_index()
-        weekly['week'] = weekly['year_week'].astype(str)
-        weekly_data = weekly[['week', 'y']].rename(columns={'y': 'total_sales'}).to_dict('records')
+        weekly_data = [{"week": k, "total_sales": float(v)} for k, v in rollups["weekly"]["y"].items()]
 
         # Yearly reports
-        prophet_df['year'] = prophet_df['ds'].dt.year
-        yearly = prophet_df.groupby('year')['y'].sum().reset_index()
-        yearly_data = yearly.rename(columns={'y': 'total_sales'}).to_dict('records')
+        yearly_data = [{"year": int(k), "total_sales": float(v)} for k, v in rollups["yearly"]["y"].items()]
 
         return jsonify({
             "monthly": monthly_data,
@@ -1489,20 +5563,11 @@ def full_reports():
 def causal_analysis():
     """Causal analysis endpoint"""
     try:
-        if "file" not in request.files:
-            return jsonify({"error": "No file uploaded"}), 400
-        
-        file = request.files["file"]
-        df = pd.read_csv(file, dtype=str, keep_default_na=False, na_values=[''])
-        
-        # Clean and process
-        if df.shape[1] >= 2:
-            second_col = df.columns[1]
-            mask_header = (df[second_col].astype(str).str.strip().str.upper() == "OUTLET") | \
-                         (df.iloc[:, 0].astype(str).str.strip().str.upper() == "DATE")
-            df = df.loc[~mask_header].reset_index(drop=True)
-
-        prophet_df = detect_format_and_process(df)
+        dataset = get_request_dataset()
+        if dataset is None:
+            return dataset_missing_response()
+
+        prophet_df = dataset["daily"].copy()
         
         if prophet_df.empty:
             return jsonify({"causal_factors": [], "seasonal_data": [], "daily_data": []})
@@ -1530,7 +5595,7 @@ def causal_analysis():
             })
 
         return jsonify({
-            "causal_factors": [],
+            "causal_factors": calendar_effects(prophet_df),
             "seasonal_data": seasonal,
             "daily_data": daily_data
         })
@@ -1542,44 +5607,426 @@ def causal_analysis():
         return jsonify({"error": str(e)}), 400
 
 
+def safe_int(x, default=0):
+    """Lenient int from a JSON/form value ("1,200" -> 1200); default when unparseable"""
+    if x is None:
+        return int(default)
+    try:
+        if isinstance(x, str):
+            x = x.replace(",", "").strip()
+        return int(float(x))
+    except Exception:
+        return int(default)
+
+
+def safe_float(x, default=0.0):
+    """Lenient float from a JSON/form value; default when unparseable"""
+    if x is None:
+        return float(default)
+    try:
+        if isinstance(x, str):
+            x = x.replace(",", "").strip()
+        return float(x)
+    except Exception:
+        return float(default)
+
+
+# Demand multipliers of the /simulate scenarios
+SIMULATION_SCENARIOS = {
+    "normal": 1.0,
+    "promo": 1.3,
+    "holiday": 1.5,
+    "economic_downturn": 0.8
+}
+
+# Monte Carlo mode of /simulate: every scenario x path is simulated at once
+SIMULATION_MC_PATHS = int(os.environ.get("SIMULATION_MC_PATHS", 10000))
+SIMULATION_MC_MAX_PATHS = int(os.environ.get("SIMULATION_MC_MAX_PATHS", 50000))
+SIMULATION_PERCENTILES = [5, 25, 50, 75, 95]
+SIMULATION_BAND_CHUNK_DAYS = 32
+SIMULATION_TARGET_SERVICE_LEVEL = 0.95
+
+
+def distribution_summary(values, percentiles=SIMULATION_PERCENTILES, decimals=4):
+    """Mean and percentiles of per-path results"""
+    summary = {"mean": round(float(values.mean()), decimals)}
+    for q, v in zip(percentiles, np.percentile(values, percentiles)):
+        summary[f"p{q:g}"] = round(float(v), decimals)
+    return summary
+
+
+def sorted_percentiles(values, percentiles):
+    """
+    Percentiles along the last axis (NumPy's linear method) via one sort,
+    which beats np.percentile's multi-kth partition on wide float32 arrays
+    """
+    values = np.sort(values, axis=-1)
+    position = np.asarray(percentiles, dtype=float) / 100 * (values.shape[-1] - 1)
+    lo = np.floor(position).astype(np.int64)
+    hi = np.minimum(lo + 1, values.shape[-1] - 1)
+    below, above = values[..., lo], values[..., hi]
+    return np.moveaxis(below + (above - below) * (position - lo), -1, 0)
+
+
+def simulate_inventory_policies(avg, std, reorder_point, order_qty, initial_stock, lead_time, days, paths,
+                                seed=None, percentiles=None):
+    """
+    The /simulate continuous-review policy over `paths` demand paths for a
+    batch of rows at once; each row has its own mean / std demand, reorder
+    point, order quantity and opening stock (scenarios or candidate policies).
+    State is a (row, path) array stepped day by day; orders in transit sit in
+    a lead_time-slot ring buffer (the slot of day d holds what arrives on day
+    d). Rows share one normal draw per path and day (common random numbers),
+    so their differences are not noise. Returns per-path totals and, when
+    `percentiles` are given, daily percentile bands.
+    """
+    rng = np.random.default_rng(seed)
+    avg, std = np.asarray(avg, dtype=float)[:, None], np.asarray(std, dtype=float)[:, None]
+    reorder_point = np.asarray(reorder_point, dtype=float)[:, None]
+    order_qty = np.asarray(order_qty, dtype=float)[:, None]
+
+    shape = (len(avg), paths)
+    stock = np.repeat(np.asarray(initial_stock, dtype=float)[:, None], paths, axis=1)
+    position = stock.copy()
+    in_transit = np.zeros((lead_time,) + shape, dtype=bool)
+    cum_demand, cum_served, stock_sum, orders = (np.zeros(shape) for _ in range(4))
+    stockout_days = np.zeros(shape, dtype=np.int64)
+    peak, low = stock.copy(), stock.copy()
+
+    bands = chunk = None
+    if percentiles is not None:
+        q = np.asarray(percentiles, dtype=float)
+        bands = {name: np.empty((len(q), len(avg), days)) for name in ("stock", "unmet", "service_level")}
+        chunk = {name: np.empty((SIMULATION_BAND_CHUNK_DAYS,) + shape, dtype=np.float32) for name in bands}
+
+    for day in range(days):
+        slot = day % lead_time
+        stock += np.where(in_transit[slot], order_qty, 0)
+        in_transit[slot] = False
+
+        demand = np.maximum(np.rint(avg + std * rng.standard_normal(paths)), 0)
+        served = np.minimum(stock, demand)
+        stockout_days += demand > stock
+        stock -= served
+        position -= served
+        cum_demand += demand
+        cum_served += served
+        stock_sum += stock
+
+        # Reorder when the position hits the reorder point (if it can land in time)
+        if day + lead_time < days:
+            reorder = position <= reorder_point
+            in_transit[slot] = reorder
+            position += reorder * order_qty
+            orders += reorder
+        np.maximum(peak, stock, out=peak)
+        np.minimum(low, stock, out=low)
+
+        if bands is not None:
+            row = day % SIMULATION_BAND_CHUNK_DAYS
+            chunk["stock"][row] = stock
+            chunk["unmet"][row] = demand - served
+            chunk["service_level"][row] = np.divide(cum_served, cum_demand, out=np.ones(shape),
+                                                    where=cum_demand > 0)
+            if row == SIMULATION_BAND_CHUNK_DAYS - 1 or day == days - 1:
+                first = day - row
+                for name in bands:
+                    bands[name][:, :, first:day + 1] = sorted_percentiles(chunk[name][:row + 1], q).transpose(0, 2, 1)
+
+    return {
+        "service_level": np.divide(cum_served, cum_demand, out=np.ones(shape), where=cum_demand > 0),
+        "demand": cum_demand,
+        "unmet": cum_demand - cum_served,
+        "stock": stock,
+        "avg_inventory": stock_sum / days,
+        "orders": orders,
+        "stockout_days": stockout_days,
+        "peak": peak,
+        "low": low,
+        "bands": bands
+    }
+
+
+def monte_carlo_inventory(base_demand, scenarios, replenishment_qty, lead_time, days, paths,
+                          seed=None, percentiles=SIMULATION_PERCENTILES):
+    """
+    /simulate's policy for every scenario at once (see
+    simulate_inventory_policies). Returns per-scenario percentile bands and
+    KPI distributions.
+    """
+    names = list(scenarios)
+    avg = np.array([int(round(base_demand * SIMULATION_SCENARIOS[name])) for name in names], dtype=float)
+    std = avg * 0.2
+    safety_stock = np.array([int(1.65 * s * np.sqrt(lead_time)) for s in std])
+    reorder_point = avg * lead_time + safety_stock
+    sim = simulate_inventory_policies(
+        avg, std, reorder_point, np.full(len(names), replenishment_qty),
+        np.full(len(names), replenishment_qty * lead_time), lead_time, days, paths, seed, percentiles
+    )
+
+    q = np.asarray(percentiles, dtype=float)
+    service_level, unmet, avg_inventory = sim["service_level"], sim["unmet"], sim["avg_inventory"]
+    results = {}
+    for i, name in enumerate(names):
+        stockout_rate = sim["stockout_days"][i] / days
+        shortage_rate = np.divide(unmet[i], sim["demand"][i], out=np.zeros(paths), where=sim["demand"][i] > 0)
+        decision, decision_type = generate_inventory_decision(
+            float(service_level[i].mean()), float(service_level[i].mean()), float(shortage_rate.mean()),
+            float(stockout_rate.mean()), float(avg_inventory[i].mean()), replenishment_qty, int(avg[i]), name
+        )
+        results[name] = {
+            "params": {
+                "demand_multiplier": SIMULATION_SCENARIOS[name],
+                "avg_daily_demand": int(avg[i]),
+                "reorder_point": int(reorder_point[i]),
+                "safety_stock": int(safety_stock[i])
+            },
+            "bands": {
+                band: {f"p{p:g}": column_values(values[k, i], 2 if band != "service_level" else 4)
+                       for k, p in enumerate(q)}
+                for band, values in sim["bands"].items()
+            },
+            "service_level": distribution_summary(service_level[i]),
+            "prob_below_target_service": round(float((service_level[i] < SIMULATION_TARGET_SERVICE_LEVEL).mean()), 4),
+            "stockout_rate": distribution_summary(stockout_rate),
+            "total_unmet": distribution_summary(unmet[i], decimals=1),
+            "final_stock": distribution_summary(sim["stock"][i], decimals=1),
+            "avg_inventory": distribution_summary(avg_inventory[i], decimals=1),
+            "peak_stock": distribution_summary(sim["peak"][i], decimals=1),
+            "min_stock": distribution_summary(sim["low"][i], decimals=1),
+            "replenishments": distribution_summary(sim["orders"][i] * replenishment_qty, decimals=1),
+            "decision": decision,
+            "decisionType": decision_type
+        }
+    return results
+
+
+# Policy optimizer (/simulate/optimize): a reorder point x order quantity grid
+# screened on few paths, then the cheapest candidates and a finer grid around
+# the best one confirmed on more paths. Costs are per unit-day held, per
+# order placed and per unit of unmet demand; requests can override them.
+INVENTORY_HOLDING_COST = float(os.environ.get("INVENTORY_HOLDING_COST", 0.1))
+INVENTORY_ORDER_COST = float(os.environ.get("INVENTORY_ORDER_COST", 500.0))
+INVENTORY_SHORTAGE_COST = float(os.environ.get("INVENTORY_SHORTAGE_COST", 0.0))
+POLICY_GRID_REORDER_POINTS = 12
+POLICY_GRID_ORDER_QUANTITIES = 10
+POLICY_SCREEN_PATHS = int(os.environ.get("POLICY_SCREEN_PATHS", 400))
+POLICY_CONFIRM_PATHS = int(os.environ.get("POLICY_CONFIRM_PATHS", 2000))
+POLICY_CONFIRM_CANDIDATES = 8
+POLICY_SCREEN_MARGIN = 0.01
+POLICY_SCREEN_ATTEMPTS = 3
+POLICY_MAX_POLICIES = 400
+POLICY_MIN_CYCLES = 4
+
+
+def policy_grid(avg, std, lead_time, holding_cost, order_cost, z_low=-3.0, z_high=4.0):
+    """
+    Candidate reorder points (lead-time demand + z safety factors) and order
+    quantities (0.25x to 4x the EOQ)
+    """
+    lead_demand, lead_std = avg * lead_time, std * np.sqrt(lead_time)
+    z = np.linspace(z_low, z_high, POLICY_GRID_REORDER_POINTS)
+    reorder_points = np.unique(np.maximum(np.rint(lead_demand + z * lead_std), 0))
+    eoq = np.sqrt(2 * avg * order_cost / holding_cost) if holding_cost > 0 else avg * 7
+    order_quantities = np.unique(np.maximum(np.rint(max(eoq, 1) * np.geomspace(0.25, 4, POLICY_GRID_ORDER_QUANTITIES)), 1))
+    return reorder_points, order_quantities
+
+
+def evaluate_policies(avg, std, reorder_points, order_quantities, opening_stock, lead_time, days, paths, costs,
+                      seed=None):
+    """
+    Simulate (reorder point, order quantity) pairs side by side, all opening
+    with the same stock. Returns the simulation and each policy's expected
+    cost parts over the horizon.
+    """
+    reorder_points = np.asarray(reorder_points, dtype=float)
+    order_quantities = np.asarray(order_quantities, dtype=float)
+    n = len(reorder_points)
+    sim = simulate_inventory_policies(
+        np.full(n, avg), np.full(n, std), reorder_points, order_quantities,
+        np.full(n, float(opening_stock)), lead_time, days, paths, seed
+    )
+    cost = {
+        "holding": costs["holding"] * (sim["avg_inventory"] * days).mean(axis=1),
+        "ordering": costs["order"] * sim["orders"].mean(axis=1),
+        "shortage": costs["shortage"] * sim["unmet"].mean(axis=1)
+    }
+    cost["total"] = cost["holding"] + cost["ordering"] + cost["shortage"]
+    return sim, cost
+
+
+def policy_summary(reorder_point, order_qty, sim, cost, i, days, target):
+    """One evaluated policy as JSON"""
+    service_level = sim["service_level"][i]
+    return {
+        "reorder_point": int(reorder_point),
+        "order_qty": int(order_qty),
+        "service_level": round(float(service_level.mean()), 4),
+        "service_level_p5": round(float(np.percentile(service_level, 5)), 4),
+        "meets_target": bool(service_level.mean() >= target),
+        "stockout_rate": round(float(sim["stockout_days"][i].mean() / days), 4),
+        "avg_inventory": round(float(sim["avg_inventory"][i].mean()), 1),
+        "orders": round(float(sim["orders"][i].mean()), 2),
+        "cost": {
+            **{part: round(float(values[i]), 2) for part, values in cost.items()},
+            "per_day": round(float(cost["total"][i] / days), 2)
+        }
+    }
+
+
+def efficient_frontier(cost, service_level):
+    """Indices of the policies no other policy beats on both cost and service, cheapest first"""
+    frontier, best = [], -np.inf
+    for i in np.lexsort((-service_level, cost)):
+        if service_level[i] > best:
+            frontier.append(int(i))
+            best = service_level[i]
+    return frontier
+
+
+def refine_axis(grid, value, steps=5):
+    """`steps` values spanning the grid neighbours of `value`"""
+    position = int(np.searchsorted(grid, value))
+    lo = grid[max(position - 1, 0)]
+    hi = grid[min(position + 1, len(grid) - 1)]
+    return np.unique(np.rint(np.linspace(lo, hi, steps)))
+
+
+def optimize_inventory_policy(avg, std, lead_time, days, target, costs, opening_stock, current=None,
+                              reorder_points=None, order_quantities=None, seed=None):
+    """
+    Cheapest (reorder point, order quantity) meeting a mean fill-rate target.
+    Screens the grid on POLICY_SCREEN_PATHS paths (raising the reorder point
+    range when nothing qualifies), then re-simulates the best candidates and
+    a finer grid around the leader on POLICY_CONFIRM_PATHS paths; the
+    recommendation and the frontier come from that confirmed set.
+    Every policy opens with `opening_stock`. `current` is a (reorder point,
+    order quantity) pair to compare against.
+    """
+    if days < POLICY_MIN_CYCLES * lead_time:
+        raise ValueError(f"days ({days}) must cover at least {POLICY_MIN_CYCLES} lead times "
+                         f"({POLICY_MIN_CYCLES * lead_time} days); orders placed in the last lead_time days "
+                         f"never arrive, so shorter horizons favour not ordering")
+    custom_grid = reorder_points is not None or order_quantities is not None
+    default_rops, default_qtys = policy_grid(avg, std, lead_time, costs["holding"], costs["order"])
+    rops = np.unique(np.asarray(reorder_points, dtype=float)) if reorder_points is not None else default_rops
+    qtys = np.unique(np.asarray(order_quantities, dtype=float)) if order_quantities is not None else default_qtys
+    if len(rops) * len(qtys) > POLICY_MAX_POLICIES:
+        raise ValueError(f"Grid of {len(rops) * len(qtys)} policies is larger than {POLICY_MAX_POLICIES}")
+
+    # Screen: the whole grid, few paths
+    for attempt in range(POLICY_SCREEN_ATTEMPTS):
+        grid_rop, grid_qty = (axis.ravel() for axis in np.meshgrid(rops, qtys, indexing="ij"))
+        screen, screen_cost = evaluate_policies(avg, std, grid_rop, grid_qty, opening_stock, lead_time, days,
+                                                POLICY_SCREEN_PATHS, costs, seed)
+        screen_service = screen["service_level"].mean(axis=1)
+        if custom_grid or (screen_service >= target - POLICY_SCREEN_MARGIN).any():
+            break
+        if attempt == POLICY_SCREEN_ATTEMPTS - 1:
+            break  # keep rops as the grid that was screened
+        rops, _ = policy_grid(avg, std, lead_time, costs["holding"], costs["order"],
+                              z_low=4.0 + 4.0 * attempt, z_high=8.0 + 4.0 * attempt)
+
+    # Confirm: cheapest near-feasible policies plus a finer grid around the leader
+    feasible = np.flatnonzero(screen_service >= target - POLICY_SCREEN_MARGIN)
+    if len(feasible):
+        shortlist = feasible[np.argsort(screen_cost["total"][feasible])][:POLICY_CONFIRM_CANDIDATES]
+    else:
+        shortlist = np.argsort(-screen_service)[:POLICY_CONFIRM_CANDIDATES]
+    leader = shortlist[0]
+    fine_rop, fine_qty = (axis.ravel() for axis in np.meshgrid(
+        refine_axis(rops, grid_rop[leader]), refine_axis(qtys, grid_qty[leader]), indexing="ij"
+    ))
+    candidates = np.unique(np.column_stack([
+        np.concatenate([grid_rop[shortlist], fine_rop]),
+        np.concatenate([grid_qty[shortlist], fine_qty])
+    ]), axis=0)
+    if current is not None:
+        candidates = np.vstack([candidates, [current]])
+    confirm, confirm_cost = evaluate_policies(avg, std, candidates[:, 0], candidates[:, 1], opening_stock,
+                                              lead_time, days, POLICY_CONFIRM_PATHS, costs,
+                                              None if seed is None else seed + 1)
+    confirm_service = confirm["service_level"].mean(axis=1)
+
+    searched = len(candidates) - (current is not None)
+    ok = np.flatnonzero(confirm_service[:searched] >= target)
+    best = (ok[np.argmin(confirm_cost["total"][ok])] if len(ok)
+            else int(np.argmax(confirm_service[:searched])))
+    frontier = efficient_frontier(confirm_cost["total"][:searched], confirm_service[:searched])
+
+    return {
+        "recommended": policy_summary(*candidates[best], confirm, confirm_cost, best, days, target),
+        "current": (policy_summary(*candidates[-1], confirm, confirm_cost, len(candidates) - 1, days, target)
+                    if current is not None else None),
+        "frontier": [{
+            "reorder_point": int(candidates[i, 0]),
+            "order_qty": int(candidates[i, 1]),
+            "service_level": round(float(confirm_service[i]), 4),
+            "cost": round(float(confirm_cost["total"][i]), 2)
+        } for i in frontier],
+        "opening_stock": int(opening_stock),
+        "grid": {
+            "paths": POLICY_SCREEN_PATHS,
+            "reorder_points": [int(v) for v in rops],
+            "order_quantities": [int(v) for v in qtys],
+            "service_level": np.round(screen_service.reshape(len(rops), len(qtys)), 4).tolist(),
+            "cost": np.round(screen_cost["total"].reshape(len(rops), len(qtys)), 2).tolist()
+        },
+        "evaluated_policies": int(len(grid_rop) + len(candidates)),
+        "paths": {"screen": POLICY_SCREEN_PATHS, "confirm": POLICY_CONFIRM_PATHS}
+    }
+
+
 @app.route("/simulate", methods=["POST"])
 def simulate():
-    """Inventory simulation endpoint"""
+    """
+    Inventory simulation endpoint. One random path by default; with
+    mode "monte_carlo" it simulates `paths` paths (default SIMULATION_MC_PATHS)
+    for `scenarios` (default all) and returns percentile bands.
+    """
     try:
         data = request.json or {}
 
-        def safe_int(x, default=0):
-            if x is None:
-                return int(default)
-            try:
-                if isinstance(x, str):
-                    x = x.replace(",", "").strip()
-                return int(float(x))
-            except Exception:
-                return int(default)
-
-        def safe_float(x, default=0.0):
-            if x is None:
-                return float(default)
-            try:
-                if isinstance(x, str):
-                    x = x.replace(",", "").strip()
-                return float(x)
-            except Exception:
-                return float(default)
-
         replenishment_qty = safe_int(data.get("stock", 1000))
         lead_time = max(1, safe_int(data.get("lead_time", 1)))
         days = min(365, max(1, safe_int(data.get("days", 30))))
         scenario = (data.get("scenario") or "normal").lower()
         base_demand = safe_float(data.get("demand", 500.0))
 
-        scenario_multiplier = {
-            "normal": 1.0, 
-            "promo": 1.3, 
-            "holiday": 1.5, 
-            "economic_downturn": 0.8
-        }.get(scenario, 1.0)
+        if (data.get("mode") or "single").lower() == "monte_carlo":
+            scenarios = data.get("scenarios") or list(SIMULATION_SCENARIOS)
+            if isinstance(scenarios, str):
+                scenarios = list(SIMULATION_SCENARIOS) if scenarios == "all" else scenarios.split(",")
+            scenarios = [name.strip().lower() for name in scenarios]
+            unknown = [name for name in scenarios if name not in SIMULATION_SCENARIOS]
+            if unknown:
+                return jsonify({"error": f"Unknown scenario(s) {', '.join(unknown)}. "
+                                         f"Use any of: {', '.join(SIMULATION_SCENARIOS)}"}), 400
+            paths = min(SIMULATION_MC_MAX_PATHS, max(1, safe_int(data.get("paths"), SIMULATION_MC_PATHS)))
+            seed = data.get("seed")
+            start = time.perf_counter()
+            results = monte_carlo_inventory(
+                base_demand, dict.fromkeys(scenarios), replenishment_qty, lead_time, days, paths,
+                seed=safe_int(seed) if seed is not None else None
+            )
+            return json_response({
+                "title": "Inventory Simulation - Continuous Review Policy (Monte Carlo)",
+                "mode": "monte_carlo",
+                "params": {
+                    "replenishment_qty": replenishment_qty,
+                    "lead_time": lead_time,
+                    "days": days,
+                    "base_demand": base_demand,
+                    "paths": paths,
+                    "seed": seed,
+                    "percentiles": SIMULATION_PERCENTILES,
+                    "target_service_level": SIMULATION_TARGET_SERVICE_LEVEL
+                },
+                "scenarios": results,
+                "compute_ms": round((time.perf_counter() - start) * 1000, 1)
+            })
+
+        scenario_multiplier = SIMULATION_SCENARIOS.get(scenario, 1.0)
 
         avg_daily_demand = int(round(base_demand * scenario_multiplier))
         demand_std_dev = avg_daily_demand * 0.2
@@ -1697,6 +6144,91 @@ def simulate():
         return jsonify({"error": str(e)}), 400
 
 
+@app.route("/simulate/optimize", methods=["POST"])
+def optimize_inventory():
+    """
+    Search reorder points x order quantities for the cheapest policy that
+    meets `target_service_level` (mean fill rate). Takes /simulate's inputs
+    (demand, scenario, lead_time, days, stock as the current order quantity)
+    plus optional opening_stock, holding_cost, order_cost, shortage_cost,
+    reorder_points, order_quantities and seed. Every policy opens with
+    /simulate's stock (stock * lead_time), or the current reorder point
+    when no stock is sent.
+    """
+    try:
+        data = request.json or {}
+        lead_time = max(1, safe_int(data.get("lead_time", 1)))
+        days = min(365, max(1, safe_int(data.get("days", 90))))
+        scenario = (data.get("scenario") or "normal").lower()
+        target = min(0.9999, max(0.0, safe_float(data.get("target_service_level"), SIMULATION_TARGET_SERVICE_LEVEL)))
+        costs = {
+            "holding": max(0.0, safe_float(data.get("holding_cost"), INVENTORY_HOLDING_COST)),
+            "order": max(0.0, safe_float(data.get("order_cost"), INVENTORY_ORDER_COST)),
+            "shortage": max(0.0, safe_float(data.get("shortage_cost"), INVENTORY_SHORTAGE_COST))
+        }
+        avg = float(int(round(safe_float(data.get("demand", 500.0)) * SIMULATION_SCENARIOS.get(scenario, 1.0))))
+        if avg <= 0:
+            return jsonify({"error": "demand must be positive"}), 400
+        std = avg * 0.2
+
+        # The policy /simulate would run for the same inputs, and its opening stock
+        reorder_point = avg * lead_time + int(1.65 * std * np.sqrt(lead_time))
+        current, opening_stock = None, reorder_point
+        if data.get("stock") is not None:
+            current = (reorder_point, max(1, safe_int(data["stock"])))
+            opening_stock = current[1] * lead_time
+        if data.get("opening_stock") is not None:
+            opening_stock = max(0, safe_int(data["opening_stock"]))
+
+        seed = data.get("seed")
+        start = time.perf_counter()
+        result = optimize_inventory_policy(
+            avg, std, lead_time, days, target, costs, opening_stock, current,
+            reorder_points=data.get("reorder_points"), order_quantities=data.get("order_quantities"),
+            seed=safe_int(seed) if seed is not None else None
+        )
+
+        best, now = result["recommended"], result["current"]
+        if best["meets_target"]:
+            decision = (f"Reorder {best['order_qty']} units whenever stock on hand plus on order falls to "
+                        f"{best['reorder_point']}: {best['service_level']*100:.1f}% service at "
+                        f"{best['cost']['per_day']:,.2f} per day")
+            decision_type = "success"
+            if now is not None:
+                decision += (f" (current policy: {now['service_level']*100:.1f}% at "
+                             f"{now['cost']['per_day']:,.2f} per day)")
+        else:
+            decision = (f"No policy in the search reaches {target*100:.1f}% service; the best found gives "
+                        f"{best['service_level']*100:.1f}% (reorder point {best['reorder_point']}, "
+                        f"order {best['order_qty']}). Consider a shorter lead time or a larger search range.")
+            decision_type = "warning"
+
+        return json_response({
+            "title": "Inventory Policy Optimization - Continuous Review (s, Q)",
+            "scenario": scenario,
+            "params": {
+                "avg_daily_demand": int(avg),
+                "lead_time": lead_time,
+                "days": days,
+                "target_service_level": target,
+                "costs": costs,
+                "seed": seed
+            },
+            **result,
+            "savings_per_day": (round(now["cost"]["per_day"] - best["cost"]["per_day"], 2)
+                                if now is not None and best["meets_target"] else None),
+            "decision": decision,
+            "decisionType": decision_type,
+            "compute_ms": round((time.perf_counter() - start) * 1000, 1)
+        })
+
+    except Exception as e:
+        import traceback
+        print(f"Policy optimization error: {e}")
+        print(traceback.format_exc())
+        return jsonify({"error": str(e)}), 400
+
+
 def generate_inventory_decision(service_level, fill_rate, shortage_rate, stockout_rate, 
                                 avg_inventory, replenishment_qty, avg_demand, scenario):
     """Generate inventory management decision based on KPIs"""
@@ -1769,190 +6301,332 @@ def generate_inventory_decision(service_level, fill_rate, shortage_rate, stockou
 @app.route("/sku-info", methods=["GET"])
 def sku_info():
     """Return SKU case quantity information"""
-    CASE_QUANTITIES = {
-        'MD8': 24, 'MD12': 24, 'MD290': 24, 'MD750': 12, 'MD1L': 12, 
-        'MD1.25': 12, 'MD1.5': 12, 'MD1.5/6': 6,
-        'P8': 24, 'P290': 24, 'P750': 12, 'P1L': 12, 
-        'P1.25': 12, 'P1.5': 12, 'P1.5/6': 6,
-        'S7': 24, 'SS8': 24, 'SS290': 24, 'SEV290': 24, 
-        'S1.25': 12, 'S1.5': 12,
-        'GBB350': 24, 'GBB500': 24, 'GTF350': 24, 'GR500': 24, 
-        'GO500': 24, 'GB900': 12, 'GBB8': 24, 'GBB237': 24,
-        'MILKIS': 30, 'MILKIS500': 20,
-        'TRO8': 24,
-        'PW350': 24, 'PW500': 24, 'PW1L': 12
-    }
-    return jsonify({"sku_case_quantities": CASE_QUANTITIES})
+    return jsonify({"sku_case_quantities": {sku: int(qty) for sku, qty in zip(PRICE_BOOK.skus, PRICE_BOOK.case_qty)}})
 
-@app.route("/sales-query", methods=["POST"])
-def sales_query():
+# Prefix-sum indexes over the daily series (optionally filtered by outlet/SKU)
+SALES_INDEX_CACHE = LRUCache("sales index cache", 64 * 1024 * 1024)
+
+
+def range_extreme_table(values, pick_max=True):
     """
-    Query exact sales for specific date ranges
-    Supports: specific date, week, month, year, or custom range
+    Sparse table for O(1) range argmax/argmin. Level k holds the position of
+    the extreme of values[i:i + 2**k]; ties keep the earliest position.
     """
-    try:
-        if "file" not in request.files:
-            return jsonify({"error": "No file uploaded"}), 400
+    n = len(values)
+    table = [np.arange(n)]
+    span = 1
+    while span * 2 <= n:
+        prev = table[-1]
+        left, right = prev[:n - 2 * span + 1], prev[span:n - span + 1]
+        better = values[right] > values[left] if pick_max else values[right] < values[left]
+        table.append(np.where(better, right, left))
+        span *= 2
+    return table
+
+
+def range_extreme(table, values, lo, hi, pick_max=True):
+    """Position of the max (or min) of values[lo:hi]"""
+    k = int(hi - lo).bit_length() - 1
+    left, right = table[k][lo], table[k][hi - (1 << k)]
+    better = values[right] > values[left] if pick_max else values[right] < values[left]
+    return right if better else left
+
+
+def build_sales_index(calendar, values):
+    """Sorted day index with cumulative sums and range max/min tables"""
+    values = np.asarray(values, dtype=float)
+    max_table = range_extreme_table(values, True)
+    min_table = range_extreme_table(values, False)
+    return {
+        "calendar": calendar.assign(y=values),
+        "ordinals": calendar['date'].to_numpy().astype('datetime64[D]').astype(np.int64),
+        "values": values,
+        "csum": np.concatenate([[0.0], np.cumsum(values)]),
+        "max_table": max_table,
+        "min_table": min_table,
+        "nbytes": int(values.nbytes * 3 + sum(t.nbytes for t in max_table + min_table)
+                      + calendar.memory_usage(deep=True).sum())
+    }
 
-        file = request.files["file"]
-        query_type = request.form.get("query_type", "date")  # date, week, month, year, custom
-        query_value = request.form.get("query_value", "")  # e.g., "2023-03-15", "2023-03", "2023"
-        start_date = request.form.get("start_date", "")  # for custom range
-        end_date = request.form.get("end_date", "")  # for custom range
-        
-        # Load and process data
-        df = pd.read_csv(file, dtype=str, keep_default_na=False, na_values=[''])
-        
-        # Clean duplicate headers
-        if df.shape[1] >= 2:
-            second_col = df.columns[1]
-            mask_header = (df[second_col].astype(str).str.strip().str.upper() == "OUTLET") | \
-                         (df.iloc[:, 0].astype(str).str.strip().str.upper() == "DATE")
-            df = df.loc[~mask_header].reset_index(drop=True)
-
-        prophet_df = detect_format_and_process(df)
-        
-        if prophet_df.empty:
-            return jsonify({"error": "No valid data after processing"}), 400
 
-        # Parse dates
-        prophet_df['date'] = pd.to_datetime(prophet_df['ds'])
-        prophet_df['year'] = prophet_df['date'].dt.year
-        prophet_df['month'] = prophet_df['date'].dt.month
-        prophet_df['week'] = prophet_df['date'].dt.isocalendar().week
-        prophet_df['day_of_week'] = prophet_df['date'].dt.day_name()
-        
-        result = {}
-        
-        if query_type == "date":
-            # Specific date query
-            query_date = pd.to_datetime(query_value)
-            matched = prophet_df[prophet_df['date'] == query_date]
-            
-            if len(matched) > 0:
-                result = {
-                    "query_type": "Specific Date",
-                    "query_value": query_value,
-                    "total_sales": int(matched['y'].sum()),
-                    "date": query_value,
-                    "day_of_week": matched.iloc[0]['day_of_week'],
-                    "found": True
-                }
-            else:
-                result = {
-                    "query_type": "Specific Date",
-                    "query_value": query_value,
-                    "found": False,
-                    "message": "No sales data found for this date"
-                }
+def filtered_daily_units(dataset, outlets=None, skus=None):
+    """Daily units restricted to some outlets and/or SKUs, aligned to the calendar"""
+    compact = dataset_compact(dataset)
+    cube = dataset["aggregates"]["cube"]
+
+    weights = compact["case_qty"]
+    if skus:
+        unknown = [sku for sku in skus if sku not in compact["skus"]]
+        if unknown:
+            raise ValueError(f"Unknown SKU(s): {', '.join(unknown)}")
+        weights = np.where(np.isin(compact["skus"], skus), weights, 0.0)
+
+    if not outlets:
+        return cube["day_sku"] @ weights
+
+    positions = pd.Index(compact["outlets"]).get_indexer(outlets)
+    if (positions < 0).any():
+        unknown = [o for o, p in zip(outlets, positions) if p < 0]
+        raise ValueError(f"Unknown outlet(s): {', '.join(unknown)}")
+    cells = np.isin(cube["pair_outlets"], positions)
+    cell_units = cube["day_outlet_sku"][cells] @ weights
+    day_pos = np.searchsorted(cube["day_index"], cube["pair_days"][cells])
+    return np.bincount(day_pos, weights=cell_units, minlength=len(cube["day_index"]))
+
+
+def get_sales_index(dataset, outlets=None, skus=None):
+    """Cached prefix-sum index for a dataset and filter combination"""
+    key = (dataset["dataset_id"], tuple(outlets or ()), tuple(skus or ()))
+    index = SALES_INDEX_CACHE.get(key)
+    if index is None:
+        calendar = dataset["aggregates"]["calendar"]
+        if outlets or skus:
+            values = filtered_daily_units(dataset, outlets, skus)
+        else:
+            values = calendar['y'].to_numpy(dtype=float)
+        index = build_sales_index(calendar, values)
+        SALES_INDEX_CACHE.put(key, index, index["nbytes"])
+    return index
+
+
+def index_bounds(index, start, end):
+    """[lo, hi) positions of the days between start and end (inclusive)"""
+    start_ord, end_ord = (np.datetime64(pd.Timestamp(d).date(), 'D').astype(np.int64) for d in (start, end))
+    return (int(np.searchsorted(index["ordinals"], start_ord, side='left')),
+            int(np.searchsorted(index["ordinals"], end_ord, side='right')))
+
+
+def index_total(index, lo, hi):
+    """Sum of the daily values in [lo, hi)"""
+    return index["csum"][hi] - index["csum"][lo]
+
+
+def index_day(index, pos):
+    """{"date", "sales"} for one indexed day"""
+    return {"date": str(index["calendar"]['date'].iloc[pos].date()), "sales": int(index["values"][pos])}
+
+
+def index_peak(index, lo, hi):
+    return index_day(index, range_extreme(index["max_table"], index["values"], lo, hi, True))
+
+
+def index_lowest(index, lo, hi):
+    return index_day(index, range_extreme(index["min_table"], index["values"], lo, hi, False))
+
+
+def index_breakdown(index, lo, hi):
+    """Per-day records of [lo, hi)"""
+    return index["calendar"].iloc[lo:hi][['date', 'y']].rename(columns={'y': 'sales'}).to_dict('records')
+
+
+def answer_sales_query(index, query_type, query_value="", start_date="", end_date=""):
+    """
+    Answer one sales query from a prefix-sum index: totals and averages are
+    two cumulative-sum lookups, peaks and lows come from the sparse tables,
+    so each range costs O(log n) plus the size of any daily breakdown
+    """
+    result = {}
+    
+    if query_type == "date":
+        # Specific date query
+        lo, hi = index_bounds(index, query_value, query_value)
         
-        elif query_type == "week":
-            # Week query (format: "2023-W10")
-            year, week = query_value.split('-W')
-            year = int(year)
-            week = int(week)
-            
-            matched = prophet_df[(prophet_df['year'] == year) & (prophet_df['week'] == week)]
-            
-            if len(matched) > 0:
-                result = {
-                    "query_type": "Week",
-                    "query_value": query_value,
-                    "total_sales": int(matched['y'].sum()),
-                    "average_daily": int(matched['y'].mean()),
-                    "days_count": len(matched),
-                    "date_range": f"{matched['date'].min().date()} to {matched['date'].max().date()}",
-                    "daily_breakdown": matched[['date', 'y']].rename(columns={'y': 'sales'}).to_dict('records'),
-                    "found": True
-                }
-            else:
-                result = {"query_type": "Week", "query_value": query_value, "found": False}
+        if hi > lo:
+            result = {
+                "query_type": "Specific Date",
+                "query_value": query_value,
+                "total_sales": int(index_total(index, lo, hi)),
+                "date": query_value,
+                "day_of_week": index["calendar"]['day_of_week'].iloc[lo],
+                "found": True
+            }
+        else:
+            result = {
+                "query_type": "Specific Date",
+                "query_value": query_value,
+                "found": False,
+                "message": "No sales data found for this date"
+            }
+    
+    elif query_type == "week":
+        # ISO week query (format: "2023-W10"), Monday to Sunday
+        year, week = query_value.split('-W')
+        monday = pd.Timestamp.fromisocalendar(int(year), int(week), 1)
+        lo, hi = index_bounds(index, monday, monday + pd.Timedelta(days=6))
         
-        elif query_type == "month":
-            # Month query (format: "2023-03")
-            year, month = query_value.split('-')
-            year = int(year)
-            month = int(month)
-            
-            matched = prophet_df[(prophet_df['year'] == year) & (prophet_df['month'] == month)]
-            
-            if len(matched) > 0:
-                # Weekly breakdown
-                weekly = matched.groupby('week')['y'].sum().to_dict()
-                
-                result = {
-                    "query_type": "Month",
-                    "query_value": query_value,
-                    "month_name": calendar.month_name[month],
-                    "total_sales": int(matched['y'].sum()),
-                    "average_daily": int(matched['y'].mean()),
-                    "days_count": len(matched),
-                    "peak_day": {
-                        "date": str(matched.loc[matched['y'].idxmax()]['date'].date()),
-                        "sales": int(matched['y'].max())
-                    },
-                    "lowest_day": {
-                        "date": str(matched.loc[matched['y'].idxmin()]['date'].date()),
-                        "sales": int(matched['y'].min())
-                    },
-                    "weekly_breakdown": {f"Week {k}": int(v) for k, v in weekly.items()},
-                    "daily_breakdown": matched[['date', 'y']].rename(columns={'y': 'sales'}).to_dict('records'),
-                    "found": True
-                }
-            else:
-                result = {"query_type": "Month", "query_value": query_value, "found": False}
+        if hi > lo:
+            total = index_total(index, lo, hi)
+            dates = index["calendar"]['date']
+            result = {
+                "query_type": "Week",
+                "query_value": query_value,
+                "total_sales": int(total),
+                "average_daily": int(total / (hi - lo)),
+                "days_count": hi - lo,
+                "date_range": f"{dates.iloc[lo].date()} to {dates.iloc[hi - 1].date()}",
+                "daily_breakdown": index_breakdown(index, lo, hi),
+                "found": True
+            }
+        else:
+            result = {"query_type": "Week", "query_value": query_value, "found": False}
+    
+    elif query_type == "month":
+        # Month query (format: "2023-03")
+        year, month = query_value.split('-')
+        year = int(year)
+        month = int(month)
+        first = pd.Timestamp(year, month, 1)
+        lo, hi = index_bounds(index, first, first + pd.offsets.MonthEnd(0))
         
-        elif query_type == "year":
-            # Year query (format: "2023")
-            year = int(query_value)
-            matched = prophet_df[prophet_df['year'] == year]
+        if hi > lo:
+            total = index_total(index, lo, hi)
+            # Weekly breakdown
+            weekly = index["calendar"].iloc[lo:hi].groupby('week')['y'].sum().to_dict()
             
-            if len(matched) > 0:
-                # Monthly breakdown
-                monthly = matched.groupby('month')['y'].sum().to_dict()
-                
-                result = {
-                    "query_type": "Year",
-                    "query_value": query_value,
-                    "total_sales": int(matched['y'].sum()),
-                    "average_daily": int(matched['y'].mean()),
-                    "days_count": len(matched),
-                    "peak_month": {
-                        "month": calendar.month_name[matched.groupby('month')['y'].sum().idxmax()],
-                        "sales": int(matched.groupby('month')['y'].sum().max())
-                    },
-                    "monthly_breakdown": {calendar.month_abbr[k]: int(v) for k, v in monthly.items()},
-                    "found": True
-                }
-            else:
-                result = {"query_type": "Year", "query_value": query_value, "found": False}
+            result = {
+                "query_type": "Month",
+                "query_value": query_value,
+                "month_name": calendar.month_name[month],
+                "total_sales": int(total),
+                "average_daily": int(total / (hi - lo)),
+                "days_count": hi - lo,
+                "peak_day": index_peak(index, lo, hi),
+                "lowest_day": index_lowest(index, lo, hi),
+                "weekly_breakdown": {f"Week {k}": int(v) for k, v in weekly.items()},
+                "daily_breakdown": index_breakdown(index, lo, hi),
+                "found": True
+            }
+        else:
+            result = {"query_type": "Month", "query_value": query_value, "found": False}
+    
+    elif query_type == "year":
+        # Year query (format: "2023")
+        year = int(query_value)
+        lo, hi = index_bounds(index, pd.Timestamp(year, 1, 1), pd.Timestamp(year, 12, 31))
         
-        elif query_type == "custom":
-            # Custom date range
-            start = pd.to_datetime(start_date)
-            end = pd.to_datetime(end_date)
-            
-            matched = prophet_df[(prophet_df['date'] >= start) & (prophet_df['date'] <= end)]
+        if hi > lo:
+            total = index_total(index, lo, hi)
+            # Monthly breakdown: one prefix-sum lookup per month with data
+            monthly = {}
+            for month in range(1, 13):
+                first = pd.Timestamp(year, month, 1)
+                m_lo, m_hi = index_bounds(index, first, first + pd.offsets.MonthEnd(0))
+                if m_hi > m_lo:
+                    monthly[month] = index_total(index, m_lo, m_hi)
+            peak_month = max(monthly, key=monthly.get)
             
-            if len(matched) > 0:
-                result = {
-                    "query_type": "Custom Range",
-                    "start_date": start_date,
-                    "end_date": end_date,
-                    "total_sales": int(matched['y'].sum()),
-                    "average_daily": int(matched['y'].mean()),
-                    "days_count": len(matched),
-                    "peak_day": {
-                        "date": str(matched.loc[matched['y'].idxmax()]['date'].date()),
-                        "sales": int(matched['y'].max())
-                    },
-                    "daily_breakdown": matched[['date', 'y']].rename(columns={'y': 'sales'}).to_dict('records'),
-                    "found": True
-                }
-            else:
-                result = {"query_type": "Custom Range", "found": False}
+            result = {
+                "query_type": "Year",
+                "query_value": query_value,
+                "total_sales": int(total),
+                "average_daily": int(total / (hi - lo)),
+                "days_count": hi - lo,
+                "peak_month": {
+                    "month": calendar.month_name[peak_month],
+                    "sales": int(monthly[peak_month])
+                },
+                "monthly_breakdown": {calendar.month_abbr[k]: int(v) for k, v in monthly.items()},
+                "found": True
+            }
+        else:
+            result = {"query_type": "Year", "query_value": query_value, "found": False}
+    
+    elif query_type == "custom":
+        # Custom date range
+        lo, hi = index_bounds(index, start_date, end_date)
         
-        return jsonify(result)
+        if hi > lo:
+            total = index_total(index, lo, hi)
+            result = {
+                "query_type": "Custom Range",
+                "start_date": start_date,
+                "end_date": end_date,
+                "total_sales": int(total),
+                "average_daily": int(total / (hi - lo)),
+                "days_count": hi - lo,
+                "peak_day": index_peak(index, lo, hi),
+                "daily_breakdown": index_breakdown(index, lo, hi),
+                "found": True
+            }
+        else:
+            result = {"query_type": "Custom Range", "found": False}
+    
+    return result
+
+
+def name_list(value):
+    """Outlet/SKU filter as a list: accepts a JSON list or a comma-separated string"""
+    if not value:
+        return []
+    if isinstance(value, str):
+        value = value.split(',')
+    return [str(v).strip() for v in value if str(v).strip()]
+
+
+def run_sales_query(dataset, query, outlets=None, skus=None):
+    """One query dict (query_type, query_value, start_date, end_date, outlets, skus)"""
+    outlets = name_list(query.get("outlets")) or outlets
+    skus = name_list(query.get("skus")) or skus
+    index = get_sales_index(dataset, outlets, skus)
+    result = answer_sales_query(
+        index,
+        query.get("query_type", "date"),
+        query.get("query_value", ""),
+        query.get("start_date", ""),
+        query.get("end_date", "")
+    )
+    if outlets or skus:
+        result["filters"] = {"outlets": outlets, "skus": skus}
+    return result
+
+
+@app.route("/sales-query", methods=["POST"])
+def sales_query():
+    """
+    Query exact sales for specific date ranges
+    Supports: specific date, week, month, year, or custom range,
+    optionally filtered by `outlets` and/or `skus` (comma-separated).
+    Send `queries` (a JSON list of query objects) to answer many at once.
+    """
+    try:
+        dataset = get_request_dataset()
+        if dataset is None:
+            return dataset_missing_response()
+
+        params = request.get_json(silent=True) if request.is_json else request.form
+        params = params or {}
+        outlets = name_list(params.get("outlets"))
+        skus = name_list(params.get("skus"))
+
+        if dataset["daily"].empty:
+            return jsonify({"error": "No valid data after processing"}), 400
+
+        queries = params.get("queries")
+        if queries is None:
+            query = {
+                "query_type": params.get("query_type", "date"),  # date, week, month, year, custom
+                "query_value": params.get("query_value", ""),  # e.g., "2023-03-15", "2023-03", "2023"
+                "start_date": params.get("start_date", ""),  # for custom range
+                "end_date": params.get("end_date", "")  # for custom range
+            }
+            return jsonify(run_sales_query(dataset, query, outlets, skus))
+
+        # Batch form: one result (or error) per query, in request order
+        if isinstance(queries, str):
+            queries = json.loads(queries)
+        start = time.perf_counter()
+        results = []
+        for query in queries:
+            try:
+                results.append(run_sales_query(dataset, query, outlets, skus))
+            except Exception as e:
+                results.append({"error": str(e), "query": query})
+
+        return jsonify({
+            "results": results,
+            "count": len(results),
+            "query_ms": round((time.perf_counter() - start) * 1000, 2)
+        })
 
     except Exception as e:
         import traceback
@@ -1962,25 +6636,66 @@ def sales_query():
     
 @app.route("/sku-pricing", methods=["GET"])
 def sku_pricing():
-    """Return complete SKU information including prices"""
-    sku_data = []
-    for sku, qty in CASE_QUANTITIES.items():
-        sku_data.append({
-            "sku": sku,
-            "case_qty": qty,
-            "case_price": CASE_PRICES.get(sku, 0),
-            "price_per_unit": CASE_PRICES.get(sku, 0) / qty if qty > 0 else 0
-        })
-    
-    return jsonify({
-        "sku_info": sku_data,
-        "total_skus": len(sku_data),
-        "price_range": {
-            "min_case_price": min(CASE_PRICES.values()),
-            "max_case_price": max(CASE_PRICES.values()),
-            "avg_case_price": sum(CASE_PRICES.values()) / len(CASE_PRICES)
+    """
+    Return complete SKU information including prices, as of `as_of`
+    (default today). Pass `sku` to include that SKU's price history.
+    """
+    try:
+        as_of = request.args.get("as_of")
+        sku_data = PRICE_BOOK.catalog(as_of or None)
+        prices = [item["case_price"] for item in sku_data]
+        
+        response = {
+            "sku_info": sku_data,
+            "total_skus": len(sku_data),
+            "price_range": {
+                "min_case_price": min(prices),
+                "max_case_price": max(prices),
+                "avg_case_price": sum(prices) / len(prices)
+            },
+            "price_book_version": PRICE_BOOK.version
         }
-    })
+        if request.args.get("sku"):
+            response["history"] = PRICE_BOOK.history(request.args["sku"].strip())
+        return jsonify(response)
+
+    except Exception as e:
+        import traceback
+        print(f"SKU pricing error: {e}")
+        print(traceback.format_exc())
+        return jsonify({"error": str(e)}), 400
+
+
+@app.route("/sku-pricing", methods=["POST"])
+def update_sku_pricing():
+    """
+    Add effective-dated case prices: {"sku", "case_price", "effective_from"}
+    or {"prices": [...]}. A batch is applied only if every entry is valid.
+    Datasets are repriced on their next request.
+    """
+    try:
+        payload = request.get_json(silent=True) or request.form.to_dict()
+        changes = payload.get("prices") or [payload]
+        if isinstance(changes, str):
+            changes = json.loads(changes)
+
+        if not isinstance(changes, list):
+            return jsonify({"error": "prices must be a list"}), 400
+
+        # All or nothing: one bad entry rejects the whole batch
+        applied = PRICE_BOOK.set_prices(changes)
+        return jsonify({
+            "applied": applied,
+            "price_book_version": PRICE_BOOK.version
+        })
+
+    except KeyError as e:
+        return jsonify({"error": f"Missing field {e}"}), 400
+    except Exception as e:
+        import traceback
+        print(f"SKU pricing update error: {e}")
+        print(traceback.format_exc())
+        return jsonify({"error": str(e)}), 400
 
 
 if __name__ == '__main__':
@@ -5,8 +5,10 @@ console.log('🌐 Environment:', import.meta.env.MODE);
 console.log('🔗 API Base URL:', API_BASE_URL);
 
 export const API_ENDPOINTS = {
+  DATASETS: `${API_BASE_URL}/datasets`,
   CAUSAL_ANALYSIS: `${API_BASE_URL}/causal-analysis`,
   FORECAST: `${API_BASE_URL}/forecast`,
+  FORECAST_OVERLAY: `${API_BASE_URL}/forecast/overlay`,
   STORE_ANALYTICS: `${API_BASE_URL}/store-analytics`,
   CAUSAL_FACTORS: `${API_BASE_URL}/causal-factors-report`,
   FULL_REPORTS: `${API_BASE_URL}/full-reports`,
@@ -39,6 +39,116 @@ export function Portal({ children }) {
   return createPortal(children, document.body);
 }
 
+// ⭐ Upload each file once: the backend parses it and returns a dataset_id
+// that every analysis endpoint accepts instead of the raw CSV.
+const datasetIdPromises = new WeakMap();
+
+const registerDataset = (uploadedFile) => {
+  if (!datasetIdPromises.has(uploadedFile)) {
+    const form = new FormData();
+    form.append("file", uploadedFile);
+    const promise = fetch(API_ENDPOINTS.DATASETS, { method: "POST", body: form })
+      .then(async (res) => {
+        if (!res.ok) throw new Error((await res.text()) || "Dataset upload failed");
+        return (await res.json()).dataset_id;
+      })
+      .catch((err) => {
+        datasetIdPromises.delete(uploadedFile);
+        throw err;
+      });
+    datasetIdPromises.set(uploadedFile, promise);
+  }
+  return datasetIdPromises.get(uploadedFile);
+};
+
+const postDataset = async (url, uploadedFile, fields = {}) => {
+  const send = (datasetId) => {
+    const form = new FormData();
+    form.append("dataset_id", datasetId);
+    Object.entries(fields).forEach(([key, value]) => form.append(key, value));
+    return fetch(url, { method: "POST", body: form });
+  };
+
+  const res = await send(await registerDataset(uploadedFile));
+  if (res.status !== 404) return res;
+
+  // Dataset was evicted or the server restarted: upload again and retry once
+  datasetIdPromises.delete(uploadedFile);
+  return send(await registerDataset(uploadedFile));
+};
+
+// ⭐ Scenario events are applied by the backend on top of the cached base
+// forecast (/forecast/overlay), so adding or removing an event costs no refit.
+const FORECAST_HORIZON_DAYS = 365;
+
+const SCENARIO_SERIES = ["actual", "baseline", "predicted", "upper", "lower"];
+
+const postOverlay = (datasetId, events) =>
+  fetch(API_ENDPOINTS.FORECAST_OVERLAY, {
+    method: "POST",
+    headers: { "Content-Type": "application/json" },
+    body: JSON.stringify({
+      dataset_id: datasetId,
+      days: FORECAST_HORIZON_DAYS,
+      events,
+    }),
+  });
+
+// Pass the uploaded file, or only the saved datasetId for a restored session
+const fetchEventOverlay = async (events, uploadedFile, datasetId) => {
+  let id = uploadedFile ? await registerDataset(uploadedFile) : datasetId;
+  if (!id) throw new Error("Upload the file again to update events");
+
+  let res = await postOverlay(id, events);
+  if (res.status === 404) {
+    if (!uploadedFile)
+      throw new Error(
+        "The forecast for this file has expired. Upload the file again to update events."
+      );
+    // Dataset was evicted or the server restarted: upload again and retry once
+    datasetIdPromises.delete(uploadedFile);
+    id = await registerDataset(uploadedFile);
+    res = await postOverlay(id, events);
+  }
+  if (!res.ok) throw new Error((await res.text()) || "Event overlay failed");
+  return { datasetId: id, overlay: await res.json() };
+};
+
+// History rows (actual sales) followed by the overlaid forecast rows
+const buildScenarioGraph = (historyRows, overlay, datasetId) => {
+  const forecastRows = overlay.dates
+    .map((date, i) => {
+      const eventImpacts = {};
+      overlay.events.forEach((event) => {
+        const value = overlay.contributions[event.key][i];
+        if (value) eventImpacts[event.key] = value;
+      });
+      return {
+        ds: date,
+        actual: null,
+        baseline: overlay.baseline[i],
+        predicted: overlay.predicted[i],
+        upper: overlay.upper[i],
+        lower: overlay.lower[i],
+        totalImpact: overlay.total_impact[i],
+        ...eventImpacts,
+      };
+    })
+    .filter((row) => row.predicted !== null && row.predicted > 0);
+
+  return {
+    rows: [...historyRows, ...forecastRows],
+    seriesNames: SCENARIO_SERIES,
+    eventNames: overlay.events
+      .filter((event) => event.days_in_horizon > 0)
+      .map((event) => event.key),
+    datasetId,
+  };
+};
+
+const historyRowsOf = (scenarioGraph) =>
+  (scenarioGraph?.rows || []).filter((row) => row.actual !== null);
+
 const CollapsibleSection = ({ title, children, defaultOpen = false }) => {
   const [isOpen, setIsOpen] = useState(defaultOpen);
 
@@ -289,13 +399,10 @@ const CausalAnalysis = ({ onNavigate, onBack }) => {
   const fetchDecisionSupport = async (uploadedFile) => {
     setLoadingDecisions(true);
     try {
-      const form = new FormData();
-      form.append("file", uploadedFile);
-
-      const res = await fetch(API_ENDPOINTS.DECISION_SUPPORT, {
-        method: "POST",
-        body: form,
-      });
+      const res = await postDataset(
+        API_ENDPOINTS.DECISION_SUPPORT,
+        uploadedFile
+      );
 
       if (!res.ok)
         throw new Error((await res.text()) || "Decision support failed");
@@ -333,13 +440,10 @@ const CausalAnalysis = ({ onNavigate, onBack }) => {
 
   const fetchCategoryAnalysis = async (uploadedFile) => {
     try {
-      const form = new FormData();
-      form.append("file", uploadedFile);
-
-      const res = await fetch(API_ENDPOINTS.CATEGORY_ANALYSIS, {
-        method: "POST",
-        body: form,
-      });
+      const res = await postDataset(
+        API_ENDPOINTS.CATEGORY_ANALYSIS,
+        uploadedFile
+      );
 
       if (res.ok) {
         const data = await res.json();
@@ -375,13 +479,10 @@ const CausalAnalysis = ({ onNavigate, onBack }) => {
 
   const fetchStoreDemandCauses = async (uploadedFile) => {
     try {
-      const form = new FormData();
-      form.append("file", uploadedFile);
-
-      const res = await fetch(API_ENDPOINTS.STORE_DEMAND_CAUSES, {
-        method: "POST",
-        body: form,
-      });
+      const res = await postDataset(
+        API_ENDPOINTS.STORE_DEMAND_CAUSES,
+        uploadedFile
+      );
 
       if (res.ok) {
         const data = await res.json();
@@ -429,32 +530,17 @@ const CausalAnalysis = ({ onNavigate, onBack }) => {
       // ⭐ FIX: Fetch all AI analyses and get the data directly
       const [decisionData, categoryData, storeCausesData] = await Promise.all([
         (async () => {
-          const form = new FormData();
-          form.append("file", file);
-          const res = await fetch(API_ENDPOINTS.DECISION_SUPPORT, {
-            method: "POST",
-            body: form,
-          });
+          const res = await postDataset(API_ENDPOINTS.DECISION_SUPPORT, file);
           return res.ok ? await res.json() : null;
         })(),
 
         (async () => {
-          const form = new FormData();
-          form.append("file", file);
-          const res = await fetch(API_ENDPOINTS.CATEGORY_ANALYSIS, {
-            method: "POST",
-            body: form,
-          });
+          const res = await postDataset(API_ENDPOINTS.CATEGORY_ANALYSIS, file);
           return res.ok ? await res.json() : null;
         })(),
 
         (async () => {
-          const form = new FormData();
-          form.append("file", file);
-          const res = await fetch(API_ENDPOINTS.STORE_DEMAND_CAUSES, {
-            method: "POST",
-            body: form,
-          });
+          const res = await postDataset(API_ENDPOINTS.STORE_DEMAND_CAUSES, file);
           return res.ok ? await res.json() : null;
         })(),
       ]);
@@ -628,13 +714,10 @@ const CausalAnalysis = ({ onNavigate, onBack }) => {
     setIsLoading(true);
     setUploadStatus("Fetching store-level analytics...");
     try {
-      const form = new FormData();
-      form.append("file", uploadedFile);
-
-      const res = await fetch(API_ENDPOINTS.STORE_ANALYTICS, {
-        method: "POST",
-        body: form,
-      });
+      const res = await postDataset(
+        API_ENDPOINTS.STORE_ANALYTICS,
+        uploadedFile
+      );
       if (!res.ok)
         throw new Error((await res.text()) || "Store analytics failed");
       const data = await res.json();
@@ -653,13 +736,8 @@ const CausalAnalysis = ({ onNavigate, onBack }) => {
     setIsLoading(true);
     setUploadStatus(`Generating ${period} reports...`);
     try {
-      const form = new FormData();
-      form.append("file", uploadedFile);
-      form.append("period", period);
-
-      const res = await fetch(API_ENDPOINTS.FULL_REPORTS, {
-        method: "POST",
-        body: form,
+      const res = await postDataset(API_ENDPOINTS.FULL_REPORTS, uploadedFile, {
+        period,
       });
       if (!res.ok) throw new Error((await res.text()) || "Reporting failed");
       const data = await res.json();
@@ -678,14 +756,13 @@ const CausalAnalysis = ({ onNavigate, onBack }) => {
     setIsLoading(true);
     setUploadStatus("Processing forecast with events...");
     setError("");
+    let newScenarioGraph = null;
 
     try {
-      const causalForm = new FormData();
-      causalForm.append("file", uploadedFile);
-      const causalRes = await fetch(API_ENDPOINTS.CAUSAL_ANALYSIS, {
-        method: "POST",
-        body: causalForm,
-      });
+      const causalRes = await postDataset(
+        API_ENDPOINTS.CAUSAL_ANALYSIS,
+        uploadedFile
+      );
       if (!causalRes.ok)
         throw new Error((await causalRes.text()) || "Causal analysis failed");
       const causalData = await causalRes.json();
@@ -700,13 +777,11 @@ const CausalAnalysis = ({ onNavigate, onBack }) => {
       }
 
       setUploadStatus("Generating 1-year forecast...");
-      const forecastForm = new FormData();
-      forecastForm.append("file", uploadedFile);
-      forecastForm.append("days", "365");
-      const forecastRes = await fetch(API_ENDPOINTS.FORECAST, {
-        method: "POST",
-        body: forecastForm,
-      });
+      const forecastRes = await postDataset(
+        API_ENDPOINTS.FORECAST,
+        uploadedFile,
+        { days: String(FORECAST_HORIZON_DAYS) }
+      );
       if (!forecastRes.ok)
         throw new Error((await forecastRes.text()) || "Forecast failed");
       const forecastData = await forecastRes.json();
@@ -714,93 +789,25 @@ const CausalAnalysis = ({ onNavigate, onBack }) => {
       if (forecastData.graph?.dates && forecastData.graph?.series) {
         const { dates, series } = forecastData.graph;
         const actualSales = series.actual || [];
-
-        const rows = dates.map((date, i) => {
-          const baseValue = series.base?.[i];
-          const actualValue = actualSales[i];
-          const isHistorical =
-            actualValue !== null && actualValue !== undefined;
-          let totalImpact = 0;
-          const eventImpacts = {};
-
-          const validBaseValue =
-            baseValue !== null &&
-            baseValue !== undefined &&
-            !isNaN(baseValue) &&
-            baseValue > 0
-              ? baseValue
-              : null;
-
-          if (!isHistorical && validBaseValue !== null) {
-            events.forEach((event) => {
-              const currentDate = date.includes("T")
-                ? date.split("T")[0]
-                : date.substring(0, 10);
-              const startDate = event.startDate.includes("T")
-                ? event.startDate.split("T")[0]
-                : event.startDate;
-              const endDate = (event.endDate || event.startDate).includes("T")
-                ? (event.endDate || event.startDate).split("T")[0]
-                : event.endDate || event.startDate;
-
-              if (currentDate >= startDate && currentDate <= endDate) {
-                const impactValue = validBaseValue * (event.impact / 100);
-                totalImpact += impactValue;
-                eventImpacts[`${event.typeLabel}_${event.id}`] = impactValue;
-              }
-            });
-          }
-
-          return {
+        const historyRows = dates
+          .map((date, i) => ({
             ds: date,
-            actual: isHistorical ? actualValue : null,
-            baseline:
-              !isHistorical && validBaseValue !== null ? validBaseValue : null,
-            predicted:
-              !isHistorical && validBaseValue !== null
-                ? Math.max(0, validBaseValue + totalImpact)
-                : null,
-            upper:
-              !isHistorical && validBaseValue !== null
-                ? Math.max(0, (validBaseValue + totalImpact) * 1.15)
-                : null,
-            lower:
-              !isHistorical && validBaseValue !== null
-                ? Math.max(0, (validBaseValue + totalImpact) * 0.85)
-                : null,
-            totalImpact,
-            ...eventImpacts,
-          };
-        });
-
-        const validRows = rows.filter((row) => {
-          if (row.actual !== null) return true;
-          return row.predicted !== null && row.predicted > 0;
-        });
+            actual: actualSales[i] ?? null,
+            baseline: null,
+            predicted: null,
+            upper: null,
+            lower: null,
+            totalImpact: 0,
+          }))
+          .filter((row) => row.actual !== null);
 
-        const allEventKeys = new Set();
-        validRows.forEach((row) =>
-          Object.keys(row).forEach((key) => {
-            if (
-              ![
-                "ds",
-                "actual",
-                "baseline",
-                "predicted",
-                "upper",
-                "lower",
-                "totalImpact",
-              ].includes(key)
-            )
-              allEventKeys.add(key);
-          })
+        // The /forecast call above cached the base forecast, so this is cheap
+        setUploadStatus("Applying events...");
+        const { datasetId, overlay } = await fetchEventOverlay(
+          events,
+          uploadedFile
         );
-
-        const newScenarioGraph = {
-          rows: validRows,
-          seriesNames: ["actual", "baseline", "predicted", "upper", "lower"],
-          eventNames: Array.from(allEventKeys),
-        };
+        newScenarioGraph = buildScenarioGraph(historyRows, overlay, datasetId);
         setScenarioGraph(newScenarioGraph);
 
         const newDecisions = forecastData.decisions || [];
@@ -838,78 +845,28 @@ const CausalAnalysis = ({ onNavigate, onBack }) => {
       setIsLoading(false);
       setTimeout(() => setUploadStatus(""), 2500);
     }
+    return newScenarioGraph;
   };
 
-  // ⭐ ADD THIS NEW FUNCTION - Recalculate event impacts without backend call
-  const recalculateEventImpactsClientSide = (baseScenarioGraph, events) => {
-    if (!baseScenarioGraph?.rows?.length) return baseScenarioGraph;
-
-    console.log("🔄 Recalculating event impacts client-side...");
-
-    const updatedRows = baseScenarioGraph.rows.map((row) => {
-      // Only recalculate for forecast rows (not historical)
-      if (row.actual !== null) return row;
-
-      if (row.baseline === null || row.baseline === undefined) return row;
-
-      let totalImpact = 0;
-      const eventImpacts = {};
-
-      events.forEach((event) => {
-        const currentDate = row.ds.includes("T")
-          ? row.ds.split("T")[0]
-          : row.ds.substring(0, 10);
-        const startDate = event.startDate.includes("T")
-          ? event.startDate.split("T")[0]
-          : event.startDate;
-        const endDate = event.endDate
-          ? event.endDate.includes("T")
-            ? event.endDate.split("T")[0]
-            : event.endDate
-          : startDate;
-
-        if (currentDate >= startDate && currentDate <= endDate) {
-          const impactValue = row.baseline * (event.impact / 100);
-          totalImpact += impactValue;
-          eventImpacts[`${event.typeLabel}_${event.id}`] = impactValue;
-        }
-      });
-
-      return {
-        ...row,
-        predicted: Math.max(0, row.baseline + totalImpact),
-        upper: Math.max(0, (row.baseline + totalImpact) * 1.15),
-        lower: Math.max(0, (row.baseline + totalImpact) * 0.85),
-        totalImpact,
-        ...eventImpacts,
-      };
-    });
-
-    // Update eventNames
-    const allEventKeys = new Set();
-    updatedRows.forEach((row) => {
-      Object.keys(row).forEach((key) => {
-        if (
-          ![
-            "ds",
-            "actual",
-            "baseline",
-            "predicted",
-            "upper",
-            "lower",
-            "totalImpact",
-          ].includes(key)
-        ) {
-          allEventKeys.add(key);
-        }
-      });
-    });
-
-    return {
-      ...baseScenarioGraph,
-      rows: updatedRows,
-      eventNames: Array.from(allEventKeys),
-    };
+  // ⭐ Re-apply the events to the cached base forecast (no refit). Restored
+  // sessions have no file to upload, so they use the saved datasetId.
+  const applyScenarioEvents = async (
+    events,
+    baseScenarioGraph = scenarioGraph,
+    uploadedFile = isRealFile ? file : null
+  ) => {
+    const { datasetId, overlay } = await fetchEventOverlay(
+      events,
+      uploadedFile,
+      baseScenarioGraph?.datasetId
+    );
+    const updatedScenarioGraph = buildScenarioGraph(
+      historyRowsOf(baseScenarioGraph),
+      overlay,
+      datasetId
+    );
+    setScenarioGraph(updatedScenarioGraph);
+    return updatedScenarioGraph;
   };
 
   const handleFileUploadAndAnalyze = async (e) => {
@@ -931,28 +888,22 @@ const CausalAnalysis = ({ onNavigate, onBack }) => {
     setUploadStatus("Analyzing new file...");
 
     // Run causal forecast with EXISTING events
-    await runForecastWithEvents(f, causalEvents);
+    const uploadedScenarioGraph = await runForecastWithEvents(f, causalEvents);
 
-    const forecastForm = new FormData();
-    forecastForm.append("file", f);
-
-    // Fetch all reports in parallel
+    // Fetch all reports in parallel (the file was already registered above)
     try {
       const results = await Promise.all([
-        fetch(API_ENDPOINTS.STORE_ANALYTICS, {
-          method: "POST",
-          body: forecastForm,
-        }).then((res) => (res.ok ? res.json() : null)),
+        postDataset(API_ENDPOINTS.STORE_ANALYTICS, f).then((res) =>
+          res.ok ? res.json() : null
+        ),
 
-        fetch(API_ENDPOINTS.CAUSAL_FACTORS, {
-          method: "POST",
-          body: forecastForm,
-        }).then((res) => (res.ok ? res.json() : null)),
+        postDataset(API_ENDPOINTS.CAUSAL_FACTORS, f).then((res) =>
+          res.ok ? res.json() : null
+        ),
 
-        fetch(API_ENDPOINTS.FULL_REPORTS, {
-          method: "POST",
-          body: forecastForm,
-        }).then((res) => (res.ok ? res.json() : null)),
+        postDataset(API_ENDPOINTS.FULL_REPORTS, f).then((res) =>
+          res.ok ? res.json() : null
+        ),
 
         fetchDecisionSupport(f).then(() => decisionSupport),
         fetchCategoryAnalysis(f).then(() => categoryAnalysis),
@@ -968,14 +919,14 @@ const CausalAnalysis = ({ onNavigate, onBack }) => {
       setTimeout(async () => {
         const adjustedEvents = await validateAndAdjustEvents(
           causalEvents,
-          scenarioGraph
+          uploadedScenarioGraph
         );
         setCausalEvents(adjustedEvents);
 
         // Save with ADJUSTED events (not empty)
         if (currentUser) {
           await saveCurrentStateToFirestore(currentUser.uid, f.name, {
-            scenarioGraph: scenarioGraph,
+            scenarioGraph: uploadedScenarioGraph,
             forecastPayload: forecastPayload,
             decisions: decisions,
             featureImportance: featureImportance,
@@ -988,27 +939,30 @@ const CausalAnalysis = ({ onNavigate, onBack }) => {
             storeDemandCauses: storeDemandCauses,
           });
 
-          // ⭐ Re-run forecast with adjusted events
-          if (adjustedEvents.length > 0) {
+          // ⭐ Re-apply the adjusted events to the new base forecast
+          if (adjustedEvents.length > 0 && uploadedScenarioGraph) {
             setUploadStatus("Adjusting events to new data range...");
-            await runForecastWithEvents(f, adjustedEvents);
+            const adjustedScenarioGraph = await applyScenarioEvents(
+              adjustedEvents,
+              uploadedScenarioGraph,
+              f
+            );
 
             // Save again with updated forecast
-            setTimeout(async () => {
-              await saveCurrentStateToFirestore(currentUser.uid, f.name, {
-                scenarioGraph,
-                forecastPayload,
-                decisions,
-                featureImportance,
-                causalEvents: adjustedEvents,
-                storeAnalytics: results[0],
-                causalFactorAnalysis: results[1],
-                fullReports: results[2],
-                decisionSupport: decisionSupport,
-                categoryAnalysis: categoryAnalysis,
-                storeDemandCauses: storeDemandCauses,
-              });
-            }, 1000);
+            await saveCurrentStateToFirestore(currentUser.uid, f.name, {
+              scenarioGraph: adjustedScenarioGraph,
+              forecastPayload,
+              decisions,
+              featureImportance,
+              causalEvents: adjustedEvents,
+              storeAnalytics: results[0],
+              causalFactorAnalysis: results[1],
+              fullReports: results[2],
+              decisionSupport: decisionSupport,
+              categoryAnalysis: categoryAnalysis,
+              storeDemandCauses: storeDemandCauses,
+            });
+            setUploadStatus("");
           }
         }
       }, 2000);
@@ -1151,15 +1105,15 @@ const CausalAnalysis = ({ onNavigate, onBack }) => {
       description: "",
     });
 
-    if (file && isRealFile) {
-      // ⭐ REAL FILE: Run backend forecast
+    if (file) {
+      // ⭐ Apply the events to the cached base forecast (no refit)
       setUploadStatus("🔄 Updating forecast with new event...");
-      await runForecastWithEvents(file, updatedEvents);
+      try {
+        const updatedScenarioGraph = await applyScenarioEvents(updatedEvents);
 
-      setTimeout(async () => {
         if (currentUser) {
           await saveCurrentStateToFirestore(currentUser.uid, file.name, {
-            scenarioGraph,
+            scenarioGraph: updatedScenarioGraph,
             forecastPayload,
             decisions,
             featureImportance,
@@ -1171,36 +1125,13 @@ const CausalAnalysis = ({ onNavigate, onBack }) => {
             categoryAnalysis,
             storeDemandCauses,
           });
-          setUploadStatus("✅ Event added and forecast updated!");
-          setTimeout(() => setUploadStatus(""), 2000);
         }
-      }, 1500);
-    } else if (file && !isRealFile) {
-      // ⭐ PSEUDO-FILE: Recalculate client-side
-      setUploadStatus("🔄 Recalculating event impacts...");
-
-      const updatedScenarioGraph = recalculateEventImpactsClientSide(
-        scenarioGraph,
-        updatedEvents
-      );
-      setScenarioGraph(updatedScenarioGraph);
-
-      if (currentUser) {
-        await saveCurrentStateToFirestore(currentUser.uid, file.name, {
-          scenarioGraph: updatedScenarioGraph,
-          forecastPayload,
-          decisions,
-          featureImportance,
-          causalEvents: updatedEvents,
-          storeAnalytics,
-          causalFactorAnalysis,
-          fullReports,
-          decisionSupport,
-          categoryAnalysis,
-          storeDemandCauses,
-        });
-        setUploadStatus("✅ Event added and impacts updated!");
+        setUploadStatus("✅ Event added and forecast updated!");
         setTimeout(() => setUploadStatus(""), 2000);
+      } catch (err) {
+        console.error(err);
+        setError(String(err.message || err));
+        setUploadStatus("");
       }
     }
   };
@@ -1211,14 +1142,14 @@ const CausalAnalysis = ({ onNavigate, onBack }) => {
 
     setUploadStatus("💾 Removing event...");
 
-    if (file && isRealFile) {
-      // ⭐ REAL FILE: Recalculate with backend
-      await runForecastWithEvents(file, updatedEvents);
+    if (file) {
+      // ⭐ Apply the events to the cached base forecast (no refit)
+      try {
+        const updatedScenarioGraph = await applyScenarioEvents(updatedEvents);
 
-      setTimeout(async () => {
         if (currentUser) {
           await saveCurrentStateToFirestore(currentUser.uid, file.name, {
-            scenarioGraph,
+            scenarioGraph: updatedScenarioGraph,
             forecastPayload,
             decisions,
             featureImportance,
@@ -1230,36 +1161,13 @@ const CausalAnalysis = ({ onNavigate, onBack }) => {
             categoryAnalysis,
             storeDemandCauses,
           });
-          setUploadStatus("✅ Event removed and forecast updated!");
-          setTimeout(() => setUploadStatus(""), 2000);
         }
-      }, 1500);
-    } else if (file && !isRealFile) {
-      // ⭐ PSEUDO-FILE: Recalculate client-side
-      setUploadStatus("🔄 Recalculating impacts...");
-
-      const updatedScenarioGraph = recalculateEventImpactsClientSide(
-        scenarioGraph,
-        updatedEvents
-      );
-      setScenarioGraph(updatedScenarioGraph);
-
-      if (currentUser) {
-        await saveCurrentStateToFirestore(currentUser.uid, file.name, {
-          scenarioGraph: updatedScenarioGraph,
-          forecastPayload,
-          decisions,
-          featureImportance,
-          causalEvents: updatedEvents,
-          storeAnalytics,
-          causalFactorAnalysis,
-          fullReports,
-          decisionSupport,
-          categoryAnalysis,
-          storeDemandCauses,
-        });
-        setUploadStatus("✅ Event removed and impacts updated!");
+        setUploadStatus("✅ Event removed and forecast updated!");
         setTimeout(() => setUploadStatus(""), 2000);
+      } catch (err) {
+        console.error(err);
+        setError(String(err.message || err));
+        setUploadStatus("");
       }
     }
   };
@@ -1274,9 +1182,7 @@ const CausalAnalysis = ({ onNavigate, onBack }) => {
     setError("");
 
     try {
-      const formData = new FormData();
-      formData.append("file", file);
-      formData.append("query_type", queryType);
+      const fields = { query_type: queryType };
 
       if (queryType === "custom") {
         if (!customStartDate || !customEndDate) {
@@ -1284,21 +1190,22 @@ const CausalAnalysis = ({ onNavigate, onBack }) => {
           setIsQuerying(false);
           return;
         }
-        formData.append("start_date", customStartDate);
-        formData.append("end_date", customEndDate);
+        fields.start_date = customStartDate;
+        fields.end_date = customEndDate;
       } else {
         if (!queryValue) {
           setError("Please enter a date/period to query");
           setIsQuerying(false);
           return;
         }
-        formData.append("query_value", queryValue);
+        fields.query_value = queryValue;
       }
 
-      const response = await fetch(API_ENDPOINTS.SALES_QUERY, {
-        method: "POST",
-        body: formData,
-      });
+      const response = await postDataset(
+        API_ENDPOINTS.SALES_QUERY,
+        file,
+        fields
+      );
 
       if (!response.ok) {
         throw new Error((await response.text()) || "Query failed");